@@ -0,0 +1,117 @@
+from fastapi import Depends, HTTPException, Request
+from sqlalchemy import select
+from collections import OrderedDict, namedtuple
+from jose import jwt, JWTError
+import threading, time
+
+from .db import get_db, writer
+from . import models
+from .security import SECRET, ALGO
+
+# -----------------------------------------------------------------------------
+# Request authentication
+#
+# A decoded token resolves to a small immutable snapshot of the user. Snapshots
+# are kept in a bounded TTL/LRU cache keyed by the raw token, so an
+# authenticated request normally costs no JWT decode and no user query. The
+# request's AsyncSession comes from get_db and is shared with the handler.
+# -----------------------------------------------------------------------------
+UserSnap = namedtuple("UserSnap", "id name email role")
+
+CACHE_TTL = 60.0
+CACHE_SIZE = 4096
+
+class TokenCache:
+    def __init__(self, maxsize: int = CACHE_SIZE, ttl: float = CACHE_TTL):
+        self.maxsize, self.ttl = maxsize, ttl
+        self._d = OrderedDict()  # token -> (expires_at, UserSnap)
+        self._lock = threading.Lock()
+
+    def get(self, token: str):
+        with self._lock:
+            hit = self._d.get(token)
+            if not hit:
+                return None
+            if hit[0] <= time.monotonic():
+                del self._d[token]
+                return None
+            self._d.move_to_end(token)
+            return hit[1]
+
+    def put(self, token: str, snap: UserSnap, ttl: float = None):
+        with self._lock:
+            self._d[token] = (time.monotonic() + min(ttl or self.ttl, self.ttl), snap)
+            self._d.move_to_end(token)
+            while len(self._d) > self.maxsize:
+                self._d.popitem(last=False)
+
+    def drop_user(self, user_id: int):
+        with self._lock:
+            for k in [k for k, (_, s) in self._d.items() if s.id == user_id]:
+                del self._d[k]
+
+    def clear(self):
+        with self._lock:
+            self._d.clear()
+
+cache = TokenCache()
+
+def invalidate_user(user_id: int):
+    # Call whenever a user's role, password or profile changes.
+    cache.drop_user(user_id)
+
+def snapshot(u) -> UserSnap:
+    return UserSnap(u.id, u.name, u.email, u.role)
+
+async def resolve(token: str, d):
+    if not token:
+        return None
+    snap = cache.get(token)
+    if snap:
+        return snap
+    try:
+        claims = jwt.decode(token, SECRET, algorithms=[ALGO])
+    except JWTError:
+        return None
+    email = claims.get("sub")
+    if not email:
+        return None
+    u = (await d.execute(select(models.User).where(models.User.email == email))).scalar_one_or_none()
+    if not u:
+        return None
+    snap = snapshot(u)
+    await d.close()  # hand the connection back; the handler may await a slow upload next
+    left = claims.get("exp", 0) - time.time() if claims.get("exp") else None
+    cache.put(token, snap, left)
+    return snap
+
+# -----------------------------------------------------------------------------
+# Dependencies (coroutines, so resolving a user never takes a threadpool worker)
+# -----------------------------------------------------------------------------
+async def optional_user(request: Request, d=Depends(get_db)):
+    return await resolve(request.cookies.get("t"), d)
+
+async def require_user(u=Depends(optional_user)):
+    if not u:
+        raise HTTPException(status_code=302, headers={"Location": "/auth/login"})
+    return u
+
+async def require_admin(u=Depends(require_user)):
+    if u.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin only")
+    return u
+
+# -----------------------------------------------------------------------------
+# Account changes (always invalidate cached snapshots)
+# -----------------------------------------------------------------------------
+async def set_role(d, user_id: int, role: str):
+    async with writer():
+        await d.execute(models.User.__table__.update().where(models.User.id == user_id).values(role=role))
+        await d.commit()
+    invalidate_user(user_id)
+
+async def set_password(d, user_id: int, hashed: str):
+    async with writer():
+        await d.execute(models.User.__table__.update().where(models.User.id == user_id).values(hashed_password=hashed))
+        await d.commit()
+    invalidate_user(user_id)
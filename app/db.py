@@ -1,5 +1,90 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.orm import sessionmaker, declarative_base
-engine=create_engine('sqlite:///./vapp.db', connect_args={'check_same_thread': False})
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+import asyncio, contextlib, os, weakref
+
+# Either a plain or an async driver URL may be given; the request path always
+# uses the async driver, while migrations, CLI commands and the background image
+# thread use the matching sync one.
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./vapp.db")
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg", "mysql": "mysql+aiomysql"}
+SYNC_DRIVERS = {"sqlite+aiosqlite": "sqlite", "postgresql+asyncpg": "postgresql", "mysql+aiomysql": "mysql+pymysql"}
+
+def _with_driver(url: str, mapping: dict) -> str:
+    scheme, sep, rest = url.partition("://")
+    return mapping.get(scheme, scheme) + sep + rest
+
+ASYNC_URL = _with_driver(DATABASE_URL, ASYNC_DRIVERS)
+SYNC_URL = _with_driver(DATABASE_URL, SYNC_DRIVERS)
+IS_SQLITE = SYNC_URL.startswith("sqlite")
+
+# Pool for the async engine. Requests wait up to DB_POOL_TIMEOUT for a free
+# connection. SQLite gets no overflow by default: it serializes writers anyway,
+# and overflow connections would be opened and torn down on every request.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "0" if IS_SQLITE else "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+# Applied to every new SQLite connection. WAL lets readers run alongside the
+# single writer; synchronous=NORMAL is durable across app crashes under WAL.
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA temp_store=MEMORY",
+)
+
+engine=create_engine(SYNC_URL, connect_args={'check_same_thread': False} if IS_SQLITE else {})
 SessionLocal=sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base=declarative_base()
+
+async_engine = create_async_engine(
+    ASYNC_URL,
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=-1 if IS_SQLITE else DB_POOL_RECYCLE,
+    pool_pre_ping=not IS_SQLITE,
+)
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+def _sqlite_pragmas(dbapi_conn, _rec):
+    cur = dbapi_conn.cursor()
+    for p in SQLITE_PRAGMAS:
+        cur.execute(p)
+    cur.close()
+
+if IS_SQLITE:
+    event.listen(engine, "connect", _sqlite_pragmas)
+    event.listen(async_engine.sync_engine, "connect", _sqlite_pragmas)
+
+# SQLite takes one writer at a time. Queueing write transactions on an asyncio
+# lock hands the database over in FIFO order, instead of every waiter polling in
+# SQLite's busy handler with growing sleeps. One lock per event loop; other
+# processes are still covered by busy_timeout.
+_write_locks = weakref.WeakKeyDictionary()
+
+def writer():
+    if not IS_SQLITE:
+        return contextlib.nullcontext()
+    loop = asyncio.get_running_loop()
+    lock = _write_locks.get(loop)
+    if lock is None:
+        lock = _write_locks[loop] = asyncio.Lock()
+    return lock
+
+async def warm_pool(n: int = None):
+    # Opens the pool's connections up front so the first burst of requests does
+    # not pay for connection setup (each aiosqlite connection is its own thread).
+    conns = [await async_engine.connect() for _ in range(min(n or DB_POOL_SIZE, DB_POOL_SIZE))]
+    for c in conns:
+        await c.close()
+
+async def get_db():
+    async with AsyncSessionLocal() as d:
+        yield d
@@ -0,0 +1,264 @@
+from sqlalchemy import text
+from collections import defaultdict, namedtuple
+import math, os, threading
+
+import numpy as np
+
+from . import versions
+
+# -----------------------------------------------------------------------------
+# Geofencing against the sites registry (offices and client locations)
+#
+# A point is classified as the site it falls inside (nearest centre if it is
+# inside several), otherwise the nearest site within NEAREST_MAX_M, otherwise
+# no site. Sites live in memory in a grid of CELL_DEG cells; a lookup walks
+# rings of cells outwards from the point's cell and stops as soon as no
+# unvisited cell can hold a better site, so it only touches the few sites
+# around the point. The grid is rebuilt when the `sites` data version changes.
+# reclassify() re-runs every stored point in bulk with NumPy.
+# -----------------------------------------------------------------------------
+EARTH_M = 6371008.8
+M_PER_DEG = EARTH_M * math.pi / 180
+CELL_DEG = float(os.getenv("GEOFENCE_CELL_DEG", "0.01"))  # ~1.1 km
+NEAREST_MAX_M = float(os.getenv("GEOFENCE_NEAREST_MAX_M", "25000"))
+RADIUS_DEFAULT = 150.0
+KINDS = ("office", "client")
+SCOPE = "sites"
+
+BLOCK_DEG = 0.25  # reclassify() groups points into blocks this size
+PAIR_BUDGET = 2_000_000  # point x site distances per NumPy batch
+BATCH = 5000
+
+Match = namedtuple("Match", "site_id name distance_m inside")
+
+def distance_m(lat1, lng1, lat2, lng2):
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((p2 - p1) / 2) ** 2
+         + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_M * math.asin(min(1.0, math.sqrt(a)))
+
+def distances_m(lat1, lng1, lat2, lng2):
+    # Broadcasting haversine over NumPy arrays.
+    p1, p2 = np.radians(lat1), np.radians(lat2)
+    a = (np.sin((p2 - p1) / 2) ** 2
+         + np.cos(p1) * np.cos(p2) * np.sin(np.radians(lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_M * np.arcsin(np.minimum(1.0, np.sqrt(a)))
+
+def _cell(lat, lng):
+    return math.floor(lat / CELL_DEG), math.floor(lng / CELL_DEG)
+
+def _ring(ci, cj, k):
+    if k == 0:
+        yield ci, cj
+        return
+    for di in range(-k, k + 1):
+        if abs(di) == k:
+            for dj in range(-k, k + 1):
+                yield ci + di, cj + dj
+        else:
+            yield ci + di, cj - k
+            yield ci + di, cj + k
+
+class SiteIndex:
+    def __init__(self, rows):
+        rows = list(rows)
+        self.ids = [r.id for r in rows]
+        self.names = [r.name for r in rows]
+        self.lat = np.array([r.lat for r in rows], dtype=np.float64)
+        self.lng = np.array([r.lng for r in rows], dtype=np.float64)
+        self.radius = np.array([r.radius_m or RADIUS_DEFAULT for r in rows], dtype=np.float64)
+        self.max_radius = float(self.radius.max()) if rows else 0.0
+        self.reach = max(NEAREST_MAX_M, self.max_radius)
+        self.cells = defaultdict(list)
+        self._pts = [(r.lat, r.lng, r.radius_m or RADIUS_DEFAULT) for r in rows]
+        for i, r in enumerate(rows):
+            self.cells[_cell(r.lat, r.lng)].append(i)
+        # cells can't hold sites further than `reach` away from anything useful
+        self.max_rings = int(self.reach / (CELL_DEG * M_PER_DEG)) + 2
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _match(self, i, dist, inside):
+        if i is None or (not inside and dist > self.reach):
+            return Match(None, None, None, False)
+        return Match(self.ids[i], self.names[i], round(dist, 1), inside)
+
+    def classify(self, lat: float, lng: float):
+        ci, cj = _cell(lat, lng)
+        best = None  # (outside?, distance, site index)
+        for k in range(self.max_rings * 4):
+            for c in _ring(ci, cj, k):
+                for i in self.cells.get(c, ()):
+                    slat, slng, rad = self._pts[i]
+                    dist = distance_m(lat, lng, slat, slng)
+                    key = (dist > rad, dist, i)
+                    if best is None or key < best:
+                        best = key
+            # Every site in an unvisited cell is at least this far away.
+            edge = min(90.0, abs(lat) + (k + 1) * CELL_DEG)
+            seen = k * CELL_DEG * M_PER_DEG * max(math.cos(math.radians(edge)), 1e-3)
+            if best is not None:
+                need = best[1] if not best[0] else max(best[1], self.max_radius)
+                if seen >= need:
+                    break
+            elif seen > self.reach:
+                break
+        if best is None:
+            return self._match(None, None, False)
+        return self._match(best[2], best[1], not best[0])
+
+    def classify_many(self, lat, lng):
+        # -> (site index or -1, distance_m or NaN, inside) arrays, same rules
+        # as classify(). Points are grouped by BLOCK_DEG block and only sites
+        # within `reach` of a block are compared against its points.
+        lat, lng = np.asarray(lat, dtype=np.float64), np.asarray(lng, dtype=np.float64)
+        n = len(lat)
+        site = np.full(n, -1, dtype=np.int64)
+        dist = np.full(n, np.nan)
+        inside = np.zeros(n, dtype=bool)
+        if not n or not len(self):
+            return site, dist, inside
+        blocks = np.floor(lat / BLOCK_DEG) * 1e6 + np.floor(lng / BLOCK_DEG)
+        _, inv = np.unique(blocks, return_inverse=True)
+        pad_lat = self.reach / M_PER_DEG
+        for b in np.unique(inv):
+            pts = np.flatnonzero(inv == b)
+            lo, hi = lat[pts].min() - pad_lat, lat[pts].max() + pad_lat
+            cos = math.cos(math.radians(min(89.9, max(abs(lo), abs(hi)))))
+            pad_lng = self.reach / (M_PER_DEG * max(cos, 1e-3))
+            cand = np.flatnonzero((self.lat >= lo) & (self.lat <= hi)
+                                  & (self.lng >= lng[pts].min() - pad_lng) & (self.lng <= lng[pts].max() + pad_lng))
+            if not len(cand):
+                continue
+            step = max(1, PAIR_BUDGET // len(cand))
+            for s in range(0, len(pts), step):
+                p = pts[s:s + step]
+                dm = distances_m(lat[p, None], lng[p, None], self.lat[cand], self.lng[cand])
+                ins = dm <= self.radius[cand]
+                j = np.argmin(np.where(ins, dm, dm + 4 * EARTH_M), axis=1)  # inside sites rank first
+                r = np.arange(len(p))
+                d, i = dm[r, j], ins[r, j]
+                ok = i | (d <= self.reach)
+                site[p[ok]], dist[p[ok]], inside[p] = cand[j[ok]], d[ok].round(1), i
+        return site, dist, inside
+
+# -----------------------------------------------------------------------------
+# Process-wide index
+# -----------------------------------------------------------------------------
+_index = (None, SiteIndex(()))
+_lock = threading.Lock()
+
+def load(d):
+    return d.execute(text("SELECT id, name, lat, lng, radius_m FROM sites "
+                          "WHERE lat IS NOT NULL AND lng IS NOT NULL")).fetchall()
+
+def index(d) -> SiteIndex:
+    # Rebuilt whenever the sites scope's version moves; without the version
+    # triggers (versions.ready) it is rebuilt on every call.
+    global _index
+    if not versions.ready:
+        return SiteIndex(load(d))
+    ver = versions.get(d, SCOPE)
+    if _index[0] == ver:
+        return _index[1]
+    with _lock:
+        if _index[0] != ver:
+            _index = (ver, SiteIndex(load(d)))
+        return _index[1]
+
+def classify(d, lat, lng):
+    # None when there is nothing to classify (no fix, or no sites registered).
+    if lat is None or lng is None:
+        return None
+    idx = index(d)
+    return idx.classify(lat, lng) if len(idx) else None
+
+def columns(m):
+    # Match -> values for the <side>_site_id/_site_dist/_inside columns
+    return (m.site_id, m.distance_m, m.inside) if m else (None, None, None)
+
+def as_dict(m):
+    if not m:
+        return None
+    return {"id": m.site_id, "name": m.name, "distance_m": m.distance_m, "inside": m.inside}
+
+# -----------------------------------------------------------------------------
+# Registry
+# -----------------------------------------------------------------------------
+def add_site(d, name: str, kind: str, lat: float, lng: float, radius_m: float = None):
+    return d.execute(
+        text("INSERT INTO sites (name, kind, lat, lng, radius_m) VALUES (:n,:k,:la,:ln,:r) RETURNING id"),
+        {"n": name, "k": kind, "la": lat, "ln": lng, "r": radius_m or RADIUS_DEFAULT},
+    ).scalar()
+
+def check_site(name, kind, lat, lng, radius_m):
+    # Raises ValueError; returns the normalised row.
+    name = (name or "").strip()
+    if not name:
+        raise ValueError("name is required")
+    kind = (kind or "office").strip().lower()
+    if kind not in KINDS:
+        raise ValueError(f"kind must be one of {', '.join(KINDS)}")
+    lat, lng = float(lat), float(lng)
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise ValueError("coordinates out of range")
+    radius_m = float(radius_m) if radius_m not in (None, "") else RADIUS_DEFAULT
+    if not 0 < radius_m <= NEAREST_MAX_M:
+        raise ValueError(f"radius must be between 0 and {NEAREST_MAX_M:.0f} m")
+    return {"n": name, "k": kind, "la": lat, "ln": lng, "r": radius_m}
+
+def import_sites(d, rows):
+    # rows: dicts with name, kind, lat, lng, radius_m. Returns (added, errors).
+    ok, errors = [], []
+    for n, r in enumerate(rows, 1):
+        try:
+            ok.append(check_site(r.get("name"), r.get("kind"), r.get("lat"), r.get("lng"), r.get("radius_m")))
+        except (TypeError, ValueError) as e:
+            errors.append(f"row {n}: {e}")
+    for s in range(0, len(ok), BATCH):
+        d.execute(text("INSERT INTO sites (name, kind, lat, lng, radius_m) VALUES (:n,:k,:la,:ln,:r)"),
+                  ok[s:s + BATCH])
+    return len(ok), errors
+
+def sites_page(d, q: str = None, limit: int = 100, offset: int = 0):
+    where, params = "", {"n": limit, "o": offset}
+    if q:
+        where, params["q"] = "WHERE name LIKE :q", f"%{q}%"
+    rows = d.execute(text(f"SELECT id, name, kind, lat, lng, radius_m FROM sites {where} "
+                          "ORDER BY name, id LIMIT :n OFFSET :o"), params).fetchall()
+    total = d.execute(text(f"SELECT COUNT(*) FROM sites {where}"), params).scalar()
+    return rows, total
+
+# -----------------------------------------------------------------------------
+# Bulk re-classification of stored points
+# -----------------------------------------------------------------------------
+TARGETS = (
+    ("attendance", "cin_lat", "cin_lng", "cin_site_id", "cin_site_dist", "cin_inside"),
+    ("attendance", "cout_lat", "cout_lng", "cout_site_id", "cout_site_dist", "cout_inside"),
+    ("recce", "lat", "lng", "site_id", "site_dist", "inside"),
+)
+
+def reclassify(d):
+    # Recomputes every stored fix against the current registry; returns the
+    # number of points written. Commits per table.
+    idx, total = SiteIndex(load(d)), 0
+    for table, la, ln, sid, sd, ins in TARGETS:
+        rows = d.execute(text(f"SELECT id, {la}, {ln} FROM {table} "
+                              f"WHERE {la} IS NOT NULL AND {ln} IS NOT NULL")).fetchall()
+        if not rows:
+            continue
+        ids, lat, lng = np.array(list(map(tuple, rows)), dtype=np.float64).T
+        site, dist, inside = idx.classify_many(lat, lng)
+        have = len(idx) > 0
+        params = [{
+            "id": int(i),
+            "s": idx.ids[s] if s >= 0 else None,
+            "d": None if np.isnan(m) else float(m),
+            "in": bool(x) if have else None,
+        } for i, s, m, x in zip(ids, site, dist, inside)]
+        for s in range(0, len(params), BATCH):
+            d.execute(text(f"UPDATE {table} SET {sid}=:s, {sd}=:d, {ins}=:in WHERE id=:id"), params[s:s + BATCH])
+        d.commit()
+        total += len(params)
+    return total
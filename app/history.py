@@ -0,0 +1,101 @@
+from sqlalchemy import text
+from datetime import date
+import base64, json
+
+# -----------------------------------------------------------------------------
+# Attendance history (JSON API)
+#
+# Rows are returned in (date, user_id) order and paged by keyset: the cursor
+# is the last row's (date, user_id), and the next page starts strictly after
+# it. That walks ix_attendance_date_user (or ux_attendance_user_date when one
+# user is asked for) instead of counting past an OFFSET. Working hours are
+# computed in SQL. Optional column groups are only selected when asked for.
+# -----------------------------------------------------------------------------
+HOURS_SQL = "ROUND((julianday(a.cout_ts) - julianday(a.cin_ts)) * 24, 2)"
+
+PAGE_DEFAULT = 100
+PAGE_MAX = 1000
+STATUSES = ("PRESENT", "LATE")
+
+BASE_COLUMNS = ("a.date", "a.user_id", "u.name", "u.email", "a.status", "a.cin_ts", "a.cout_ts",
+                f"{HOURS_SQL} AS hrs")
+FIELD_GROUPS = {
+    "remarks": ("a.cin_remark", "a.cout_remark"),
+    "geo": ("a.cin_lat", "a.cin_lng", "a.cout_lat", "a.cout_lng", "a.cin_site_id", "a.cin_site_dist",
+            "a.cin_inside", "a.cout_site_id", "a.cout_site_dist", "a.cout_inside"),
+    "photos": ("a.cin_photo", "a.cout_photo", "a.cin_thumb", "a.cout_thumb"),
+}
+
+def encode_cursor(day, user_id: int) -> str:
+    raw = json.dumps([str(day), user_id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str):
+    # Raises ValueError on anything that isn't a cursor we issued.
+    try:
+        day, uid = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return date.fromisoformat(day).isoformat(), int(uid)
+    except Exception:
+        raise ValueError("bad cursor")
+
+def parse_fields(fields: str = None):
+    # None/empty means every group; otherwise a comma list of FIELD_GROUPS keys.
+    if not fields:
+        return tuple(FIELD_GROUPS)
+    groups = tuple(dict.fromkeys(f.strip().lower() for f in fields.split(",") if f.strip()))
+    unknown = [g for g in groups if g not in FIELD_GROUPS]
+    if unknown:
+        raise ValueError(f"unknown fields: {', '.join(unknown)}")
+    return groups
+
+def _serialize(m, groups):
+    r = {
+        "date": str(m["date"]),
+        "user_id": m["user_id"],
+        "name": m["name"],
+        "email": m["email"],
+        "status": m["status"],
+        "check_in_ts": str(m["cin_ts"]) if m["cin_ts"] else None,
+        "check_out_ts": str(m["cout_ts"]) if m["cout_ts"] else None,
+        "working_hours": m["hrs"],
+    }
+    if "remarks" in groups:
+        r["cin_remark"], r["cout_remark"] = m["cin_remark"], m["cout_remark"]
+    if "geo" in groups:
+        r["check_in_geo"] = [m["cin_lat"], m["cin_lng"]] if m["cin_lat"] is not None else None
+        r["check_out_geo"] = [m["cout_lat"], m["cout_lng"]] if m["cout_lat"] is not None else None
+        for side, key in (("cin", "check_in"), ("cout", "check_out")):
+            inside = m[side + "_inside"]
+            r[f"{key}_site"] = None if inside is None else {
+                "id": m[side + "_site_id"], "distance_m": m[side + "_site_dist"], "inside": bool(inside)}
+    if "photos" in groups:
+        for side, key in (("cin", "check_in"), ("cout", "check_out")):
+            r[f"{key}_photo"] = f"/{m[side + '_photo']}" if m[side + "_photo"] else None
+            r[f"{key}_thumb"] = f"/{m[side + '_thumb']}" if m[side + "_thumb"] else None
+    return r
+
+def page(d, d1: date, d2: date, user_id: int = None, statuses=None, groups=None,
+         after=None, limit: int = PAGE_DEFAULT):
+    groups = groups if groups is not None else tuple(FIELD_GROUPS)
+    cols = list(BASE_COLUMNS)
+    for g in groups:
+        cols.extend(FIELD_GROUPS[g])
+    where = ["a.date BETWEEN :d1 AND :d2"]
+    params = {"d1": d1, "d2": d2, "n": limit + 1}
+    if user_id:
+        where.append("a.user_id = :u")
+        params["u"] = user_id
+    if statuses:
+        where.append("a.status IN (" + ",".join(f":s{i}" for i in range(len(statuses))) + ")")
+        params.update({f"s{i}": s for i, s in enumerate(statuses)})
+    if after:
+        # The plain >= gives the planner an index seek; the OR trims that day.
+        where.append("a.date >= :cd AND (a.date > :cd OR a.user_id > :cu)")
+        params["cd"], params["cu"] = after
+    q = (f"SELECT {', '.join(cols)} FROM attendance a JOIN users u ON u.id = a.user_id "
+         f"WHERE {' AND '.join(where)} ORDER BY a.date, a.user_id LIMIT :n")
+    rows = d.execute(text(q), params).fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    nxt = encode_cursor(rows[-1].date, rows[-1].user_id) if more else None
+    return [_serialize(r._mapping, groups) for r in rows], nxt
@@ -0,0 +1,157 @@
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipResponder
+from starlette.responses import Response
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timezone
+from email.utils import formatdate, parsedate_to_datetime
+import glob, hashlib, os, threading
+
+from . import metrics, versions
+
+# -----------------------------------------------------------------------------
+# HTTP caching for polled views
+#
+# A view names the data_versions scopes it is built from (see versions.py).
+# One primary-key lookup turns them into a weak ETag and a Last-Modified, and
+# a client that already holds that ETag gets a 304 before any row query or
+# template render runs. Views are `private, no-cache`: browsers keep them but
+# revalidate on every poll. The build digest (templates + code) is part of
+# every ETag, and Last-Modified is never earlier than process start, so a
+# deploy invalidates everything.
+#
+# Without version triggers (versions.ready is False, i.e. not SQLite) views
+# get an empty Tag: no validators are sent, nothing is answered with 304 and
+# fragments are not cached.
+#
+# Fragments holds rendered HTML that doesn't depend on the viewer, keyed by the
+# same versions, so it is shared between admins. CompressMiddleware gzips
+# HTML, JSON and text responses; images and pre-compressed exports go through
+# untouched.
+# -----------------------------------------------------------------------------
+CACHE_CONTROL = "private, no-cache"
+FRAGMENTS_MAX = int(os.getenv("FRAGMENT_CACHE_SIZE", "256"))
+GZIP_MIN_BYTES = 1000
+GZIP_LEVEL = 6
+COMPRESSIBLE = ("text/html", "application/json", "text/plain")
+
+cache_total = metrics.Counter("vapp_http_cache_total", "Conditional views and fragment cache lookups by view and outcome.")
+metrics.REGISTRY.append(cache_total)
+
+def _build():
+    here = os.path.dirname(__file__)
+    h = hashlib.sha256()
+    for p in sorted(glob.glob(os.path.join(here, "*.py")) + glob.glob(os.path.join(here, "templates", "*.html"))):
+        with open(p, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()[:12]
+
+BUILD = _build()
+STARTED = datetime.now(timezone.utc).replace(microsecond=0)
+
+Tag = namedtuple("Tag", "etag last_modified key")
+
+def _utc(v: str):
+    return datetime.fromisoformat(v).replace(tzinfo=timezone.utc, microsecond=0)
+
+def tag(d, scopes, *extra, since: datetime = None) -> Tag:
+    # Sync (run via d.run_sync). `extra` is whatever else the view depends on
+    # (query params, the viewer, today's date); `since` floors Last-Modified
+    # for views that also change with the clock.
+    if not versions.ready:
+        return Tag(None, None, None)
+    vers = versions.many(d, scopes)
+    key = (BUILD, *(vers[s][0] for s in scopes), *extra)
+    etag = 'W/"%s"' % hashlib.sha1(repr(key).encode()).hexdigest()[:20]
+    stamps = [_utc(c) for _, c in vers.values() if c] + [STARTED] + ([since] if since else [])
+    return Tag(etag, max(stamps), key)
+
+def _matches(header: str, etag: str) -> bool:
+    # Weak comparison, as If-None-Match requires.
+    if header.strip() == "*":
+        return True
+    want = etag.removeprefix("W/")
+    return any(t.strip().removeprefix("W/") == want for t in header.split(","))
+
+def fresh(request, t: Tag) -> bool:
+    if t.etag is None:
+        return False
+    inm = request.headers.get("if-none-match")
+    if inm is not None:
+        return _matches(inm, t.etag)
+    ims = request.headers.get("if-modified-since")
+    if ims:
+        try:
+            return t.last_modified <= parsedate_to_datetime(ims)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def _headers(t: Tag):
+    return {"ETag": t.etag, "Last-Modified": formatdate(t.last_modified.timestamp(), usegmt=True),
+            "Cache-Control": CACHE_CONTROL}
+
+def not_modified(t: Tag, view: str):
+    cache_total.inc(view=view, outcome="304")
+    return Response(status_code=304, headers=_headers(t))
+
+def tagged(resp, t: Tag, view: str):
+    cache_total.inc(view=view, outcome="200")
+    if t.etag is not None:
+        resp.headers.update(_headers(t))
+    return resp
+
+class Fragments:
+    def __init__(self, maxsize: int = FRAGMENTS_MAX):
+        self.maxsize = maxsize
+        self._d = OrderedDict()  # name -> (key, html)
+        self._lock = threading.Lock()
+
+    def get(self, name, key, view: str):
+        if key is None:
+            return None
+        with self._lock:
+            hit = self._d.get(name)
+            if hit and hit[0] == key:
+                self._d.move_to_end(name)
+                cache_total.inc(view=view, outcome="fragment_hit")
+                return hit[1]
+        cache_total.inc(view=view, outcome="fragment_miss")
+        return None
+
+    def put(self, name, key, html: str):
+        if key is None:
+            return html
+        with self._lock:
+            self._d[name] = (key, html)
+            self._d.move_to_end(name)
+            while len(self._d) > self.maxsize:
+                self._d.popitem(last=False)
+        return html
+
+    def clear(self):
+        with self._lock:
+            self._d.clear()
+
+fragments = Fragments()
+
+class CompressMiddleware:
+    # Starlette's GZipMiddleware, applied only to COMPRESSIBLE content types.
+    def __init__(self, app, minimum_size: int = GZIP_MIN_BYTES, compresslevel: int = GZIP_LEVEL):
+        self.app = app
+        self.minimum_size, self.compresslevel = minimum_size, compresslevel
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or "gzip" not in Headers(scope=scope).get("accept-encoding", ""):
+            return await self.app(scope, receive, send)
+        gz = GZipResponder(self.app, self.minimum_size, compresslevel=self.compresslevel)
+        gz.send = send
+        target = send
+
+        async def pick(msg):
+            nonlocal target
+            if msg["type"] == "http.response.start":
+                ct = Headers(raw=msg["headers"]).get("content-type", "")
+                target = gz.send_with_gzip if ct.startswith(COMPRESSIBLE) else send
+            await target(msg)
+
+        await self.app(scope, receive, pick)
@@ -0,0 +1,67 @@
+from sqlalchemy import text
+from datetime import datetime, timedelta
+import json
+
+# -----------------------------------------------------------------------------
+# Idempotency keys
+#
+# Mobile clients send an Idempotency-Key header and retry freely. store() runs
+# inside the action's own transaction, so a key exists only if the action
+# committed; lookup() then replays the original response. A key belongs to the
+# action that stored it: presenting it for another action raises KeyReused
+# rather than replaying an unrelated response.
+# -----------------------------------------------------------------------------
+HEADER = "idempotency-key"
+KEEP_DAYS = 7
+MAX_KEY_LEN = 128
+
+def key_from(request):
+    k = (request.headers.get(HEADER) or "").strip()
+    return k[:MAX_KEY_LEN] or None
+
+class KeyReused(Exception):
+    def __init__(self, action: str):
+        super().__init__(action)
+        self.action = action
+
+def lookup(d, user_id: int, key: str, action: str):
+    if not key:
+        return None
+    row = d.execute(
+        text("SELECT action, response FROM idempotency_keys WHERE user_id=:u AND key=:k"),
+        {"u": user_id, "k": key},
+    ).fetchone()
+    if row is None:
+        return None
+    if row.action != action:
+        raise KeyReused(row.action)
+    return json.loads(row.response)
+
+def lookup_many(d, user_id: int, keys):
+    # {key: (action, response)} for the keys that have one (offline sync replays).
+    keys = [k for k in keys if k]
+    if not keys:
+        return {}
+    names = ",".join(f":k{i}" for i in range(len(keys)))
+    rows = d.execute(
+        text(f"SELECT key, action, response FROM idempotency_keys WHERE user_id=:u AND key IN ({names})"),
+        {"u": user_id, **{f"k{i}": k for i, k in enumerate(keys)}},
+    ).fetchall()
+    return {r.key: (r.action, json.loads(r.response)) for r in rows}
+
+def store(d, user_id: int, key: str, action: str, response: dict):
+    if not key:
+        return
+    d.execute(
+        text("INSERT OR IGNORE INTO idempotency_keys (user_id,key,action,response,created_at) "
+             "VALUES (:u,:k,:a,:r,:t)"),
+        {"u": user_id, "k": key, "a": action, "r": json.dumps(response), "t": datetime.utcnow()},
+    )
+
+def prune(d, days: int = KEEP_DAYS):
+    n = d.execute(
+        text("DELETE FROM idempotency_keys WHERE created_at < :t"),
+        {"t": datetime.utcnow() - timedelta(days=days)},
+    ).rowcount
+    d.commit()
+    return n
@@ -0,0 +1,96 @@
+from sqlalchemy import text
+import hashlib, os
+
+from .db import SessionLocal
+from . import storage
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow missing: originals are served as-is
+    Image = None
+
+# -----------------------------------------------------------------------------
+# Background image pipeline
+#
+# After a photo is stored, an images.derive job is queued (see tasks.py). It
+# writes a small thumbnail and a recompressed display copy, then records their
+# paths next to the original. Derived files are named by the source
+# content hash, so they never change and can be cached forever.
+# -----------------------------------------------------------------------------
+THUMB_DIR = "uploads/thumbs"
+DISPLAY_DIR = "uploads/display"
+THUMB_SIZE = (160, 160)
+THUMB_QUALITY = 70
+DISPLAY_MAX = 1280
+DISPLAY_QUALITY = 75
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp")
+
+def enabled() -> bool:
+    return Image is not None
+
+def _sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(256 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def make_derivatives(src: str, sha: str = None):
+    # Returns (thumb_path, display_path); both are paths under uploads/.
+    parsed = storage.parse(src)  # stored blobs are named by their hash
+    sha = sha or (parsed[0] if parsed else _sha256(src))
+    thumb = f"{THUMB_DIR}/{sha[:2]}/{sha[:32]}.jpg"
+    display = f"{DISPLAY_DIR}/{sha[:2]}/{sha[:32]}.jpg"
+    if os.path.exists(thumb) and os.path.exists(display):
+        return thumb, display
+    with storage.open_blob(src) as f, Image.open(f) as im:
+        im = ImageOps.exif_transpose(im).convert("RGB")
+        for path, size, quality in ((display, (DISPLAY_MAX, DISPLAY_MAX), DISPLAY_QUALITY),
+                                    (thumb, THUMB_SIZE, THUMB_QUALITY)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            out = im.copy()
+            out.thumbnail(size)
+            tmp = path + ".tmp"
+            out.save(tmp, "JPEG", quality=quality, optimize=True, progressive=True)
+            os.replace(tmp, path)
+    return thumb, display
+
+def _record(job, thumb, display):
+    d = SessionLocal()
+    try:
+        if job["kind"] == "attendance":
+            side = "cin" if job["side"] == "in" else "cout"
+            # Only if the row still points at the photo we processed.
+            d.execute(
+                text(f"UPDATE attendance SET {side}_thumb=:t, {side}_display=:p "
+                     f"WHERE user_id=:u AND date=:dt AND {side}_photo=:src"),
+                {"t": thumb, "p": display, "u": job["user_id"], "dt": job["date"], "src": job["src"]},
+            )
+        else:
+            d.execute(
+                text("UPDATE recce SET thumb=:t, display=:p WHERE id=:id AND filename=:src"),
+                {"t": thumb, "p": display, "id": job["recce_id"], "src": job["src"]},
+            )
+        d.commit()
+    finally:
+        d.close()
+
+def process(job):
+    thumb, display = make_derivatives(job["src"], job.get("sha"))
+    _record(job, thumb, display)
+
+def wanted(src: str) -> bool:
+    return enabled() and src.lower().endswith(IMAGE_EXTS)
+
+def pending_jobs(d):
+    # Every stored photo that has no derived copies yet (for backfills).
+    for r in d.execute(text(
+        "SELECT user_id, date, cin_photo, cout_photo, cin_thumb, cout_thumb FROM attendance "
+        "WHERE (cin_photo IS NOT NULL AND cin_thumb IS NULL) OR (cout_photo IS NOT NULL AND cout_thumb IS NULL)"
+    )).fetchall():
+        if r.cin_photo and not r.cin_thumb:
+            yield {"kind": "attendance", "side": "in", "user_id": r.user_id, "date": r.date, "src": r.cin_photo}
+        if r.cout_photo and not r.cout_thumb:
+            yield {"kind": "attendance", "side": "out", "user_id": r.user_id, "date": r.date, "src": r.cout_photo}
+    for r in d.execute(text("SELECT id, filename FROM recce WHERE filename IS NOT NULL AND thumb IS NULL")).fetchall():
+        yield {"kind": "recce", "recce_id": r.id, "src": r.filename}
@@ -0,0 +1,293 @@
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+from datetime import datetime, timedelta
+import asyncio, json, logging, os, random, uuid
+
+from .db import AsyncSessionLocal, writer
+from . import metrics
+
+log = logging.getLogger("vapp.jobs")
+
+# -----------------------------------------------------------------------------
+# Durable background jobs
+#
+# Side effects that don't have to happen before the response (points, monthly
+# rollups, image derivatives, webhooks) are written to the `jobs` table in the
+# same transaction as the row that caused them, so they are never lost and
+# never run for a write that rolled back. enqueue() only buffers on the
+# session; the buffer is written with one INSERT just before commit and the
+# workers are woken once it has committed. Worker tasks started in the app
+# lifespan claim due jobs in batches under a lease, run them and delete them.
+#
+# A job enqueued with a `key` is dropped if one with that key is already
+# queued (periodic jobs). The key is released when the job is claimed, so a
+# running job can queue its own follow-up.
+#
+# DB handlers run on the worker's session in the same transaction as the
+# delete of their job rows, so a job's writes land exactly once. A batch runs
+# in one go; if any handler fails it is re-run with a savepoint per job so
+# only the failing ones are retried.
+#
+# Blocking handlers (files, HTTP) run in a thread and must be idempotent.
+# Their own workers claim them one at a time under BLOCKING_LEASE, so a slow
+# one neither holds up points and rollups nor outlives the lease of a batch.
+#
+# A failure is retried with exponential backoff and jitter; after MAX_ATTEMPTS
+# the job is kept as 'dead' with its last error. A worker that dies mid-batch
+# leaves its jobs to be reclaimed once the lease runs out.
+# -----------------------------------------------------------------------------
+WORKERS = int(os.getenv("JOB_WORKERS", "2"))  # 0: only `manage run-jobs` processes the queue
+BATCH = int(os.getenv("JOB_BATCH", "50"))
+POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "2"))
+BLOCKING_WORKERS = int(os.getenv("JOB_BLOCKING_WORKERS", "1"))
+LEASE = timedelta(seconds=int(os.getenv("JOB_LEASE_SECONDS", "300")))
+BLOCKING_LEASE = timedelta(seconds=int(os.getenv("JOB_BLOCKING_LEASE_SECONDS", "3600")))
+MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "8"))
+BACKOFF_BASE = 2.0  # seconds; doubles per attempt
+BACKOFF_MAX = 3600.0
+ERROR_MAX = 2000
+
+jobs_total = metrics.Counter("vapp_jobs_total", "Background jobs by kind and outcome (done, retry, dead).")
+metrics.REGISTRY.append(jobs_total)
+
+# kind -> (fn, blocking). DB handlers are fn(d, payload); blocking ones fn(payload).
+HANDLERS = {}
+
+def handler(kind: str, blocking: bool = False):
+    def deco(fn):
+        HANDLERS[kind] = (fn, blocking)
+        return fn
+    return deco
+
+_PENDING = "vapp_jobs"
+_WAKE = "vapp_jobs_wake"
+
+def enqueue(d, kind: str, payload: dict = None, delay: float = 0, key: str = None):
+    # Joins the caller's transaction; nothing runs until it commits.
+    now = datetime.utcnow()
+    d.info.setdefault(_PENDING, []).append(
+        {"k": kind, "p": json.dumps(payload or {}, default=str), "r": now + timedelta(seconds=delay), "t": now,
+         "u": key})
+
+@event.listens_for(Session, "before_commit")
+def _write_pending(session):
+    rows = session.info.pop(_PENDING, None)
+    if rows:
+        session.execute(text("INSERT INTO jobs (kind, payload, state, attempts, run_at, created_at, dedupe_key) "
+                             "VALUES (:k, :p, 'queued', 0, :r, :t, :u) ON CONFLICT(dedupe_key) DO NOTHING"), rows)
+        session.info[_WAKE] = True
+
+@event.listens_for(Session, "after_commit")
+def _wake_workers(session):
+    if session.info.pop(_WAKE, None):
+        wake()
+
+@event.listens_for(Session, "after_rollback")
+def _drop_pending(session):
+    session.info.pop(_PENDING, None)
+    session.info.pop(_WAKE, None)
+
+def backoff(attempts: int) -> float:
+    return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+
+# -----------------------------------------------------------------------------
+# Claiming and finishing (sync, run via d.run_sync)
+# -----------------------------------------------------------------------------
+def claim(d, lease: str, limit: int = BATCH, blocking: bool = False):
+    # Claims due DB jobs, or with blocking=True the blocking ones. Kinds
+    # without a handler go with the DB jobs and are marked dead there.
+    now = datetime.utcnow()
+    kinds = {f"k{n}": k for n, k in enumerate(k for k, h in HANDLERS.items() if h[1])}
+    if blocking and not kinds:
+        return []
+    only = f"AND kind {'IN' if blocking else 'NOT IN'} ({', '.join(':' + k for k in kinds)}) " if kinds else ""
+    return d.execute(
+        text("UPDATE jobs SET state='running', lease=:l, locked_until=:lu, attempts=attempts+1, dedupe_key=NULL "
+             "WHERE id IN (SELECT id FROM jobs WHERE ((state='queued' AND run_at <= :now) "
+             f"OR (state='running' AND locked_until < :now)) {only}ORDER BY run_at, id LIMIT :n) "
+             "RETURNING id, kind, payload, attempts"),
+        {"l": lease, "lu": now + (BLOCKING_LEASE if blocking else LEASE), "now": now, "n": limit, **kinds},
+    ).fetchall()
+
+class _LeaseLost(Exception):
+    pass
+
+def _done(d, done, lease: str):
+    # Raises _LeaseLost if any of them has been reclaimed by another worker.
+    if not done:
+        return
+    ids = {f"i{n}": job.id for n, job in enumerate(done)}
+    n = d.execute(text(f"DELETE FROM jobs WHERE lease=:l AND id IN ({', '.join(':' + k for k in ids)})"),
+                  {"l": lease, **ids}).rowcount
+    if n != len(done):
+        raise _LeaseLost()
+    for job in done:
+        jobs_total.inc(kind=job.kind, outcome="done")
+
+def _failed(d, job, lease: str, err: str):
+    dead = job.attempts >= MAX_ATTEMPTS or job.kind not in HANDLERS
+    d.execute(
+        text("UPDATE jobs SET state=:s, run_at=:r, last_error=:e, lease=NULL, locked_until=NULL "
+             "WHERE id=:id AND lease=:l"),
+        {"s": "dead" if dead else "queued", "r": datetime.utcnow() + timedelta(seconds=backoff(job.attempts)),
+         "e": err[:ERROR_MAX], "id": job.id, "l": lease},
+    )
+    jobs_total.inc(kind=job.kind, outcome="dead" if dead else "retry")
+    (log.error if dead else log.warning)("job %s %s failed (attempt %d): %s", job.id, job.kind, job.attempts, err)
+
+def finish(d, batch, lease: str, outcomes: dict):
+    # outcomes: job id -> error string, or None for blocking jobs that ran fine.
+    # DB jobs (not in outcomes) are run here.
+    failed = [job for job in batch if outcomes.get(job.id) is not None]
+    try:
+        for job in batch:
+            if job.id not in outcomes:
+                HANDLERS[job.kind][0](d, json.loads(job.payload))
+        _done(d, [job for job in batch if job.id in outcomes and outcomes[job.id] is None]
+              + [job for job in batch if job.id not in outcomes], lease)
+    except _LeaseLost:
+        # Reclaimed by someone else after our lease ran out: undo everything;
+        # whoever holds the jobs now runs them.
+        d.rollback()
+        return
+    except Exception:
+        d.rollback()
+        return _finish_each(d, batch, lease, outcomes)
+    for job in failed:
+        _failed(d, job, lease, outcomes[job.id])
+    d.commit()
+
+def _finish_each(d, batch, lease: str, outcomes: dict):
+    # Slow path after a failure: one savepoint per job.
+    for job in batch:
+        err = outcomes.get(job.id)
+        if job.id not in outcomes:
+            try:
+                with d.begin_nested():
+                    HANDLERS[job.kind][0](d, json.loads(job.payload))
+                    _done(d, [job], lease)
+                continue
+            except _LeaseLost:
+                continue
+            except Exception as e:
+                err = f"{type(e).__name__}: {e}"
+        if err is None:
+            try:
+                with d.begin_nested():
+                    _done(d, [job], lease)
+            except _LeaseLost:
+                pass
+        else:
+            _failed(d, job, lease, err)
+    d.commit()
+
+# -----------------------------------------------------------------------------
+# Workers
+# -----------------------------------------------------------------------------
+_loop = None
+_event = None
+_tasks = []
+_stopping = False
+
+def wake():
+    if _loop is not None and not _loop.is_closed():
+        _loop.call_soon_threadsafe(_event.set)
+
+async def run_once(limit: int = BATCH, blocking: bool = False) -> int:
+    # Claims and runs one batch of DB jobs, or one blocking job; returns how
+    # many jobs it picked up.
+    lease = uuid.uuid4().hex
+    async with AsyncSessionLocal() as d:
+        async with writer():
+            batch = await d.run_sync(claim, lease, 1 if blocking else limit, blocking)
+            await d.commit()
+        if not batch:
+            return 0
+        outcomes = {}
+        for job in batch:
+            h = HANDLERS.get(job.kind)
+            if h is None:
+                outcomes[job.id] = f"no handler for {job.kind!r}"
+            elif h[1]:
+                try:
+                    await asyncio.to_thread(h[0], json.loads(job.payload))
+                    outcomes[job.id] = None
+                except Exception as e:
+                    outcomes[job.id] = f"{type(e).__name__}: {e}"
+        async with writer():
+            await d.run_sync(finish, batch, lease, outcomes)
+    return len(batch)
+
+def busy(d) -> int:
+    now = datetime.utcnow()
+    return d.execute(text("SELECT COUNT(*) FROM jobs WHERE (state='queued' AND run_at <= :now) "
+                          "OR (state='running' AND locked_until >= :now)"), {"now": now}).scalar()
+
+async def drain(limit: int = BATCH) -> int:
+    # Runs due jobs until none are left or in flight elsewhere (tests,
+    # benchmarks, `manage run-jobs`).
+    total = 0
+    while True:
+        n = await run_once(limit) + await run_once(blocking=True)
+        total += n
+        if n:
+            continue
+        async with AsyncSessionLocal() as d:
+            if not await d.run_sync(busy):
+                return total
+        await asyncio.sleep(0.05)
+
+async def _work(name: str, blocking: bool = False):
+    while not _stopping:
+        try:
+            if await run_once(blocking=blocking):
+                continue
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("job worker %s", name)
+        _event.clear()
+        try:
+            await asyncio.wait_for(_event.wait(), POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+def start(workers: int = None, blocking_workers: int = None):
+    # No workers at all (JOB_WORKERS=0) leaves the whole queue to `manage run-jobs`.
+    global _loop, _event, _stopping
+    _loop, _event, _stopping = asyncio.get_running_loop(), asyncio.Event(), False
+    workers = WORKERS if workers is None else workers
+    if blocking_workers is None:
+        blocking_workers = BLOCKING_WORKERS if workers else 0
+    for n in range(workers):
+        _tasks.append(asyncio.create_task(_work(str(n)), name=f"vapp-jobs-{n}"))
+    for n in range(blocking_workers):
+        _tasks.append(asyncio.create_task(_work(f"b{n}", blocking=True), name=f"vapp-jobs-b{n}"))
+
+async def stop(timeout: float = 10):
+    global _loop, _stopping
+    _stopping = True
+    if _event is not None:
+        _event.set()
+    if _tasks:
+        _, pending = await asyncio.wait(_tasks, timeout=timeout)
+        for t in pending:
+            t.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    _tasks.clear()
+    _loop = None
+
+# -----------------------------------------------------------------------------
+# Maintenance
+# -----------------------------------------------------------------------------
+def stats(d):
+    return {r.state: r.n for r in d.execute(text("SELECT state, COUNT(*) AS n FROM jobs GROUP BY state"))}
+
+def pending(d, kind: str) -> int:
+    return d.execute(text("SELECT COUNT(*) FROM jobs WHERE kind=:k AND state != 'dead'"), {"k": kind}).scalar()
+
+def retry_dead(d):
+    n = d.execute(text("UPDATE jobs SET state='queued', attempts=0, run_at=:t WHERE state='dead'"),
+                  {"t": datetime.utcnow()}).rowcount
+    d.commit()
+    return n
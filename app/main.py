@@ -1,132 +1,142 @@
-from fastapi import FastAPI, Request, Form, UploadFile, File, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, Request, Form, UploadFile, File, HTTPException, Query, Depends
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse, PlainTextResponse, JSONResponse
 from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy import select, text
-from datetime import datetime, date, time
-from jose import jwt, JWTError
-import os, shutil, csv, io
+from markupsafe import Markup
+from contextlib import asynccontextmanager
+from datetime import datetime, date, time, timedelta, timezone
+import os, csv, io, json, zlib
 
-from .db import Base, engine, SessionLocal
-from . import models
-from .security import hash_pw, verify_pw, make_token, SECRET, ALGO
+from .db import engine, async_engine, AsyncSessionLocal, SessionLocal, get_db, writer, warm_pool
+from . import models, migrations, points, rollups, uploads, auth, idempotency, metrics, history, resumable, search
+from . import payroll, geofence, jobs, tasks, versions, httpcache, storage, security
+from .auth import optional_user, require_user, require_admin
+from .security import hash_pw_async, verify_pw_async, make_token, throttle, client_ip, HashBusy
 
 # -----------------------------------------------------------------------------
 # Setup
 # -----------------------------------------------------------------------------
 os.makedirs("uploads", exist_ok=True)
-Base.metadata.create_all(bind=engine)
+migrations.run(engine)
+_d = SessionLocal()
+try:
+    points.ensure_balances(_d)
+    rollups.ensure_rollups(_d)
+    tasks.ensure_compaction(_d)
+    tasks.ensure_storage_maintenance(_d)
+    tasks.ensure_upload_pruning(_d)
+finally:
+    _d.close()
 
-app = FastAPI(title="V-app (Voiceworx)")
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
-templates = Jinja2Templates(directory="app/templates")
+@asynccontextmanager
+async def lifespan(app):
+    await warm_pool()
+    security.start_pool()
+    jobs.start()
+    yield
+    await jobs.stop()
+    security.stop_pool()
+    await async_engine.dispose()
 
-# -----------------------------------------------------------------------------
-# Helpers
-# -----------------------------------------------------------------------------
-def get_db():
-    d = SessionLocal()
-    try:
-        yield d
-    finally:
-        d.close()
-
-def current_user(request: Request, d):
-    token = request.cookies.get("t")
-    if not token:
-        return None
-    try:
-        email = jwt.decode(token, SECRET, algorithms=[ALGO]).get("sub")
-    except JWTError:
-        return None
-    if not email:
-        return None
-    return d.execute(select(models.User).where(models.User.email == email)).scalar_one_or_none()
+app = FastAPI(title="V-app (Voiceworx)", lifespan=lifespan)
+app.router.route_class = uploads.UploadRoute  # stages upload parts while parsing
+app.add_middleware(uploads.UploadLimitMiddleware)
+app.add_middleware(httpcache.CompressMiddleware)
+metrics.install(app, engine, async_engine)
+app.mount("/uploads", uploads.UploadFiles(directory="uploads"), name="uploads")
+templates = Jinja2Templates(directory=os.path.join(os.path.dirname(__file__), "templates"))
 
-def require_user(request: Request):
-    d = SessionLocal()
-    try:
-        u = current_user(request, d)
-        if not u:
-            raise HTTPException(status_code=302, headers={"Location": "/auth/login"})
-        return u
-    finally:
-        d.close()
+# Handlers are coroutines on an AsyncSession. Sync helpers that share a
+# transaction (points, rollups, idempotency, the _record_* writes) run through
+# d.run_sync() on the same connection rather than in the threadpool.
 
 # -----------------------------------------------------------------------------
 # Routes: Home / Auth
 # -----------------------------------------------------------------------------
 @app.get("/", response_class=HTMLResponse)
-def home(request: Request):
+async def home(request: Request):
     return templates.TemplateResponse("home.html", {"request": request})
 
 @app.get("/auth/register", response_class=HTMLResponse)
-def reg_form(request: Request):
+async def reg_form(request: Request):
     return templates.TemplateResponse("register.html", {"request": request})
 
+def _busy(retry_after: int = 5, detail: str = "Server busy, try again shortly"):
+    return HTTPException(status_code=429, detail=detail, headers={"Retry-After": str(retry_after)})
+
+@app.exception_handler(idempotency.KeyReused)
+async def _key_reused(request: Request, e: idempotency.KeyReused):
+    return JSONResponse({"detail": f"Idempotency-Key was already used for a {e.action}"}, status_code=422)
+
+async def _user_by_email(d, email: str):
+    return (await d.execute(select(models.User).where(models.User.email == email))).scalar_one_or_none()
+
+async def _add_user(d, name: str, email: str, hashed: str):
+    async with writer():
+        d.add(models.User(name=name, email=email, hashed_password=hashed))
+        await d.commit()
+
 @app.post("/auth/register")
-def reg(name: str = Form(...), email: str = Form(...), password: str = Form(...)):
-    d = SessionLocal()
+async def reg(name: str = Form(...), email: str = Form(...), password: str = Form(...), d=Depends(get_db)):
+    if await _user_by_email(d, email):
+        return RedirectResponse("/auth/login?e=exists", status_code=302)
+    await d.close()  # not held across the hash
     try:
-        existing = d.execute(select(models.User).where(models.User.email == email)).scalar_one_or_none()
-        if existing:
-            return RedirectResponse("/auth/login?e=exists", status_code=302)
-        u = models.User(name=name, email=email, hashed_password=hash_pw(password))
-        d.add(u)
-        d.commit()
-        return RedirectResponse("/auth/login?ok=1", status_code=302)
-    finally:
-        d.close()
+        hashed = await hash_pw_async(password)
+    except HashBusy:
+        raise _busy()
+    await _add_user(d, name, email, hashed)
+    return RedirectResponse("/auth/login?ok=1", status_code=302)
 
 @app.get("/auth/login", response_class=HTMLResponse)
-def login_form(request: Request):
+async def login_form(request: Request):
     return templates.TemplateResponse("login.html", {"request": request})
 
 @app.post("/auth/login")
-def login(email: str = Form(...), password: str = Form(...)):
-    d = SessionLocal()
+async def login(request: Request, email: str = Form(...), password: str = Form(...), d=Depends(get_db)):
+    keys = {"acct": email.strip().lower(), "ip": client_ip(request)}
+    wait = throttle.retry_after(**keys)
+    if wait:
+        raise _busy(wait, "Too many failed login attempts, try again later")
+    u = await _user_by_email(d, email)
+    await d.close()  # not held across the hash; u stays loaded, detached
     try:
-        u = d.execute(select(models.User).where(models.User.email == email)).scalar_one_or_none()
-        if not u or not verify_pw(password, u.hashed_password):
-            return RedirectResponse("/auth/login?e=1", status_code=302)
-        resp = RedirectResponse("/dashboard", status_code=302)
-        resp.set_cookie("t", make_token(u.email), httponly=True, samesite="lax")
-        return resp
-    finally:
-        d.close()
+        ok = bool(u) and await verify_pw_async(password, u.hashed_password)
+    except HashBusy:
+        raise _busy()
+    if not ok:
+        throttle.fail(**keys)
+        return RedirectResponse("/auth/login?e=1", status_code=302)
+    throttle.reset(acct=keys["acct"])
+    resp = RedirectResponse("/dashboard", status_code=302)
+    resp.set_cookie("t", make_token(u.email), httponly=True, samesite="lax")
+    return resp
 
 # -----------------------------------------------------------------------------
 # Dashboard
 # -----------------------------------------------------------------------------
 @app.get("/dashboard", response_class=HTMLResponse)
-def dash(request: Request):
-    d = SessionLocal()
-    try:
-        u = current_user(request, d)
-        if not u:
-            return RedirectResponse("/auth/login", status_code=302)
-        pts = d.execute(text("SELECT COALESCE(SUM(pts),0) FROM points WHERE user_id=:u"), {"u": u.id}).scalar()
-        return templates.TemplateResponse("dashboard.html", {"request": request, "user": u, "points": int(pts or 0)})
-    finally:
-        d.close()
+async def dash(request: Request, u=Depends(optional_user), d=Depends(get_db)):
+    if not u:
+        return RedirectResponse("/auth/login", status_code=302)
+    pts = await d.run_sync(points.balance, u.id)
+    return templates.TemplateResponse("dashboard.html", {"request": request, "user": u, "points": pts})
+
+POINTS_HISTORY_MAX = 120
+
+@app.get("/api/points")
+async def api_points(months: int = 12, u=Depends(require_user), d=Depends(get_db)):
+    # Balance plus per-month, per-category totals (snapshots + live ledger).
+    total = await d.run_sync(points.balance, u.id)
+    rows = await d.run_sync(points.history, u.id, min(max(months, 1), POINTS_HISTORY_MAX))
+    return {"ok": True, "total": total, "months": rows}
 
 # -----------------------------------------------------------------------------
 # Attendance
 # -----------------------------------------------------------------------------
 LATE_AFTER = time(10, 31)
 
-def _month_late_and_paycut(d, user_id: int):
-    late_count = d.execute(
-        text(
-            "SELECT COUNT(*) FROM attendance "
-            "WHERE user_id=:u AND status='LATE' "
-            "AND strftime('%Y-%m', date)=strftime('%Y-%m','now')"
-        ),
-        {"u": user_id},
-    ).scalar()
-    late_count = int(late_count or 0)
-    return late_count, late_count // 4
-
 def _serialize_row(row):
     if not row:
         return None
@@ -137,6 +147,8 @@ def _serialize_row(row):
         "check_out_ts": str(m.get("cout_ts")) if m.get("cout_ts") else None,
         "check_in_photo": f"/{m.get('cin_photo')}" if m.get("cin_photo") else None,
         "check_out_photo": f"/{m.get('cout_photo')}" if m.get("cout_photo") else None,
+        "check_in_thumb": f"/{m.get('cin_thumb')}" if m.get("cin_thumb") else None,
+        "check_out_thumb": f"/{m.get('cout_thumb')}" if m.get("cout_thumb") else None,
         "status": m.get("status"),
         "cin_remark": m.get("cin_remark"),
         "cout_remark": m.get("cout_remark"),
@@ -153,339 +165,908 @@ def _serialize_row(row):
     return r
 
 @app.get("/attendance", response_class=HTMLResponse)
-def attendance_page(request: Request):
-    u = require_user(request)
+async def attendance_page(request: Request, u=Depends(require_user)):
     return templates.TemplateResponse("attendance.html", {"request": request, "user": u})
 
+def _midnight(day: date):
+    return datetime.combine(day, time()).astimezone(timezone.utc)
+
 @app.get("/attendance/today")
-def attendance_today(request: Request):
-    u = require_user(request)
-    d = SessionLocal()
-    try:
-        rec = d.execute(text("SELECT * FROM attendance WHERE user_id=:u AND date=:dt"),
-                        {"u": u.id, "dt": date.today()}).fetchone()
-        record = _serialize_row(rec)
-        late_count, paycut = _month_late_and_paycut(d, u.id)
-        points_total = d.execute(text("SELECT COALESCE(SUM(pts),0) FROM points WHERE user_id=:u"),
-                                 {"u": u.id}).scalar()
-        return {
-            "ok": True,
-            "record": record,
-            "late_count": late_count,
-            "paycut_days": paycut,
-            "points_total": float(points_total or 0),
-        }
-    finally:
-        d.close()
+async def attendance_today(request: Request, u=Depends(require_user), d=Depends(get_db)):
+    # Polled by the attendance page: 304 until the user's row, rollup or
+    # balance changes, or the day rolls over. Lates come from attendance and
+    # points include queued awards, like the check-in/check-out responses, so
+    # the page agrees with them before the queue has caught up.
+    today = date.today()
+    tag = await d.run_sync(httpcache.tag, [versions.user_scope(u.id)], u.id, today.isoformat(),
+                           since=_midnight(today))
+    if httpcache.fresh(request, tag):
+        return httpcache.not_modified(tag, "attendance_today")
+    rec = (await d.execute(text("SELECT * FROM attendance WHERE user_id=:u AND date=:dt"),
+                           {"u": u.id, "dt": today})).fetchone()
+    record = _serialize_row(rec)
+    late_count, paycut = await d.run_sync(rollups.month_lates, u.id, today)
+    points_total = await d.run_sync(tasks.balance_with_queued, u.id)
+    return httpcache.tagged(JSONResponse({
+        "ok": True,
+        "record": record,
+        "late_count": late_count,
+        "paycut_days": paycut,
+        "points_total": float(points_total or 0),
+    }), tag, "attendance_today")
 
-# SERVER-SIDE GUARDS to prevent double actions:
-def _has_checkin_today(d, user_id: int):
-    return bool(d.execute(text("SELECT 1 FROM attendance WHERE user_id=:u AND date=:dt AND cin_ts IS NOT NULL"),
-                          {"u": user_id, "dt": date.today()}).fetchone())
+def _wants_json(request: Request):
+    return "json" in (request.headers.get("accept") or "").lower()
 
-def _has_checkout_today(d, user_id: int):
-    return bool(d.execute(text("SELECT 1 FROM attendance WHERE user_id=:u AND date=:dt AND cout_ts IS NOT NULL"),
-                          {"u": user_id, "dt": date.today()}).fetchone())
+# Each action is one transaction. The guard lives in the write itself: the
+# upsert/update only matches when the row is in the expected state, and
+# RETURNING hands back what the response needs. A second request (double tap,
+# concurrent retry) simply matches nothing and cannot award points twice.
+# _apply_* do the writes without committing (offline sync batches several);
+# _record_* wrap them in a transaction of their own and file the upload with
+# storage.put() in it, so a refused action leaves no file behind.
+def _apply_checkin(d, user_id: int, fn: str, sha: str, lat, lng, remarks, now: datetime):
+    status = "LATE" if now.time() >= LATE_AFTER and now.weekday() <= 5 else "PRESENT"
+    site = geofence.classify(d, lat, lng)
+    sid, sdist, inside = geofence.columns(site)
+    row = d.execute(
+        text(
+            "INSERT INTO attendance (user_id,date,cin_ts,cin_lat,cin_lng,cin_photo,status,cin_remark,"
+            "cin_site_id,cin_site_dist,cin_inside) "
+            "VALUES (:u,:dt,:ts,:lat,:lng,:ph,:st,:r,:sid,:sd,:si) "
+            "ON CONFLICT(user_id,date) DO UPDATE SET cin_ts=excluded.cin_ts, cin_lat=excluded.cin_lat, "
+            "cin_lng=excluded.cin_lng, cin_photo=excluded.cin_photo, status=excluded.status, "
+            "cin_remark=excluded.cin_remark, cin_site_id=excluded.cin_site_id, "
+            "cin_site_dist=excluded.cin_site_dist, cin_inside=excluded.cin_inside "
+            "WHERE attendance.cin_ts IS NULL "
+            "RETURNING id"
+        ),
+        {"u": user_id, "dt": now.date(), "ts": now, "lat": lat, "lng": lng, "ph": fn, "st": status, "r": remarks,
+         "sid": sid, "sd": sdist, "si": inside},
+    ).fetchone()
+    if not row:
+        return None
+    # Points, the monthly rollup and image derivatives are queued in this
+    # transaction and applied by the job workers after the response.
+    pts = tasks.award_later(d, user_id, "ATTENDANCE", "Check-in", -5 if status == "LATE" else 10, now)
+    jobs.enqueue(d, "rollups.checkin", {"user_id": user_id, "day": now.date(), "status": status})
+    tasks.derive_later(d, kind="attendance", side="in", user_id=user_id, date=now.date(), src=fn, sha=sha)
+    tasks.notify(d, "checkin", user_id, date=now.date(), status=status, site=geofence.as_dict(site))
+    late_count, paycut = rollups.month_lates(d, user_id, now.date())
+    res = {
+        "ok": True,
+        "status": status,
+        "check_in_ts": now.isoformat(),
+        "photo_url": f"/{fn}",
+        "photo_sha256": sha,
+        "points_awarded": pts,
+        "late_count": late_count,
+        "paycut_days": paycut,
+        "site": geofence.as_dict(site),
+    }
+    return res
+
+def _record_checkin(d, user_id: int, staged, lat, lng, remarks, key: str = None):
+    fn = storage.put(d, staged)
+    res = _apply_checkin(d, user_id, fn, staged.sha256, lat, lng, remarks, datetime.now())
+    if not res:
+        d.rollback()
+        return None
+    idempotency.store(d, user_id, key, "checkin", res)
+    d.commit()
+    return res
 
 @app.post("/attendance/checkin")
-def checkin(
+async def checkin(
     request: Request,
     file: UploadFile = File(...),
     lat: float = Form(None),
     lng: float = Form(None),
-    remarks: str = Form(None)  # NEW
+    remarks: str = Form(None),  # NEW
+    u=Depends(require_user),
+    d=Depends(get_db),
 ):
-    u = require_user(request)
-    d = SessionLocal()
-    try:
+    key = idempotency.key_from(request)
+    res = await d.run_sync(idempotency.lookup, u.id, key, "checkin") if key else None
+    await d.close()  # no pooled connection held while the photo streams in
+    if not res:
+        staged = await uploads.save_upload(file, "attendance", uploads.PHOTO_MAX, uploads.PHOTO_TYPES, ".jpg")
+        try:
+            async with writer():
+                res = await d.run_sync(_record_checkin, u.id, staged, lat, lng, remarks, key)
+        finally:
+            storage.discard(staged)
+        if not res:
+            # Slow path only: replay a concurrent retry's result.
+            res = await d.run_sync(idempotency.lookup, u.id, key, "checkin")
+    if not res:
         # Guard: block second check-in
-        if _has_checkin_today(d, u.id):
-            if "json" in (request.headers.get("accept") or "").lower():
-                return {"ok": False, "error": "Already checked in today"}
-            return RedirectResponse("/attendance?already_in=1", status_code=302)
-    finally:
-        d.close()
-
-    os.makedirs("uploads/attendance", exist_ok=True)
-    fn = f"uploads/attendance/{u.id}_{date.today().isoformat()}_in.jpg"
-    with open(fn, "wb") as f:
-        shutil.copyfileobj(file.file, f)
-    now = datetime.now()
-    status = "LATE" if now.time() >= LATE_AFTER and now.weekday() <= 5 else "PRESENT"
+        if _wants_json(request):
+            return {"ok": False, "error": "Already checked in today"}
+        return RedirectResponse("/attendance?already_in=1", status_code=302)
 
-    d = SessionLocal()
-    try:
-        d.execute(
-            text(
-                "INSERT OR REPLACE INTO attendance (id,user_id,date,cin_ts,cin_lat,cin_lng,cin_photo,status,cin_remark) "
-                "VALUES ((SELECT id FROM attendance WHERE user_id=:u AND date=:dt),:u,:dt,:ts,:lat,:lng,:ph,:st,:r)"
-            ),
-            {"u": u.id, "dt": date.today(), "ts": now, "lat": lat, "lng": lng, "ph": fn, "st": status, "r": remarks},
-        )
-        pts = -5 if status == "LATE" else 10
-        d.execute(
-            text("INSERT INTO points (user_id,category,descr,pts,created_at) VALUES (:u,:c,:d,:p,:t)"),
-            {"u": u.id, "c": "ATTENDANCE", "d": "Check-in", "p": pts, "t": now},
-        )
-        d.commit()
-        late_count, paycut = _month_late_and_paycut(d, u.id)
-    finally:
-        d.close()
-
-    if "json" in (request.headers.get("accept") or "").lower():
-        return {
-            "ok": True,
-            "status": status,
-            "check_in_ts": now.isoformat(),
-            "photo_url": f"/{fn}",
-            "points_awarded": pts,
-            "late_count": late_count,
-            "paycut_days": paycut,
-        }
+    if _wants_json(request):
+        return res
     return RedirectResponse("/attendance?in=1", status_code=302)
 
+def _apply_checkout(d, user_id: int, fn: str, sha: str, lat, lng, remarks, now: datetime):
+    site = geofence.classify(d, lat, lng)
+    sid, sdist, inside = geofence.columns(site)
+    row = d.execute(
+        text(
+            "UPDATE attendance SET cout_ts=:ts, cout_lat=:lat, cout_lng=:lng, cout_photo=:ph, cout_remark=:r, "
+            "cout_site_id=:sid, cout_site_dist=:sd, cout_inside=:si "
+            "WHERE user_id=:u AND date=:dt AND cin_ts IS NOT NULL AND cout_ts IS NULL "
+            "RETURNING ROUND((julianday(cout_ts) - julianday(cin_ts)) * 24, 2) AS hrs"
+        ),
+        {"ts": now, "lat": lat, "lng": lng, "ph": fn, "r": remarks, "u": user_id, "dt": now.date(),
+         "sid": sid, "sd": sdist, "si": inside},
+    ).fetchone()
+    if not row:
+        return None
+    tasks.award_later(d, user_id, "ATTENDANCE", "Check-out", 10, now)
+    jobs.enqueue(d, "rollups.checkout", {"user_id": user_id, "day": now.date(), "hours": row.hrs})
+    tasks.derive_later(d, kind="attendance", side="out", user_id=user_id, date=now.date(), src=fn, sha=sha)
+    tasks.notify(d, "checkout", user_id, date=now.date(), hours=row.hrs, site=geofence.as_dict(site))
+    late_count, paycut = rollups.month_lates(d, user_id, now.date())
+    res = {
+        "ok": True,
+        "check_out_ts": now.isoformat(),
+        "photo_url": f"/{fn}",
+        "photo_sha256": sha,
+        "working_hours": row.hrs,
+        "points_awarded": 10,
+        "late_count": late_count,
+        "paycut_days": paycut,
+        "site": geofence.as_dict(site),
+    }
+    return res
+
+def _record_checkout(d, user_id: int, staged, lat, lng, remarks, key: str = None):
+    fn = storage.put(d, staged)
+    res = _apply_checkout(d, user_id, fn, staged.sha256, lat, lng, remarks, datetime.now())
+    if not res:
+        d.rollback()
+        return None
+    idempotency.store(d, user_id, key, "checkout", res)
+    d.commit()
+    return res
+
+def _checkout_rejected(d, user_id: int, key: str = None):
+    prev = idempotency.lookup(d, user_id, key, "checkout")
+    row = d.execute(text("SELECT cin_ts FROM attendance WHERE user_id=:u AND date=:dt"),
+                    {"u": user_id, "dt": date.today()}).fetchone()
+    if prev:
+        return prev, None
+    return None, "no_in" if not row or not row.cin_ts else "already_out"
+
 @app.post("/attendance/checkout")
-def checkout(
+async def checkout(
     request: Request,
     file: UploadFile = File(...),
     lat: float = Form(None),
     lng: float = Form(None),
-    remarks: str = Form(None)  # NEW
+    remarks: str = Form(None),  # NEW
+    u=Depends(require_user),
+    d=Depends(get_db),
 ):
-    u = require_user(request)
-    d = SessionLocal()
-    try:
-        # Guard: need check-in first; block second checkout
-        if not _has_checkin_today(d, u.id):
-            if "json" in (request.headers.get("accept") or "").lower():
-                return {"ok": False, "error": "No check-in found for today"}
-            return RedirectResponse("/attendance?no_in=1", status_code=302)
-        if _has_checkout_today(d, u.id):
-            if "json" in (request.headers.get("accept") or "").lower():
-                return {"ok": False, "error": "Already checked out today"}
-            return RedirectResponse("/attendance?already_out=1", status_code=302)
-    finally:
-        d.close()
+    key = idempotency.key_from(request)
+    res = await d.run_sync(idempotency.lookup, u.id, key, "checkout") if key else None
+    await d.close()  # no pooled connection held while the photo streams in
+    blocked = None
+    if not res:
+        staged = await uploads.save_upload(file, "attendance", uploads.PHOTO_MAX, uploads.PHOTO_TYPES, ".jpg")
+        try:
+            async with writer():
+                res = await d.run_sync(_record_checkout, u.id, staged, lat, lng, remarks, key)
+        finally:
+            storage.discard(staged)
+        if not res:
+            res, blocked = await d.run_sync(_checkout_rejected, u.id, key)
+    # Guard: need check-in first; block second checkout
+    if blocked == "no_in":
+        if _wants_json(request):
+            return {"ok": False, "error": "No check-in found for today"}
+        return RedirectResponse("/attendance?no_in=1", status_code=302)
+    if blocked == "already_out":
+        if _wants_json(request):
+            return {"ok": False, "error": "Already checked out today"}
+        return RedirectResponse("/attendance?already_out=1", status_code=302)
 
-    os.makedirs("uploads/attendance", exist_ok=True)
-    fn = f"uploads/attendance/{u.id}_{date.today().isoformat()}_out.jpg"
-    with open(fn, "wb") as f:
-        shutil.copyfileobj(file.file, f)
-    now = datetime.now()
+    if _wants_json(request):
+        return res
+    return RedirectResponse("/attendance?out=1", status_code=302)
 
-    d = SessionLocal()
+# -----------------------------------------------------------------------------
+# Attendance API (JSON): history over a date range, keyset-paginated
+# -----------------------------------------------------------------------------
+@app.get("/api/attendance")
+async def api_attendance(
+    frm: str = Query(None, alias="from"),
+    to: str = None,
+    user_id: int = None,
+    status: str = None,
+    late: bool = False,
+    fields: str = None,
+    limit: int = history.PAGE_DEFAULT,
+    cursor: str = None,
+    u=Depends(require_user),
+    d=Depends(get_db),
+):
+    # Staff see their own rows; admins see everyone's, or one user's via user_id.
+    if u.role != "admin":
+        if user_id and user_id != u.id:
+            raise HTTPException(status_code=403, detail="Admin only")
+        user_id = u.id
+    d2 = _parse_day(to, "to") if to else date.today()
+    d1 = _parse_day(frm, "from") if frm else d2.replace(day=1)
+    if d2 < d1:
+        raise HTTPException(status_code=400, detail="'to' is before 'from'")
+    statuses = [s.strip().upper() for s in (status or "").split(",") if s.strip()]
+    if late:
+        statuses = ["LATE"]
+    if any(s not in history.STATUSES for s in statuses):
+        raise HTTPException(status_code=400, detail=f"status must be one of {', '.join(history.STATUSES)}")
     try:
-        d.execute(
-            text(
-                "UPDATE attendance SET cout_ts=:ts, cout_lat=:lat, cout_lng=:lng, cout_photo=:ph, cout_remark=:r "
-                "WHERE user_id=:u AND date=:dt"
-            ),
-            {"ts": now, "lat": lat, "lng": lng, "ph": fn, "r": remarks, "u": u.id, "dt": date.today()},
-        )
-        d.execute(
-            text("INSERT INTO points (user_id,category,descr,pts,created_at) VALUES (:u,:c,:d,:p,:t)"),
-            {"u": u.id, "c": "ATTENDANCE", "d": "Check-out", "p": 10, "t": now},
-        )
-        rec = d.execute(
-            text("SELECT cin_ts, cout_ts FROM attendance WHERE user_id=:u AND date=:dt"),
-            {"u": u.id, "dt": date.today()},
-        ).fetchone()
-        hours = None
-        if rec and rec._mapping.get("cin_ts") and rec._mapping.get("cout_ts"):
-            t1 = rec._mapping["cin_ts"]; t2 = rec._mapping["cout_ts"]
-            hours = round((t2 - t1).total_seconds() / 3600, 2)
-        d.commit()
-        late_count, paycut = _month_late_and_paycut(d, u.id)
-    finally:
-        d.close()
-
-    if "json" in (request.headers.get("accept") or "").lower():
-        return {
-            "ok": True,
-            "check_out_ts": now.isoformat(),
-            "photo_url": f"/{fn}",
-            "working_hours": hours,
-            "points_awarded": 10,
-            "late_count": late_count,
-            "paycut_days": paycut,
-        }
-    return RedirectResponse("/attendance?out=1", status_code=302)
+        groups = history.parse_fields(fields)
+        after = history.decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    limit = min(max(limit, 1), history.PAGE_MAX)
+    rows, nxt = await d.run_sync(history.page, d1, d2, user_id, statuses, groups, after, limit)
+    return {"ok": True, "from": d1.isoformat(), "to": d2.isoformat(), "rows": rows, "next_cursor": nxt}
 
 # -----------------------------------------------------------------------------
 # Reports
 # -----------------------------------------------------------------------------
 @app.get("/reports", response_class=HTMLResponse)
-def reports_page(request: Request):
-    u = require_user(request)
-    d = SessionLocal()
-    try:
-        rows = d.execute(
-            text("SELECT report_date, summary FROM reports WHERE user_id=:u ORDER BY report_date DESC"),
-            {"u": u.id}
-        ).fetchall()
-        return templates.TemplateResponse("reports.html", {"request": request, "user": u, "rows": rows})
-    finally:
-        d.close()
+async def reports_page(request: Request, u=Depends(require_user), d=Depends(get_db)):
+    rows = (await d.execute(
+        text("SELECT report_date, summary FROM reports WHERE user_id=:u ORDER BY report_date DESC"),
+        {"u": u.id}
+    )).fetchall()
+    return templates.TemplateResponse("reports.html", {"request": request, "user": u, "rows": rows})
+
+def _apply_report(d, user_id: int, report_date: str, summary: str):
+    d.execute(
+        text("INSERT INTO reports (user_id, report_date, summary, created_at) VALUES (:u,:d,:s,:t)"),
+        {"u": user_id, "d": report_date, "s": summary, "t": datetime.utcnow()},
+    )
+    tasks.notify(d, "report", user_id, report_date=report_date)
+    return tasks.award_later(d, user_id, "REPORT", "Daily report", 10)
 
 @app.post("/reports/new")
-def report_new(request: Request, report_date: str = Form(...), summary: str = Form(...)):
-    u = require_user(request)
-    d = SessionLocal()
-    try:
-        d.execute(
-            text("INSERT INTO reports (user_id, report_date, summary, created_at) VALUES (:u,:d,:s,:t)"),
-            {"u": u.id, "d": report_date, "s": summary, "t": datetime.utcnow()},
-        )
-        d.execute(
-            text("INSERT INTO points (user_id,category,descr,pts,created_at) VALUES (:u,:c,:d,:p,:t)"),
-            {"u": u.id, "c": "REPORT", "d": "Daily report", "p": 10, "t": datetime.utcnow()},
-        )
-        d.commit()
-    finally:
-        d.close()
+async def report_new(report_date: str = Form(...), summary: str = Form(...),
+                     u=Depends(require_user), d=Depends(get_db)):
+    async with writer():
+        await d.run_sync(_apply_report, u.id, report_date, summary)
+        await d.commit()
     return RedirectResponse("/reports?ok=1", status_code=302)
 
 # -----------------------------------------------------------------------------
 # Recce
 # -----------------------------------------------------------------------------
 @app.get("/recce", response_class=HTMLResponse)
-def recce_page(request: Request):
-    u = require_user(request)
+async def recce_page(request: Request, u=Depends(require_user)):
     return templates.TemplateResponse("recce.html", {"request": request, "user": u})
 
+def _apply_recce(d, user_id: int, project, notes, fn: str, ts: datetime = None, lat=None, lng=None,
+                 sha: str = None, name: str = None):
+    ts = ts or datetime.utcnow()
+    sid, sdist, inside = geofence.columns(geofence.classify(d, lat, lng))
+    rid = d.execute(
+        text("INSERT INTO recce (user_id, uploaded_at, project, notes, filename, original_name, lat, lng, "
+             "site_id, site_dist, inside) VALUES (:u,:t,:p,:n,:f,:on,:lat,:lng,:sid,:sd,:si)"),
+        {"u": user_id, "t": ts, "p": project, "n": notes, "f": fn, "on": name and uploads.safe_name(name),
+         "lat": lat, "lng": lng, "sid": sid, "sd": sdist, "si": inside},
+    ).lastrowid
+    tasks.award_later(d, user_id, "RECCE", "Recce upload", 15)
+    tasks.derive_later(d, kind="recce", recce_id=rid, src=fn, sha=sha)
+    tasks.notify(d, "recce", user_id, recce_id=rid, project=project, site_id=sid, inside=inside)
+    return rid
+
+def _record_recce(d, user_id: int, project, notes, staged, lat=None, lng=None, name: str = None):
+    fn = storage.put(d, staged)
+    rid = _apply_recce(d, user_id, project, notes, fn, lat=lat, lng=lng, sha=staged.sha256, name=name)
+    d.commit()
+    return rid
+
 @app.post("/recce/upload")
-def recce_upload(request: Request, project: str = Form(None), notes: str = Form(None), file: UploadFile = File(...)):
-    u = require_user(request)
-    os.makedirs("uploads/recce", exist_ok=True)
-    fn = f"uploads/recce/{u.id}_{int(datetime.utcnow().timestamp())}_{file.filename}"
-    with open(fn, "wb") as f:
-        shutil.copyfileobj(file.file, f)
-    d = SessionLocal()
+async def recce_upload(project: str = Form(None), notes: str = Form(None), file: UploadFile = File(...),
+                       lat: float = Form(None), lng: float = Form(None),
+                       u=Depends(require_user), d=Depends(get_db)):
+    staged = await uploads.save_upload(file, "recce", uploads.RECCE_MAX, uploads.RECCE_TYPES)
     try:
-        d.execute(
-            text("INSERT INTO recce (user_id, uploaded_at, project, notes, filename) VALUES (:u,:t,:p,:n,:f)"),
-            {"u": u.id, "t": datetime.utcnow(), "p": project, "n": notes, "f": fn},
-        )
-        d.execute(
-            text("INSERT INTO points (user_id,category,descr,pts,created_at) VALUES (:u,:c,:d,:p,:t)"),
-            {"u": u.id, "c": "RECCE", "d": "Recce upload", "p": 15, "t": datetime.utcnow()},
-        )
-        d.commit()
+        async with writer():
+            await d.run_sync(_record_recce, u.id, project, notes, staged, lat, lng, file.filename)
     finally:
-        d.close()
+        storage.discard(staged)
     return RedirectResponse("/recce?ok=1", status_code=302)
 
 # -----------------------------------------------------------------------------
-# Admin: Leaderboard
+# Recce: resumable chunked uploads (see resumable.py)
 # -----------------------------------------------------------------------------
-@app.get("/admin", response_class=HTMLResponse)
-def admin(request: Request):
-    d = SessionLocal()
+def _upload_or_404(d, sid: str, user_id: int):
+    s = resumable.get(d, sid, user_id)
+    if not s:
+        raise HTTPException(status_code=404, detail="No such upload")
+    return s
+
+def _upload_status(s, have):
+    missing = sorted(set(range(resumable.chunk_count(s))) - set(have))
+    return {"ok": True, "upload_id": s.id, "size": s.size, "chunk_size": s.chunk_size,
+            "chunks": resumable.chunk_count(s), "received": have, "missing": missing,
+            "recce_id": s.recce_id}
+
+@app.post("/api/uploads")
+async def upload_create(
+    filename: str = Form(...),
+    size: int = Form(...),
+    content_type: str = Form(...),
+    chunk_size: int = Form(resumable.CHUNK_DEFAULT),
+    sha256: str = Form(None),
+    project: str = Form(None),
+    notes: str = Form(None),
+    lat: float = Form(None),
+    lng: float = Form(None),
+    u=Depends(require_user),
+    d=Depends(get_db),
+):
+    if not any(content_type.lower().startswith(t) for t in uploads.RECCE_TYPES):
+        raise HTTPException(status_code=415, detail=f"Unsupported file type: {content_type}")
+    if not 0 < size <= uploads.RECCE_MAX:
+        raise HTTPException(status_code=413, detail=f"Upload too large (max {uploads.RECCE_MAX // (1024 * 1024)} MB)")
+    chunk_size = min(max(chunk_size, resumable.CHUNK_MIN), resumable.CHUNK_MAX)
+    async with writer():
+        sid = await d.run_sync(resumable.create, u.id, uploads.safe_name(filename), content_type.lower(),
+                               size, chunk_size, (sha256 or "").lower() or None, project, notes, lat, lng)
+        await d.commit()
+    s = await d.run_sync(resumable.get, sid, u.id)
+    return _upload_status(s, [])
+
+@app.get("/api/uploads/{sid}")
+async def upload_status(sid: str, u=Depends(require_user), d=Depends(get_db)):
+    s = await d.run_sync(_upload_or_404, sid, u.id)
+    return _upload_status(s, await d.run_sync(resumable.received, sid))
+
+@app.put("/api/uploads/{sid}/chunks/{n}")
+async def upload_chunk(sid: str, n: int, request: Request, u=Depends(require_user), d=Depends(get_db)):
+    s = await d.run_sync(_upload_or_404, sid, u.id)
+    await d.close()  # not held while the chunk streams in
+    if s.recce_id:
+        raise HTTPException(status_code=409, detail="Upload already finalized")
+    if not 0 <= n < resumable.chunk_count(s):
+        raise HTTPException(status_code=416, detail="Chunk index out of range")
+    want = (request.headers.get("x-chunk-sha256") or "").strip().lower()
+    if not want:
+        raise HTTPException(status_code=400, detail="X-Chunk-SHA256 header required")
+    length = resumable.chunk_len(s, n)
+    async with writer():
+        ok = await d.run_sync(resumable.begin_chunk, sid, n)
+        await d.commit()
+    if not ok:
+        raise HTTPException(status_code=409, detail="Upload already finalized or being finalized")
     try:
-        u = current_user(request, d)
-        if not u or u.role != "admin":
-            raise HTTPException(status_code=403, detail="Admin only")
-        users = d.execute(text("SELECT id,name FROM users ORDER BY name")).fetchall()
-        lb = []
-        for row in users:
-            pts = d.execute(text("SELECT COALESCE(SUM(pts),0) FROM points WHERE user_id=:u"), {"u": row.id}).scalar()
-            lb.append((row, int(pts or 0)))
-        lb.sort(key=lambda x: x[1], reverse=True)
-        return templates.TemplateResponse("admin.html", {"request": request, "user": u, "lb": lb})
-    finally:
-        d.close()
+        got, sha = await resumable.write_chunk(request.stream(), resumable.partial_path(sid), n * s.chunk_size, length)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="No such upload")
+    except OverflowError:
+        raise HTTPException(status_code=413, detail=f"Chunk {n} is {length} bytes")
+    if got != length:
+        raise HTTPException(status_code=400, detail=f"Chunk {n} is {length} bytes, got {got}")
+    if sha != want:
+        raise HTTPException(status_code=422, detail="Chunk checksum mismatch")
+    async with writer():
+        await d.run_sync(resumable.record_chunk, sid, n, got, sha)
+        await d.commit()
+    return {"ok": True, "chunk": n, "size": got, "sha256": sha}
+
+def _recce_file(d, rid: int):
+    return d.execute(text("SELECT filename FROM recce WHERE id=:id"), {"id": rid}).scalar()
+
+def _finalize_upload(d, s, sha: str):
+    # Runs under the write lock: exactly one finalize creates the Recce row.
+    # The partial file is linked into the store (no chunk can be written to it
+    # any more, see resumable.begin_finalize) and only removed once the row has
+    # committed, so a failed finalize can simply be retried.
+    cur = resumable.get(d, s.id, s.user_id)
+    if not cur or cur.recce_id:
+        return (cur.recce_id, _recce_file(d, cur.recce_id)) if cur and cur.recce_id else (None, None)
+    partial = resumable.partial_path(s.id)
+    try:
+        fn = storage.put(d, storage.Staged(partial, sha, s.size, uploads.extension(s.filename, s.content_type),
+                                           s.content_type, keep=True))
+        rid = _apply_recce(d, s.user_id, s.project, s.notes, fn, lat=s.lat, lng=s.lng, sha=sha, name=s.filename)
+        resumable.complete(d, s.id, rid, sha)
+        d.commit()
+    except BaseException:
+        d.rollback()
+        raise
+    os.unlink(partial)
+    return rid, fn
+
+@app.post("/api/uploads/{sid}/finalize")
+async def upload_finalize(sid: str, u=Depends(require_user), d=Depends(get_db)):
+    s = await d.run_sync(_upload_or_404, sid, u.id)
+    if not s.recce_id:
+        async with writer():
+            missing = await d.run_sync(resumable.begin_finalize, s)
+            await d.commit()
+        await d.close()
+        if missing:
+            raise HTTPException(status_code=409, detail=f"{len(missing)} chunk(s) missing")
+        try:
+            sha = await run_in_threadpool(resumable.file_sha256, resumable.partial_path(sid))
+            if s.sha256 and sha != s.sha256:
+                raise HTTPException(status_code=422, detail="File checksum mismatch")
+            async with writer():
+                rid, fn = await d.run_sync(_finalize_upload, s, sha)
+        except BaseException:
+            async with writer():
+                await d.run_sync(resumable.end_finalize, sid)
+                await d.commit()
+            raise
+    else:
+        rid, fn = s.recce_id, await d.run_sync(_recce_file, s.recce_id)
+    return {"ok": True, "recce_id": rid, "file_url": f"/{fn}" if fn else None, "points_awarded": 15}
+
+@app.delete("/api/uploads/{sid}")
+async def upload_abort(sid: str, u=Depends(require_user), d=Depends(get_db)):
+    s = await d.run_sync(_upload_or_404, sid, u.id)
+    if s.recce_id:
+        raise HTTPException(status_code=409, detail="Upload already finalized")
+    async with writer():
+        await d.run_sync(resumable.discard, sid)
+        await d.commit()
+    return {"ok": True}
 
 # -----------------------------------------------------------------------------
-# Admin: Attendance Dashboard + CSV
+# Offline sync: a queue of actions captured on the device, sent in one upload
+#
+# multipart/form-data with an `actions` field holding a JSON list of
+#   {"id": "<client action id>", "type": "checkin|checkout|report|recce",
+#    "ts": "<device ISO timestamp>", "lat", "lng", "remarks",
+#    "file": "<name of the part carrying the photo/file>",
+#    "report_date", "summary", "project", "notes"}
+# plus one file part per referenced file. Files are staged first, then every
+# action is applied in device-time order in a single transaction. Action ids
+# are kept as idempotency keys, so re-sending a batch replays stored results
+# instead of recording anything twice.
 # -----------------------------------------------------------------------------
-@app.get("/admin/attendance", response_class=HTMLResponse)
-def admin_attendance(request: Request, dt: str = None):
-    u = require_user(request)
-    if u.role != "admin":
-        raise HTTPException(status_code=403, detail="Admin only")
-    if not dt:
-        dt = date.today().isoformat()
+SYNC_MAX_ACTIONS = 200
+SYNC_MAX_AGE = timedelta(days=14)
+SYNC_CLOCK_SKEW = timedelta(minutes=10)
+SYNC_KEY_PREFIX = "sync:"
+
+def _sync_ts(v):
+    # Device time as a naive server-local datetime, like datetime.now().
+    ts = datetime.fromisoformat(str(v))
+    if ts.tzinfo:
+        ts = ts.astimezone().replace(tzinfo=None)
+    now = datetime.now()
+    if ts > now + SYNC_CLOCK_SKEW or ts < now - SYNC_MAX_AGE:
+        raise ValueError("timestamp out of range")
+    return ts
+
+def _sync_float(v):
+    return None if v is None or v == "" else float(v)
 
-    d = SessionLocal()
+def _apply_sync(d, user_id: int, items):
+    # items: validated actions, in device-time order. Returns {id: result}.
+    out = {}
+    for it in items:
+        kind, ts = it["type"], it["ts"]
+        if "staged" in it:
+            it["fn"], it["sha"] = storage.put(d, it["staged"]), it["staged"].sha256
+        if kind == "checkin":
+            res = _apply_checkin(d, user_id, it["fn"], it["sha"], it["lat"], it["lng"], it["remarks"], ts)
+            err = None if res else "Already checked in that day"
+        elif kind == "checkout":
+            res = _apply_checkout(d, user_id, it["fn"], it["sha"], it["lat"], it["lng"], it["remarks"], ts)
+            err = None
+            if not res:
+                cin = d.execute(text("SELECT cin_ts FROM attendance WHERE user_id=:u AND date=:dt"),
+                                {"u": user_id, "dt": ts.date()}).scalar()
+                err = "Already checked out that day" if cin else "No check-in found for that day"
+        elif kind == "report":
+            pts = _apply_report(d, user_id, it["report_date"], it["summary"])
+            res, err = {"ok": True, "points_awarded": pts}, None
+        else:
+            rid = _apply_recce(d, user_id, it["project"], it["notes"], it["fn"],
+                               ts.astimezone(timezone.utc).replace(tzinfo=None), it["lat"], it["lng"], it["sha"],
+                               it["name"])
+            res, err = {"ok": True, "recce_id": rid, "file_url": f"/{it['fn']}", "points_awarded": 15}, None
+        if res:
+            idempotency.store(d, user_id, SYNC_KEY_PREFIX + it["id"], kind, res)
+        out[it["id"]] = res or {"ok": False, "error": err}
+    return out
+
+@app.post("/api/sync")
+async def sync_actions(request: Request, u=Depends(require_user), d=Depends(get_db)):
+    form = await request.form(max_files=SYNC_MAX_ACTIONS, max_fields=SYNC_MAX_ACTIONS + 8)
     try:
-        rows = d.execute(text("""
-            SELECT a.date, u.name, u.email,
-                   a.cin_ts, a.cout_ts, a.status,
-                   a.cin_photo, a.cout_photo,
-                   a.cin_lat, a.cin_lng, a.cout_lat, a.cout_lng,
-                   a.cin_remark, a.cout_remark
-            FROM attendance a
-            JOIN users u ON a.user_id = u.id
-            WHERE a.date = :dt
-            ORDER BY u.name
-        """), {"dt": dt}).fetchall()
-
-        data = []
-        for r in rows:
-            m = r._mapping
-            hrs = None
-            if m.get("cin_ts") and m.get("cout_ts"):
-                t1, t2 = m["cin_ts"], m["cout_ts"]
-                hrs = round((t2 - t1).total_seconds() / 3600, 2)
-            data.append({
-                "name": m["name"], "email": m["email"],
-                "status": m["status"], "date": str(m["date"]),
-                "cin": str(m["cin_ts"] or ""), "cout": str(m["cout_ts"] or ""),
-                "hrs": hrs,
-                "cin_photo": f"/{m['cin_photo']}" if m["cin_photo"] else None,
-                "cout_photo": f"/{m['cout_photo']}" if m["cout_photo"] else None,
-                "cin_lat": m["cin_lat"], "cin_lng": m["cin_lng"],
-                "cout_lat": m["cout_lat"], "cout_lng": m["cout_lng"],
-                "cin_remark": m["cin_remark"], "cout_remark": m["cout_remark"],
-            })
-
-        return templates.TemplateResponse("admin_attendance.html",
-            {"request": request, "user": u, "date": dt, "rows": data})
+        actions = json.loads(form.get("actions") or "")
+    except ValueError:
+        actions = None
+    if not isinstance(actions, list) or not all(isinstance(a, dict) for a in actions):
+        raise HTTPException(status_code=400, detail="'actions' must be a JSON list of objects")
+    if len(actions) > SYNC_MAX_ACTIONS:
+        raise HTTPException(status_code=400, detail=f"At most {SYNC_MAX_ACTIONS} actions per batch")
+
+    ids = [str(a.get("id") or "")[:idempotency.MAX_KEY_LEN - len(SYNC_KEY_PREFIX)] for a in actions]
+    done = await d.run_sync(idempotency.lookup_many, u.id, [SYNC_KEY_PREFIX + i for i in ids if i])
+    await d.close()  # not held while files are stored
+
+    results, items, seen = [None] * len(actions), [], set()
+    for n, (a, aid) in enumerate(zip(actions, ids)):
+        kind = a.get("type")
+        if not aid or aid in seen:
+            results[n] = {"ok": False, "error": "Missing or duplicate action id"}
+            continue
+        seen.add(aid)
+        if SYNC_KEY_PREFIX + aid in done:
+            action, res = done[SYNC_KEY_PREFIX + aid]
+            results[n] = ({**res, "replayed": True} if action == kind else
+                          {"ok": False, "error": f"Action id already used for a {action}"})
+            continue
+        try:
+            if kind not in ("checkin", "checkout", "report", "recce"):
+                raise ValueError("unknown action type")
+            it = {"n": n, "id": aid, "type": kind, "ts": _sync_ts(a.get("ts")),
+                  "lat": _sync_float(a.get("lat")), "lng": _sync_float(a.get("lng")),
+                  "remarks": a.get("remarks"), "project": a.get("project"), "notes": a.get("notes"),
+                  "report_date": a.get("report_date"), "summary": a.get("summary")}
+            if kind == "report" and not (it["report_date"] and it["summary"]):
+                raise ValueError("report_date and summary are required")
+            if kind != "report":
+                f = form.get(a.get("file") or "")
+                if not hasattr(f, "read"):
+                    raise ValueError("file part missing")
+                if kind == "recce":
+                    it["name"] = f.filename
+                    it["staged"] = await uploads.save_upload(f, "recce", uploads.RECCE_MAX, uploads.RECCE_TYPES)
+                else:
+                    it["staged"] = await uploads.save_upload(f, "attendance", uploads.PHOTO_MAX,
+                                                             uploads.PHOTO_TYPES, ".jpg")
+        except (TypeError, ValueError) as e:
+            results[n] = {"ok": False, "error": str(e)}
+            continue
+        except HTTPException as e:
+            results[n] = {"ok": False, "error": e.detail}
+            continue
+        items.append(it)
+
+    items.sort(key=lambda it: it["ts"])
+    # Files of refused actions are stored but unreferenced; storage.gc()
+    # removes them.
+    try:
+        async with writer():
+            applied = await d.run_sync(_apply_sync, u.id, items)
+            await d.commit()
     finally:
-        d.close()
+        for it in items:
+            storage.discard(it.get("staged"))
+    for it in items:
+        results[it["n"]] = applied[it["id"]]
+    return {"ok": True, "results": [{"id": a.get("id"), **r} for a, r in zip(actions, results)]}
 
-@app.get("/admin/attendance/export")
-def admin_attendance_export(request: Request, dt: str = None):
-    u = require_user(request)
+# -----------------------------------------------------------------------------
+# Search: recce notes/projects and report summaries (FTS5, see search.py)
+# -----------------------------------------------------------------------------
+@app.get("/api/search")
+async def api_search(
+    q: str,
+    user_id: int = None,
+    frm: str = Query(None, alias="from"),
+    to: str = None,
+    project: str = None,
+    kind: str = None,
+    page: int = 1,
+    n: int = search.PAGE_DEFAULT,
+    u=Depends(require_user),
+    d=Depends(get_db),
+):
+    if not search.ready:
+        raise HTTPException(status_code=503, detail="Search is not available on this database")
     if u.role != "admin":
+        if user_id and user_id != u.id:
+            raise HTTPException(status_code=403, detail="Admin only")
+        user_id = u.id
+    if kind and kind not in search.KINDS:
+        raise HTTPException(status_code=400, detail=f"kind must be one of {', '.join(search.KINDS)}")
+    d1 = _parse_day(frm, "from") if frm else None
+    d2 = _parse_day(to, "to") if to else None
+    page, n = max(page, 1), min(max(n, 1), search.PAGE_MAX)
+    hits, more = await d.run_sync(search.search, q, user_id, d1, d2, project, kind, n, (page - 1) * n)
+    return {"ok": True, "q": q, "page": page, "n": n, "more": more, "results": hits}
+
+# -----------------------------------------------------------------------------
+# Admin: Leaderboard
+# -----------------------------------------------------------------------------
+LEADERBOARD_PAGE = 50
+
+@app.get("/admin", response_class=HTMLResponse)
+async def admin(request: Request, page: int = 1, n: int = LEADERBOARD_PAGE,
+                u=Depends(optional_user), d=Depends(get_db)):
+    if not u or u.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin only")
+    page, n = max(page, 1), min(max(n, 1), 500)
+    tag = await d.run_sync(httpcache.tag, ["points", "users"], page, n)
+    if httpcache.fresh(request, tag):
+        return httpcache.not_modified(tag, "admin")
+    rows = await d.run_sync(points.leaderboard, n, (page - 1) * n)
+    lb = [(row, int(row.pts)) for row in rows]
+    pages = max((await d.run_sync(points.user_count) + n - 1) // n, 1)
+    return httpcache.tagged(templates.TemplateResponse("admin.html", {
+        "request": request, "user": u, "lb": lb,
+        "page": page, "pages": pages, "n": n, "rank0": (page - 1) * n,
+    }), tag, "admin")
+
+@app.post("/admin/users/role")
+async def admin_set_role(email: str = Form(...), role: str = Form(...),
+                         u=Depends(require_admin), d=Depends(get_db)):
+    if role not in ("user", "admin"):
+        raise HTTPException(status_code=400, detail="Unknown role")
+    target = (await d.execute(select(models.User.id).where(models.User.email == email))).scalar_one_or_none()
+    if not target:
+        raise HTTPException(status_code=404, detail="No such user")
+    await auth.set_role(d, target, role)
+    return RedirectResponse("/admin?role=1", status_code=302)
+
+# -----------------------------------------------------------------------------
+# Admin: Metrics (Prometheus text format)
+# -----------------------------------------------------------------------------
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint(request: Request, u=Depends(optional_user)):
+    bearer = (request.headers.get("authorization") or "").removeprefix("Bearer ").strip()
+    if not (metrics.METRICS_TOKEN and bearer == metrics.METRICS_TOKEN) and (not u or u.role != "admin"):
         raise HTTPException(status_code=403, detail="Admin only")
-    if not dt:
-        dt = date.today().isoformat()
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# -----------------------------------------------------------------------------
+# Admin: Attendance Dashboard + CSV
+# -----------------------------------------------------------------------------
+@app.get("/admin/attendance", response_class=HTMLResponse)
+async def admin_attendance(request: Request, dt: str = None, u=Depends(require_admin), d=Depends(get_db)):
+    # 304 until anything shown for the date changes. Past dates rarely do, so
+    # their rendered table is also kept in httpcache.fragments for every admin.
+    dt = _parse_day(dt, "dt").isoformat() if dt else date.today().isoformat()
+    month_key = rollups.month_key(dt)
+    tag = await d.run_sync(httpcache.tag, [versions.day_scope(dt), versions.rollup_scope(month_key),
+                                           "users", "sites"], dt)
+    if httpcache.fresh(request, tag):
+        return httpcache.not_modified(tag, "admin_attendance")
+    past = dt < date.today().isoformat()
+    day = httpcache.fragments.get(("admin_attendance", dt), tag.key, "admin_attendance") if past else None
+    if day is None:
+        day = await _attendance_day(d, dt, month_key)
+        if past:
+            httpcache.fragments.put(("admin_attendance", dt), tag.key, day)
+    return httpcache.tagged(templates.TemplateResponse("admin_attendance.html",
+        {"request": request, "user": u, "date": dt, "day": Markup(day)}), tag, "admin_attendance")
+
+async def _attendance_day(d, dt: str, month_key: str):
+    # The month summary and the day's table, rendered on their own.
+    rows = (await d.execute(text("""
+        SELECT a.date, u.name, u.email,
+               a.cin_ts, a.cout_ts, a.status, """ + history.HOURS_SQL + """ AS hrs,
+               a.cin_photo, a.cout_photo, a.cin_thumb, a.cout_thumb,
+               a.cin_display, a.cout_display,
+               a.cin_lat, a.cin_lng, a.cout_lat, a.cout_lng,
+               a.cin_remark, a.cout_remark,
+               cs.name AS cin_site, a.cin_site_dist, a.cin_inside,
+               xs.name AS cout_site, a.cout_site_dist, a.cout_inside
+        FROM attendance a
+        JOIN users u ON a.user_id = u.id
+        LEFT JOIN sites cs ON cs.id = a.cin_site_id
+        LEFT JOIN sites xs ON xs.id = a.cout_site_id
+        WHERE a.date = :dt
+        ORDER BY u.name
+    """), {"dt": dt})).fetchall()
+
+    data = []
+    for r in rows:
+        m = r._mapping
+        data.append({
+            "name": m["name"], "email": m["email"],
+            "status": m["status"], "date": str(m["date"]),
+            "cin": str(m["cin_ts"] or ""), "cout": str(m["cout_ts"] or ""),
+            "hrs": m["hrs"],
+            "cin_photo": f"/{m['cin_photo']}" if m["cin_photo"] else None,
+            "cout_photo": f"/{m['cout_photo']}" if m["cout_photo"] else None,
+            "cin_thumb": f"/{m['cin_thumb']}" if m["cin_thumb"] else None,
+            "cout_thumb": f"/{m['cout_thumb']}" if m["cout_thumb"] else None,
+            "cin_display": f"/{m['cin_display']}" if m["cin_display"] else None,
+            "cout_display": f"/{m['cout_display']}" if m["cout_display"] else None,
+            "cin_lat": m["cin_lat"], "cin_lng": m["cin_lng"],
+            "cout_lat": m["cout_lat"], "cout_lng": m["cout_lng"],
+            "cin_remark": m["cin_remark"], "cout_remark": m["cout_remark"],
+            "cin_site": m["cin_site"], "cin_site_dist": m["cin_site_dist"], "cin_inside": m["cin_inside"],
+            "cout_site": m["cout_site"], "cout_site_dist": m["cout_site_dist"], "cout_inside": m["cout_inside"],
+        })
+
+    month = await d.run_sync(rollups.company_month, month_key)
+    return templates.get_template("admin_attendance_day.html").render(date=dt, rows=data, month=month)
+
+EXPORT_BATCH = 1000
+EXPORT_HEADER = ["Name","Email","Date","Status",
+                 "Check-in","Check-out","Hours",
+                 "Cin Lat","Cin Lng","Cout Lat","Cout Lng",
+                 "Cin Remark","Cout Remark","Cin Photo","Cout Photo",
+                 "Cin Site","Cin Site Dist (m)","Cin Inside","Cout Site","Cout Site Dist (m)","Cout Inside"]
+
+def _parse_day(v: str, name: str):
+    try:
+        return date.fromisoformat(v)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail=f"Invalid {name} date")
+
+async def _export_csv(d1: date, d2: date, user_id: int = None, gz: bool = False):
+    # Async generator consumed while the response streams, with its own session.
+    # Rows come off a server-side cursor EXPORT_BATCH at a time, so memory stays
+    # flat however long the range is.
+    d = AsyncSessionLocal()
+    z = zlib.compressobj(6, zlib.DEFLATED, 31) if gz else None
+    buf = io.StringIO()
+    w = csv.writer(buf)
+
+    def chunk():
+        data = buf.getvalue().encode()
+        buf.seek(0); buf.truncate()
+        return z.compress(data) if z else data
 
-    d = SessionLocal()
     try:
-        rows = d.execute(text("""
+        w.writerow(EXPORT_HEADER)
+        q = """
             SELECT u.name, u.email, a.date, a.status, a.cin_ts, a.cout_ts,
+                   COALESCE(""" + history.HOURS_SQL + """, '') AS hrs,
                    a.cin_lat, a.cin_lng, a.cout_lat, a.cout_lng,
-                   a.cin_remark, a.cout_remark
+                   a.cin_remark, a.cout_remark,
+                   '/' || COALESCE(a.cin_thumb, a.cin_photo) AS cin_photo,
+                   '/' || COALESCE(a.cout_thumb, a.cout_photo) AS cout_photo,
+                   cs.name, a.cin_site_dist,
+                   CASE a.cin_inside WHEN 1 THEN 'yes' WHEN 0 THEN 'no' ELSE '' END,
+                   xs.name, a.cout_site_dist,
+                   CASE a.cout_inside WHEN 1 THEN 'yes' WHEN 0 THEN 'no' ELSE '' END
             FROM attendance a
             JOIN users u ON a.user_id = u.id
-            WHERE a.date = :dt
-            ORDER BY u.name
-        """), {"dt": dt}).fetchall()
-
-        output = io.StringIO()
-        writer = csv.writer(output)
-        writer.writerow(["Name","Email","Date","Status",
-                         "Check-in","Check-out","Hours",
-                         "Cin Lat","Cin Lng","Cout Lat","Cout Lng",
-                         "Cin Remark","Cout Remark"])
-        for r in rows:
-            m = r._mapping
-            hrs = ""
-            if m.get("cin_ts") and m.get("cout_ts"):
-                t1, t2 = m["cin_ts"], m["cout_ts"]
-                hrs = round((t2 - t1).total_seconds()/3600, 2)
-            writer.writerow([
-                m["name"], m["email"], m["date"], m["status"],
-                m["cin_ts"], m["cout_ts"], hrs,
-                m["cin_lat"], m["cin_lng"], m["cout_lat"], m["cout_lng"],
-                m["cin_remark"], m["cout_remark"]
-            ])
-        output.seek(0)
-        return StreamingResponse(iter([output.getvalue().encode()]),
-                                 media_type="text/csv",
-                                 headers={"Content-Disposition": f'attachment; filename="attendance_{dt}.csv"'})
+            LEFT JOIN sites cs ON cs.id = a.cin_site_id
+            LEFT JOIN sites xs ON xs.id = a.cout_site_id
+            WHERE a.date BETWEEN :d1 AND :d2
+        """
+        params = {"d1": d1, "d2": d2}
+        if user_id:
+            q += " AND a.user_id = :u"
+            params["u"] = user_id
+        q += " ORDER BY a.date, u.name"
+        res = await d.stream(text(q), params)
+        async for rows in res.partitions(EXPORT_BATCH):
+            w.writerows(rows)
+            yield chunk()
+        out = chunk()
+        if z:
+            out += z.flush()
+        if out:
+            yield out
     finally:
-        d.close()
+        await d.close()
+
+@app.get("/admin/attendance/export")
+async def admin_attendance_export(
+    dt: str = None,
+    frm: str = Query(None, alias="from"),
+    to: str = None,
+    user_id: int = None,
+    gz: bool = False,
+    u=Depends(require_admin),
+):
+    if frm or to:
+        d1 = _parse_day(frm or to, "from")
+        d2 = _parse_day(to or frm, "to")
+    else:
+        d1 = d2 = _parse_day(dt, "dt") if dt else date.today()
+    if d2 < d1:
+        raise HTTPException(status_code=400, detail="'to' is before 'from'")
+
+    name = f"attendance_{d1}" if d1 == d2 else f"attendance_{d1}_{d2}"
+    if user_id:
+        name += f"_u{user_id}"
+    name += ".csv.gz" if gz else ".csv"
+    return StreamingResponse(_export_csv(d1, d2, user_id, gz),
+                             media_type="application/gzip" if gz else "text/csv",
+                             headers={"Content-Disposition": f'attachment; filename="{name}"'})
+
+# -----------------------------------------------------------------------------
+# Admin: Payroll (monthly per-employee metrics)
+# -----------------------------------------------------------------------------
+def _parse_month(v: str = None):
+    if not v:
+        return rollups.month_key(date.today())
+    try:
+        payroll.month_bounds(v)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid month (expected YYYY-MM)")
+    return v[:7]
+
+@app.get("/admin/payroll", response_class=HTMLResponse)
+async def admin_payroll(request: Request, month: str = None, u=Depends(require_admin), d=Depends(get_db)):
+    month = _parse_month(month)
+    rows = await d.run_sync(payroll.for_month, month)
+    return templates.TemplateResponse("admin_payroll.html", {
+        "request": request, "user": u, "month": month, "rows": rows,
+        "totals": payroll.totals(rows), "closed": payroll.is_closed(month),
+        "early_before": payroll.EARLY_LEAVE_BEFORE.strftime("%H:%M"),
+    })
+
+@app.get("/admin/payroll/export")
+async def admin_payroll_export(month: str = None, format: str = "csv",
+                               u=Depends(require_admin), d=Depends(get_db)):
+    month = _parse_month(month)
+    if format not in ("csv", "json"):
+        raise HTTPException(status_code=400, detail="format must be csv or json")
+    rows = await d.run_sync(payroll.for_month, month)
+    name = f"payroll_{month}.{format}"
+    disp = {"Content-Disposition": f'attachment; filename="{name}"'}
+    if format == "json":
+        return JSONResponse({"month": month, "closed": payroll.is_closed(month), "rows": rows}, headers=disp)
+    buf = io.StringIO()
+    w = csv.DictWriter(buf, fieldnames=payroll.COLUMNS)
+    w.writeheader()
+    w.writerows(rows)
+    return PlainTextResponse(buf.getvalue(), media_type="text/csv", headers=disp)
+
+# -----------------------------------------------------------------------------
+# Admin: Sites registry (geofences, see geofence.py)
+# -----------------------------------------------------------------------------
+SITES_PAGE = 100
+
+@app.get("/admin/sites", response_class=HTMLResponse)
+async def admin_sites(request: Request, q: str = None, page: int = 1,
+                      u=Depends(require_admin), d=Depends(get_db)):
+    page = max(page, 1)
+    rows, total = await d.run_sync(geofence.sites_page, q, SITES_PAGE, (page - 1) * SITES_PAGE)
+    return templates.TemplateResponse("admin_sites.html", {
+        "request": request, "user": u, "rows": rows, "total": total, "q": q or "",
+        "page": page, "pages": max((total + SITES_PAGE - 1) // SITES_PAGE, 1),
+        "kinds": geofence.KINDS, "radius": geofence.RADIUS_DEFAULT,
+    })
+
+@app.post("/admin/sites")
+async def admin_site_add(name: str = Form(...), kind: str = Form("office"), lat: str = Form(...),
+                         lng: str = Form(...), radius_m: str = Form(None),
+                         u=Depends(require_admin), d=Depends(get_db)):
+    try:
+        row = geofence.check_site(name, kind, lat, lng, radius_m)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    async with writer():
+        await d.run_sync(geofence.add_site, row["n"], row["k"], row["la"], row["ln"], row["r"])
+        await d.commit()
+    return RedirectResponse("/admin/sites?added=1", status_code=302)
+
+@app.post("/admin/sites/import")
+async def admin_sites_import(file: UploadFile = File(...), u=Depends(require_admin), d=Depends(get_db)):
+    # CSV with a header row: name,kind,lat,lng,radius_m
+    raw = await file.read(uploads.SITES_CSV_MAX + 1)
+    if len(raw) > uploads.SITES_CSV_MAX:
+        raise HTTPException(status_code=413, detail="CSV too large")
+    try:
+        rows = list(csv.DictReader(io.StringIO(raw.decode("utf-8-sig"))))
+    except (UnicodeDecodeError, csv.Error):
+        raise HTTPException(status_code=400, detail="Not a UTF-8 CSV file")
+    async with writer():
+        added, errors = await d.run_sync(geofence.import_sites, rows)
+        await d.commit()
+    return RedirectResponse(f"/admin/sites?added={added}&errors={len(errors)}", status_code=302)
+
+@app.post("/admin/sites/{site_id}/delete")
+async def admin_site_delete(site_id: int, u=Depends(require_admin), d=Depends(get_db)):
+    async with writer():
+        await d.execute(text("DELETE FROM sites WHERE id=:id"), {"id": site_id})
+        await d.commit()
+    return RedirectResponse("/admin/sites?deleted=1", status_code=302)
 
+@app.get("/api/sites/classify")
+async def sites_classify(lat: float, lng: float, u=Depends(require_user), d=Depends(get_db)):
+    site = await d.run_sync(geofence.classify, lat, lng)
+    return {"ok": True, "site": geofence.as_dict(site)}
@@ -0,0 +1,173 @@
+import argparse
+
+from .db import engine, SessionLocal
+from . import models, migrations, points, rollups, images, idempotency, resumable, search, geofence, jobs
+from . import storage
+from . import tasks  # registers the job handlers
+
+# -----------------------------------------------------------------------------
+# Maintenance commands:  python -m app.manage <command>
+# -----------------------------------------------------------------------------
+def rebuild_points(args):
+    d = SessionLocal()
+    try:
+        n = points.rebuild_balances(d)
+        print(f"rebuilt points balances for {n} users")
+    finally:
+        d.close()
+
+def compact_points(args):
+    d = SessionLocal()
+    try:
+        done = points.compact(d)
+        for month, n in done.items():
+            print(f"{month}: folded {n} ledger rows into monthly snapshots")
+        print(f"compacted {len(done)} closed months")
+    finally:
+        d.close()
+
+def rebuild_rollups(args):
+    d = SessionLocal()
+    try:
+        n = rollups.rebuild(d)
+        print(f"rebuilt {n} monthly attendance rollups")
+    finally:
+        d.close()
+
+def build_images(args):
+    if not images.enabled():
+        print("Pillow is not installed; nothing to do")
+        return
+    d = SessionLocal()
+    try:
+        jobs = list(images.pending_jobs(d))
+    finally:
+        d.close()
+    done = 0
+    for job in jobs:
+        try:
+            images.process(job)
+            done += 1
+        except Exception as e:
+            print(f"skipped {job['src']}: {e}")
+    print(f"built thumbnails for {done}/{len(jobs)} photos")
+
+def migrate(args):
+    # main() has already run the migrations; this just makes it explicit.
+    print("database schema is up to date")
+
+def prune_keys(args):
+    d = SessionLocal()
+    try:
+        n = idempotency.prune(d)
+        print(f"pruned {n} idempotency keys older than {idempotency.KEEP_DAYS} days")
+    finally:
+        d.close()
+
+def prune_uploads(args):
+    d = SessionLocal()
+    try:
+        n = resumable.prune(d)
+        print(f"pruned {n} upload sessions idle for over {resumable.SESSION_TTL}")
+    finally:
+        d.close()
+
+def rebuild_search(args):
+    d = SessionLocal()
+    try:
+        n = search.rebuild(d)
+        d.commit()
+        print(f"indexed {n} recce entries and reports for search")
+    finally:
+        d.close()
+
+def reclassify_geofence(args):
+    d = SessionLocal()
+    try:
+        n = geofence.reclassify(d)
+        print(f"classified {n} check-in/check-out/recce locations against the sites registry")
+    finally:
+        d.close()
+
+def migrate_uploads(args):
+    d = SessionLocal()
+    try:
+        moved, missing = storage.migrate_legacy(d)
+        print(f"moved {moved} uploads into the blob store ({missing} referenced files were missing)")
+    finally:
+        d.close()
+
+def archive_uploads(args):
+    # gc + every due archive bundle now, instead of one per storage.maintain job.
+    d = SessionLocal()
+    try:
+        n = k = storage.gc(d)
+        while k >= storage.GC_BATCH:
+            k = storage.gc(d)
+            n += k
+        total = 0
+        while True:
+            k = storage.pack(d)
+            if not k:
+                break
+            total += k
+        print(f"collected {n} unreferenced blobs, archived {total} blobs older than "
+              f"{storage.ARCHIVE_AFTER_MONTHS} months")
+    finally:
+        d.close()
+
+def storage_stats(args):
+    d = SessionLocal()
+    try:
+        for r in storage.stats(d) or [{"tier": "-", "blobs": 0, "bytes": 0, "refs": 0}]:
+            print(f"{r['tier']}: {r['blobs']} blobs, {r['bytes'] / 1048576:.1f} MB, {r['refs']} references")
+    finally:
+        d.close()
+
+def run_jobs(args):
+    import asyncio
+    n = asyncio.run(jobs.drain())
+    print(f"ran {n} background jobs")
+
+def job_stats(args):
+    d = SessionLocal()
+    try:
+        st = jobs.stats(d)
+        print(", ".join(f"{k}: {v}" for k, v in sorted(st.items())) or "no jobs queued")
+    finally:
+        d.close()
+
+def retry_dead_jobs(args):
+    d = SessionLocal()
+    try:
+        print(f"requeued {jobs.retry_dead(d)} dead jobs")
+    finally:
+        d.close()
+
+COMMANDS = {
+    "archive-uploads": archive_uploads,
+    "build-images": build_images,
+    "compact-points": compact_points,
+    "job-stats": job_stats,
+    "migrate": migrate,
+    "migrate-uploads": migrate_uploads,
+    "prune-keys": prune_keys,
+    "prune-uploads": prune_uploads,
+    "rebuild-points": rebuild_points,
+    "rebuild-rollups": rebuild_rollups,
+    "rebuild-search": rebuild_search,
+    "reclassify-geofence": reclassify_geofence,
+    "retry-dead-jobs": retry_dead_jobs,
+    "run-jobs": run_jobs,
+    "storage-stats": storage_stats,
+}
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog="python -m app.manage")
+    ap.add_argument("command", choices=sorted(COMMANDS))
+    args = ap.parse_args(argv)
+    migrations.run(engine)
+    COMMANDS[args.command](args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+from sqlalchemy import event
+from starlette.routing import Mount
+from collections import Counter as _Tally
+from contextvars import ContextVar
+import bisect, logging, os, threading, time
+
+log = logging.getLogger("vapp.perf")
+
+# -----------------------------------------------------------------------------
+# Performance instrumentation
+#
+# MetricsMiddleware times every request and opens a per-request stats record in
+# a context variable. Engine hooks add each SQL statement to it (async sessions
+# and threadpool calls inherit the context), so statements are attributed to the
+# route that ran them. render() emits the Prometheus text format for /metrics.
+# -----------------------------------------------------------------------------
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "1000"))  # 0 disables the slow log
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", "10"))
+SLOW_LOG_MAX_STMTS = 200
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # lets a scraper read /metrics without an admin login
+
+REQUEST_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+SQL_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .5, 1)
+BCRYPT_BUCKETS = (.05, .1, .2, .3, .5, 1, 2, 5)
+COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 500)
+
+def _key(labels: dict):
+    return tuple(sorted(labels.items()))
+
+def _esc(v):
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _fmt(labels, extra=None):
+    items = list(labels) + (list(extra.items()) if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_esc(v)}"' for k, v in items) + "}"
+
+class Counter:
+    def __init__(self, name, help):
+        self.name, self.help = name, help
+        self._v = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        k = _key(labels)
+        with self._lock:
+            self._v[k] = self._v.get(k, 0) + amount
+
+    def render(self):
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for k, v in sorted(self._v.items()):
+                out.append(f"{self.name}{_fmt(k)} {v}")
+        return out
+
+class Histogram:
+    def __init__(self, name, help, buckets):
+        self.name, self.help, self.buckets = name, help, tuple(buckets)
+        self._v = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        k = _key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._v.get(k)
+            if row is None:
+                row = self._v[k] = [0] * (len(self.buckets) + 2)
+            if i < len(self.buckets):
+                row[i] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    def render(self):
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for k, row in sorted(self._v.items()):
+                acc = 0
+                for b, n in zip(self.buckets, row):
+                    acc += n
+                    out.append(f"{self.name}_bucket{_fmt(k, {'le': b})} {acc}")
+                out.append(f"{self.name}_bucket{_fmt(k, {'le': '+Inf'})} {row[-1]}")
+                out.append(f"{self.name}_sum{_fmt(k)} {round(row[-2], 6)}")
+                out.append(f"{self.name}_count{_fmt(k)} {row[-1]}")
+        return out
+
+request_seconds = Histogram("vapp_request_duration_seconds", "HTTP request latency by route.", REQUEST_BUCKETS)
+requests_total = Counter("vapp_requests_total", "HTTP requests by route, method and status.")
+sql_seconds = Histogram("vapp_sql_duration_seconds", "SQL statement latency by route.", SQL_BUCKETS)
+sql_per_request = Histogram("vapp_sql_statements_per_request", "SQL statements executed per request.", COUNT_BUCKETS)
+n_plus_one_total = Counter("vapp_sql_n_plus_one_total", "Requests that repeated one statement N_PLUS_ONE_THRESHOLD+ times.")
+slow_requests_total = Counter("vapp_slow_requests_total", "Requests slower than SLOW_REQUEST_MS.")
+bcrypt_seconds = Histogram("vapp_bcrypt_duration_seconds", "Password hash/verify time including queueing.", BCRYPT_BUCKETS)
+upload_bytes_total = Counter("vapp_upload_bytes_total", "Bytes written to uploads/ by upload kind.")
+uploads_total = Counter("vapp_uploads_total", "Files written to uploads/ by upload kind.")
+
+REGISTRY = [request_seconds, requests_total, sql_seconds, sql_per_request, n_plus_one_total,
+            slow_requests_total, bcrypt_seconds, upload_bytes_total, uploads_total]
+
+def render() -> str:
+    lines = []
+    for m in REGISTRY:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+# -----------------------------------------------------------------------------
+# Per-request stats
+# -----------------------------------------------------------------------------
+class _ReqStats:
+    __slots__ = ("sql_n", "sql_s", "durs", "shapes", "stmts")
+
+    def __init__(self, keep_stmts: bool):
+        self.sql_n, self.sql_s = 0, 0.0
+        self.durs = []  # observed once the route is known
+        self.shapes = _Tally()
+        self.stmts = [] if keep_stmts else None
+
+_current = ContextVar("vapp_request_stats", default=None)
+
+def _route_label(app, scope):
+    route = scope.get("route")
+    if route is not None and getattr(route, "path", None):
+        return route.path
+    path = scope.get("path", "")
+    for r in getattr(app, "routes", ()):
+        if isinstance(r, Mount) and path.startswith(r.path + "/"):
+            return r.path + "/*"
+    return "<unmatched>"
+
+class MetricsMiddleware:
+    def __init__(self, app, root=None):
+        self.app = app
+        self.root = root  # the FastAPI app, for mount lookups
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        st = _ReqStats(keep_stmts=SLOW_REQUEST_MS > 0)
+        token = _current.set(st)
+        status = 500
+        t0 = time.perf_counter()
+
+        async def send_wrapper(msg):
+            nonlocal status
+            if msg["type"] == "http.response.start":
+                status = msg["status"]
+            await send(msg)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            dt = time.perf_counter() - t0
+            _current.reset(token)
+            route = _route_label(self.root, scope)
+            method = scope.get("method", "")
+            request_seconds.observe(dt, route=route, method=method)
+            requests_total.inc(route=route, method=method, status=status)
+            sql_per_request.observe(st.sql_n, route=route)
+            for x in st.durs:
+                sql_seconds.observe(x, route=route)
+            repeated = [(s, n) for s, n in st.shapes.items() if n >= N_PLUS_ONE_THRESHOLD]
+            if repeated:
+                n_plus_one_total.inc(route=route)
+                s, n = max(repeated, key=lambda x: x[1])
+                log.warning("possible N+1 on %s %s: %d x %s", method, route, n, " ".join(s.split())[:200])
+            if SLOW_REQUEST_MS and dt * 1000 >= SLOW_REQUEST_MS:
+                slow_requests_total.inc(route=route)
+                _log_slow(method, scope.get("path", ""), dt, st)
+
+def _log_slow(method, path, dt, st):
+    lines = [f"slow request {method} {path}: {dt * 1000:.0f} ms, "
+             f"{st.sql_n} SQL statements, {st.sql_s * 1000:.0f} ms in SQL"]
+    for ms, stmt in sorted(st.stmts or [], reverse=True)[:20]:
+        lines.append(f"  {ms:8.2f} ms  {' '.join(stmt.split())[:300]}")
+    log.warning("\n".join(lines))
+
+# -----------------------------------------------------------------------------
+# SQL hooks
+# -----------------------------------------------------------------------------
+def _before(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("vapp_t0", []).append(time.perf_counter())
+
+def _after(conn, cursor, statement, parameters, context, executemany):
+    stack = conn.info.get("vapp_t0")
+    if not stack:
+        return
+    dt = time.perf_counter() - stack.pop()
+    st = _current.get()
+    if st is None:
+        sql_seconds.observe(dt, route="<background>")
+        return
+    st.sql_n += 1
+    st.sql_s += dt
+    st.durs.append(dt)
+    st.shapes[statement] += 1
+    if st.stmts is not None and len(st.stmts) < SLOW_LOG_MAX_STMTS:
+        st.stmts.append((round(dt * 1000, 2), statement))
+
+def _error(ctx):
+    # after_cursor_execute doesn't fire for a statement that raised; drop its
+    # start time so the next one isn't paired with it.
+    stack = ctx.connection.info.get("vapp_t0") if ctx.connection is not None else None
+    if stack and ctx.execution_context is not None:
+        stack.pop()
+
+def install(app, *engines):
+    for e in engines:
+        e = getattr(e, "sync_engine", e)  # AsyncEngine events live on its sync proxy
+        event.listen(e, "before_cursor_execute", _before)
+        event.listen(e, "after_cursor_execute", _after)
+        event.listen(e, "handle_error", _error)
+    app.add_middleware(MetricsMiddleware, root=app)
@@ -0,0 +1,75 @@
+from sqlalchemy import inspect, text
+
+from .db import Base, engine
+from . import search, versions, storage
+
+# -----------------------------------------------------------------------------
+# Lightweight in-place migrations
+#
+# create_all() only creates missing tables. run() brings databases created by
+# older releases up to the current models without losing data: new nullable
+# columns are added, duplicate attendance rows are folded so the
+# (user_id, date) unique index can be built, archived points rows get their
+# ledger id as source_id, missing indexes are created and the full-text
+# search table and the search/version/blob refcount triggers are installed.
+# Every step is idempotent, so it runs on each start.
+# -----------------------------------------------------------------------------
+def add_missing_columns(cn, metadata):
+    insp = inspect(cn)
+    for t in metadata.sorted_tables:
+        if not insp.has_table(t.name):
+            continue
+        have = {c["name"] for c in insp.get_columns(t.name)}
+        for col in t.columns:
+            if col.name not in have:
+                cn.execute(text(f'ALTER TABLE {t.name} ADD COLUMN {col.name} {col.type.compile(cn.dialect)}'))
+
+def _merge_from(cols, pick: str):
+    # SET (cols) from the row of the same user/day chosen by `pick`, when there is one.
+    sel = ("FROM attendance b WHERE b.user_id IS attendance.user_id AND b.date IS attendance.date "
+           f"AND {pick} LIMIT 1")
+    return (f"UPDATE attendance SET ({', '.join(cols)}) = (SELECT {', '.join('b.' + c for c in cols)} {sel}) "
+            f"WHERE id IN (SELECT id FROM _att_keep) AND EXISTS (SELECT 1 {sel})")
+
+def dedupe_attendance(cn):
+    # Older builds could end up with several rows per user/day. They are folded
+    # into the newest row: it takes the earliest check-in (with its photo,
+    # location, status and the rest of the cin_* fields) and the latest
+    # check-out that any of them has, then the others are deleted.
+    if not cn.execute(text("SELECT 1 FROM attendance GROUP BY user_id, date HAVING COUNT(*) > 1 LIMIT 1")).fetchone():
+        return 0
+    have = [c["name"] for c in inspect(cn).get_columns("attendance")]
+    cin = [c for c in have if c.startswith("cin_")] + [c for c in ("status",) if c in have]
+    cout = [c for c in have if c.startswith("cout_")]
+    cn.execute(text("CREATE TEMP TABLE _att_keep AS SELECT MAX(id) AS id FROM attendance "
+                    "GROUP BY user_id, date HAVING COUNT(*) > 1"))
+    try:
+        cn.execute(text(_merge_from(cin, "b.cin_ts IS NOT NULL ORDER BY b.cin_ts, b.id")))
+        cn.execute(text(_merge_from(cout, "b.cout_ts IS NOT NULL ORDER BY b.cout_ts DESC, b.id DESC")))
+    finally:
+        cn.execute(text("DROP TABLE _att_keep"))
+    return cn.execute(text(
+        "DELETE FROM attendance WHERE id NOT IN "
+        "(SELECT MAX(id) FROM attendance GROUP BY user_id, date)"
+    )).rowcount
+
+def backfill_points_source(cn):
+    # Rows archived before points_archive had source_id kept the ledger id as id.
+    return cn.execute(text("UPDATE points_archive SET source_id = id WHERE source_id IS NULL")).rowcount
+
+def create_missing_indexes(cn, metadata):
+    for t in metadata.sorted_tables:
+        for idx in t.indexes:
+            idx.create(cn, checkfirst=True)
+
+def run(bind=engine, metadata=None):
+    metadata = metadata or Base.metadata
+    metadata.create_all(bind=bind)
+    with bind.begin() as cn:
+        add_missing_columns(cn, metadata)
+        dedupe_attendance(cn)
+        backfill_points_source(cn)
+        create_missing_indexes(cn, metadata)
+        search.install(cn)
+        versions.install(cn)
+        storage.install(cn)
@@ -1,7 +1,7 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, Date, ForeignKey
-from sqlalchemy.orm import declarative_base, relationship
+from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, Date, ForeignKey, Index
+from sqlalchemy.orm import relationship
 
-Base = declarative_base()
+from .db import Base
 
 class User(Base):
     __tablename__ = "users"
@@ -13,6 +13,10 @@ class User(Base):
 
 class Attendance(Base):
     __tablename__ = "attendance"
+    __table_args__ = (
+        Index("ux_attendance_user_date", "user_id", "date", unique=True),
+        Index("ix_attendance_date_user", "date", "user_id"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     date = Column(Date)
@@ -28,9 +32,22 @@ class Attendance(Base):
     # NEW:
     cin_remark = Column(String)
     cout_remark = Column(String)
+    # Derived images written by the background image worker
+    cin_thumb = Column(String)
+    cin_display = Column(String)
+    cout_thumb = Column(String)
+    cout_display = Column(String)
+    # Geofence classification (see geofence.py)
+    cin_site_id = Column(Integer)
+    cin_site_dist = Column(Float)  # metres to that site's centre
+    cin_inside = Column(Boolean)
+    cout_site_id = Column(Integer)
+    cout_site_dist = Column(Float)
+    cout_inside = Column(Boolean)
 
 class Report(Base):
     __tablename__ = "reports"
+    __table_args__ = (Index("ix_reports_user_date", "user_id", "report_date"),)
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     report_date = Column(Date)
@@ -39,18 +56,168 @@ class Report(Base):
 
 class Recce(Base):
     __tablename__ = "recce"
+    __table_args__ = (Index("ix_recce_user_uploaded", "user_id", "uploaded_at"),)
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     uploaded_at = Column(DateTime)
     project = Column(String)
     notes = Column(String)
     filename = Column(String)
+    original_name = Column(String)  # client's file name; filename is the blob path
+    thumb = Column(String)
+    display = Column(String)
+    lat = Column(Float)
+    lng = Column(Float)
+    site_id = Column(Integer)
+    site_dist = Column(Float)
+    inside = Column(Boolean)
 
 class Points(Base):
     __tablename__ = "points"
+    __table_args__ = (
+        Index("ix_points_user_created", "user_id", "created_at"),
+        Index("ix_points_created", "created_at"),  # compaction finds the oldest month
+    )
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     category = Column(String)   # ATTENDANCE / REPORT / RECCE / etc
     descr = Column(String)
     pts = Column(Integer)
     created_at = Column(DateTime)
+
+class PointsMonth(Base):
+    # Compacted ledger: one row per user, month and category (see points.compact)
+    __tablename__ = "points_month"
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    month = Column(String, primary_key=True)  # YYYY-MM
+    category = Column(String, primary_key=True)
+    pts = Column(Integer, default=0)
+    entries = Column(Integer, default=0)
+
+class PointsArchive(Base):
+    # Raw ledger rows of compacted months, moved out of `points`
+    __tablename__ = "points_archive"
+    __table_args__ = (Index("ix_points_archive_user_created", "user_id", "created_at"),)
+    id = Column(Integer, primary_key=True)
+    source_id = Column(Integer)  # points.id it had in the ledger
+    user_id = Column(Integer)
+    category = Column(String)
+    descr = Column(String)
+    pts = Column(Integer)
+    created_at = Column(DateTime)
+    archived_at = Column(DateTime)
+
+class PointsBalance(Base):
+    # Running total per user, kept in step with every Points insert
+    __tablename__ = "points_balance"
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    total = Column(Integer, default=0, index=True)
+    updated_at = Column(DateTime)
+
+class AttendanceMonth(Base):
+    # Per-user monthly rollup, updated in the same transaction as attendance writes
+    __tablename__ = "attendance_month"
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    month = Column(String, primary_key=True, index=True)  # YYYY-MM
+    days_present = Column(Integer, default=0)
+    late_count = Column(Integer, default=0)
+    worked_hours = Column(Float, default=0)
+    paycut_days = Column(Integer, default=0)
+
+class IdempotencyKey(Base):
+    # Result of a completed action, replayed when a client retries with the same key
+    __tablename__ = "idempotency_keys"
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    key = Column(String, primary_key=True)
+    action = Column(String)
+    response = Column(String)  # JSON
+    created_at = Column(DateTime, index=True)
+
+class UploadSession(Base):
+    # Resumable recce upload: chunks land in uploads/.partial/<id> until finalize
+    __tablename__ = "upload_sessions"
+    id = Column(String, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    filename = Column(String)
+    content_type = Column(String)
+    size = Column(Integer)
+    chunk_size = Column(Integer)
+    sha256 = Column(String)  # expected whole-file hash, if the client sent one
+    project = Column(String)
+    notes = Column(String)
+    lat = Column(Float)
+    lng = Column(Float)
+    created_at = Column(DateTime)
+    updated_at = Column(DateTime, index=True)
+    recce_id = Column(Integer)  # set on finalize
+    finalizing_at = Column(DateTime)  # set while finalize reads the file; no chunk writes then
+
+class UploadChunk(Base):
+    __tablename__ = "upload_chunks"
+    session_id = Column(String, ForeignKey("upload_sessions.id"), primary_key=True)
+    idx = Column(Integer, primary_key=True)
+    size = Column(Integer)
+    sha256 = Column(String)
+
+class DataVersion(Base):
+    # Change counter per data scope (e.g. "attendance:2024-05"), bumped by triggers
+    __tablename__ = "data_versions"
+    scope = Column(String, primary_key=True)
+    version = Column(Integer, default=0)
+    changed_at = Column(String)  # UTC, set by the same triggers
+
+class Blob(Base):
+    # One stored upload per distinct content (see storage.py); refs kept by triggers
+    __tablename__ = "blobs"
+    __table_args__ = (Index("ix_blobs_tier_created", "tier", "created_at"),
+                      Index("ix_blobs_refs_touched", "refs", "touched_at"))
+    sha256 = Column(String, primary_key=True)
+    ext = Column(String)
+    size = Column(Integer)
+    content_type = Column(String)
+    refs = Column(Integer, default=0)
+    tier = Column(String, default="hot")  # hot / archive
+    bundle_id = Column(Integer, index=True)
+    offset = Column(Integer)  # archive: byte range of the entry in its bundle
+    length = Column(Integer)
+    method = Column(String)  # archive: store / deflate
+    created_at = Column(DateTime)
+    touched_at = Column(DateTime)
+
+class Bundle(Base):
+    # Archive pack of old blobs on the archive backend, with a .idx.json beside it
+    __tablename__ = "bundles"
+    id = Column(Integer, primary_key=True)
+    key = Column(String)
+    size = Column(Integer)
+    files = Column(Integer)
+    created_at = Column(DateTime)
+
+class Site(Base):
+    # Geofence registry: offices and client locations
+    __tablename__ = "sites"
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    kind = Column(String, default="office")  # office / client
+    lat = Column(Float)
+    lng = Column(Float)
+    radius_m = Column(Float, default=150)
+
+class Job(Base):
+    # Durable background job (see jobs.py); deleted once it has run
+    __tablename__ = "jobs"
+    __table_args__ = (
+        Index("ix_jobs_state_run", "state", "run_at"),
+        Index("ux_jobs_dedupe", "dedupe_key", unique=True),
+    )
+    id = Column(Integer, primary_key=True)
+    kind = Column(String)
+    payload = Column(String)  # JSON
+    state = Column(String, default="queued")  # queued / running / dead
+    attempts = Column(Integer, default=0)
+    run_at = Column(DateTime)
+    lease = Column(String)
+    locked_until = Column(DateTime)
+    last_error = Column(String)
+    dedupe_key = Column(String)  # set while queued: at most one queued job per key
+    created_at = Column(DateTime)
@@ -0,0 +1,113 @@
+from sqlalchemy import text
+from collections import OrderedDict
+from datetime import date, time
+import os, threading
+
+import numpy as np
+
+from . import rollups, versions
+
+# -----------------------------------------------------------------------------
+# Monthly payroll analytics
+#
+# A month's attendance comes back in one query and is loaded into column
+# arrays; every metric is then a bincount over the user index, so the cost is
+# one scan however many staff there are. Every user gets a row, including
+# those with no attendance that month. Closed months are cached in-process
+# under the month's data version (see versions.py): any attendance write in
+# that month bumps the version and the next read recomputes.
+# -----------------------------------------------------------------------------
+def _hhmm(v: str) -> time:
+    h, m = v.split(":")
+    return time(int(h), int(m))
+
+EARLY_LEAVE_BEFORE = _hhmm(os.getenv("EARLY_LEAVE_BEFORE", "18:00"))
+CACHE_MONTHS = 24
+
+COLUMNS = ("user_id", "name", "email", "days_present", "late_days", "paycut_days",
+           "total_hours", "avg_hours", "early_leaves")
+
+_cache = OrderedDict()  # month -> (key, metric columns)
+_lock = threading.Lock()
+
+def month_bounds(month: str):
+    # Raises ValueError for anything that isn't YYYY-MM.
+    y, m = month.split("-")
+    d1 = date(int(y), int(m), 1)
+    d2 = date(d1.year + d1.month // 12, d1.month % 12 + 1, 1)
+    return d1, d2
+
+def _users(d):
+    return d.execute(text("SELECT id, name, email FROM users ORDER BY name, id")).fetchall()
+
+def compute(d, month: str, users):
+    # -> one int/float array per metric, aligned with `users`
+    d1, d2 = month_bounds(month)
+    rows = d.execute(text(
+        "SELECT user_id, COALESCE(status = 'LATE', 0), "
+        "(julianday(cout_ts) - julianday(cin_ts)) * 24, "
+        "(julianday(cout_ts) - julianday(date)) * 86400 "
+        "FROM attendance WHERE date >= :d1 AND date < :d2 AND user_id IS NOT NULL AND cin_ts IS NOT NULL"
+    ), {"d1": d1, "d2": d2}).fetchall()
+
+    ids = np.fromiter((u.id for u in users), dtype=np.int64, count=len(users))
+    n = len(ids)
+    if rows and n:
+        # Plain tuples: numpy probes Row objects as mappings. NULL -> NaN for
+        # days without a check-out.
+        uid, late, hrs, out_s = np.array(list(map(tuple, rows)), dtype=np.float64).reshape(-1, 4).T
+        order = np.argsort(ids)
+        pos = np.minimum(np.searchsorted(ids, uid.astype(np.int64), sorter=order), n - 1)
+        idx = order[pos]
+        known = ids[idx] == uid  # rows of deleted users are dropped
+        idx, late, hrs, out_s = idx[known], late[known], hrs[known], out_s[known]
+        closed = ~np.isnan(hrs)
+        cutoff = EARLY_LEAVE_BEFORE.hour * 3600 + EARLY_LEAVE_BEFORE.minute * 60
+        present = np.bincount(idx, minlength=n)
+        late_days = np.bincount(idx, weights=late, minlength=n).astype(np.int64)
+        total = np.bincount(idx[closed], weights=hrs[closed], minlength=n)
+        worked = np.bincount(idx[closed], minlength=n)
+        early = np.bincount(idx[closed], weights=out_s[closed] < cutoff, minlength=n).astype(np.int64)
+    else:
+        present = late_days = worked = early = np.zeros(n, dtype=np.int64)
+        total = np.zeros(n)
+    avg = np.divide(total, worked, out=np.zeros(n), where=worked > 0)
+    return present, late_days, late_days // rollups.LATES_PER_PAYCUT, total.round(2), avg.round(2), early
+
+def is_closed(month: str) -> bool:
+    return month < rollups.month_key(date.today())
+
+def for_month(d, month: str):
+    # Open months are always computed. Closed ones are cached until their data
+    # version or the set of users changes; names are read fresh every time.
+    # Without the version triggers (versions.ready) nothing is cached.
+    users = _users(d)
+    if not is_closed(month) or not versions.ready:
+        cols = compute(d, month, users)
+    else:
+        key = (versions.get(d, versions.attendance_scope(month)), tuple(u.id for u in users))
+        with _lock:
+            hit = _cache.get(month)
+            if hit and hit[0] == key:
+                _cache.move_to_end(month)
+            else:
+                hit = None
+        if hit:
+            cols = hit[1]
+        else:
+            cols = compute(d, month, users)
+            with _lock:
+                _cache[month] = (key, cols)
+                _cache.move_to_end(month)
+                while len(_cache) > CACHE_MONTHS:
+                    _cache.popitem(last=False)
+    return [
+        dict(zip(COLUMNS, (u.id, u.name, u.email, int(p), int(l), int(c), float(t), float(a), int(e))))
+        for u, p, l, c, t, a, e in zip(users, *cols)
+    ]
+
+def totals(rows):
+    r = {c: sum(x[c] for x in rows) for c in ("days_present", "late_days", "paycut_days", "early_leaves")}
+    r["total_hours"] = round(sum(x["total_hours"] for x in rows), 2)
+    r["staff"] = sum(1 for x in rows if x["days_present"])
+    return r
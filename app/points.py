@@ -0,0 +1,149 @@
+from sqlalchemy import text
+from datetime import date, datetime
+
+# -----------------------------------------------------------------------------
+# Points ledger + running balances
+#
+# `points` stays the append-only ledger; `points_balance` holds one row per
+# user that is bumped in the same transaction as every ledger insert, so
+# reads never have to re-sum the ledger.
+#
+# Closed months are compacted: their rows are folded into `points_month`
+# (one row per user, month and category) and moved to `points_archive`, so
+# `points` only holds the live tail. Totals and history read the snapshots
+# and the tail together; compaction never changes a balance.
+# -----------------------------------------------------------------------------
+def award(d, user_id: int, category: str, descr: str, pts: int, ts: datetime = None):
+    ts = ts or datetime.utcnow()
+    d.execute(
+        text("INSERT INTO points (user_id,category,descr,pts,created_at) VALUES (:u,:c,:d,:p,:t)"),
+        {"u": user_id, "c": category, "d": descr, "p": pts, "t": ts},
+    )
+    d.execute(
+        text(
+            "INSERT INTO points_balance (user_id,total,updated_at) VALUES (:u,:p,:t) "
+            "ON CONFLICT(user_id) DO UPDATE SET total=total+excluded.total, updated_at=excluded.updated_at"
+        ),
+        {"u": user_id, "p": pts, "t": ts},
+    )
+    return pts
+
+def balance(d, user_id: int) -> int:
+    pts = d.execute(text("SELECT total FROM points_balance WHERE user_id=:u"), {"u": user_id}).scalar()
+    return int(pts or 0)
+
+def leaderboard(d, limit: int = 50, offset: int = 0):
+    # Users with no points yet still appear (with 0) at the bottom.
+    return d.execute(
+        text(
+            "SELECT u.id, u.name, COALESCE(b.total,0) AS pts FROM users u "
+            "LEFT JOIN points_balance b ON b.user_id = u.id "
+            "ORDER BY pts DESC, u.name LIMIT :n OFFSET :o"
+        ),
+        {"n": limit, "o": offset},
+    ).fetchall()
+
+def user_count(d) -> int:
+    return int(d.execute(text("SELECT COUNT(*) FROM users")).scalar() or 0)
+
+def rebuild_balances(d):
+    d.execute(text("DELETE FROM points_balance"))
+    d.execute(
+        text(
+            "INSERT INTO points_balance (user_id,total,updated_at) "
+            "SELECT user_id, SUM(pts), :t FROM ("
+            "  SELECT user_id, pts FROM points WHERE user_id IS NOT NULL "
+            "  UNION ALL SELECT user_id, pts FROM points_month"
+            ") GROUP BY user_id"
+        ),
+        {"t": datetime.utcnow()},
+    )
+    d.commit()
+    return int(d.execute(text("SELECT COUNT(*) FROM points_balance")).scalar() or 0)
+
+def ensure_balances(d):
+    # First start after upgrading: backfill balances from the existing ledger.
+    if d.execute(text("SELECT 1 FROM points_balance LIMIT 1")).fetchone():
+        return
+    if d.execute(text("SELECT 1 FROM points LIMIT 1")).fetchone():
+        rebuild_balances(d)
+
+# -----------------------------------------------------------------------------
+# Monthly snapshots and compaction
+# -----------------------------------------------------------------------------
+def _month_start(month: str) -> datetime:
+    return datetime(int(month[:4]), int(month[5:7]), 1)
+
+def _next_month(month: str) -> str:
+    y, m = int(month[:4]), int(month[5:7])
+    return f"{y + m // 12:04d}-{m % 12 + 1:02d}"
+
+def oldest_open(d, before: str = None):
+    # Oldest month, before `before` (default: the current month), that still
+    # has rows in the live ledger; None when everything closed is compacted.
+    before = before or date.today().strftime("%Y-%m")
+    first = d.execute(text("SELECT MIN(created_at) FROM points")).scalar()
+    if first is None:
+        return None
+    month = str(first)[:7]
+    return month if month < before else None
+
+def compact_month(d, month: str):
+    # Folds one month of the ledger into points_month and moves its rows to
+    # points_archive (rows without a user are archived only). The archive
+    # numbers its rows itself and keeps the ledger id as source_id: a drained
+    # `points` table hands out the same ids again. Safe to re-run
+    # when late rows arrive for a month that was already compacted: they are
+    # added to the snapshot. Does not commit. Returns the ledger rows moved.
+    lo, hi = _month_start(month), _month_start(_next_month(month))
+    rng = {"lo": lo, "hi": hi}
+    d.execute(
+        text(
+            "INSERT INTO points_month (user_id, month, category, pts, entries) "
+            "SELECT user_id, :m, COALESCE(category, ''), SUM(pts), COUNT(*) FROM points "
+            "WHERE created_at >= :lo AND created_at < :hi AND user_id IS NOT NULL "
+            "GROUP BY user_id, COALESCE(category, '') "
+            "ON CONFLICT(user_id, month, category) DO UPDATE SET "
+            "pts = pts + excluded.pts, entries = entries + excluded.entries"
+        ),
+        {"m": month, **rng},
+    )
+    d.execute(
+        text(
+            "INSERT INTO points_archive (source_id, user_id, category, descr, pts, created_at, archived_at) "
+            "SELECT id, user_id, category, descr, pts, created_at, :t FROM points "
+            "WHERE created_at >= :lo AND created_at < :hi"
+        ),
+        {"t": datetime.utcnow(), **rng},
+    )
+    return d.execute(
+        text("DELETE FROM points WHERE created_at >= :lo AND created_at < :hi"), rng
+    ).rowcount
+
+def compact(d, before: str = None):
+    # Every closed month, one transaction each. Returns {month: rows moved}.
+    done = {}
+    while (month := oldest_open(d, before)):
+        done[month] = compact_month(d, month)
+        d.commit()
+    return done
+
+def history(d, user_id: int, months: int = 12):
+    # Per month and category, newest first: snapshots for compacted months
+    # plus the live ledger for the rest (a month can have both when late rows
+    # arrive after compaction).
+    t = date.today()
+    k = t.year * 12 + t.month - 1 - (max(months, 1) - 1)
+    since = date(k // 12, k % 12 + 1, 1)
+    rows = d.execute(
+        text(
+            "SELECT month, category, SUM(pts) AS pts, SUM(entries) AS entries FROM ("
+            "  SELECT month, category, pts, entries FROM points_month WHERE user_id=:u AND month >= :m "
+            "  UNION ALL "
+            "  SELECT strftime('%Y-%m', created_at), COALESCE(category, ''), SUM(pts), COUNT(*) FROM points "
+            "  WHERE user_id=:u AND created_at >= :since GROUP BY 1, 2"
+            ") GROUP BY month, category ORDER BY month DESC, category"
+        ),
+        {"u": user_id, "m": since.strftime("%Y-%m"), "since": datetime.combine(since, datetime.min.time())},
+    ).fetchall()
+    return [{"month": r.month, "category": r.category, "pts": int(r.pts), "entries": int(r.entries)} for r in rows]
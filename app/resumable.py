@@ -0,0 +1,143 @@
+from sqlalchemy import text
+from datetime import datetime, timedelta
+import anyio, hashlib, os, uuid
+
+# -----------------------------------------------------------------------------
+# Resumable recce uploads
+#
+# create -> PUT chunk n (any order, in parallel) -> finalize. The session's
+# file is preallocated under uploads/.partial/ and every chunk is written at
+# its own offset (n * chunk_size) with pwrite; the DB tracks which chunks have
+# arrived. A chunk's row is dropped before it is written and recorded again
+# only once its length and SHA-256 check out, so a failed re-send makes it
+# missing again. Finalize marks the session first (begin_finalize), which
+# refuses further chunk writes, so the file it hashes and links into the blob
+# store can no longer change. Nothing is put in the blob store (and no Recce
+# row or points exist) until finalize has seen every chunk. Sessions idle for SESSION_TTL are
+# pruned by the hourly uploads.prune job (tasks.py).
+# -----------------------------------------------------------------------------
+PARTIAL_DIR = "uploads/.partial"
+CHUNK_DEFAULT = 8 * 1024 * 1024
+CHUNK_MIN = 256 * 1024
+CHUNK_MAX = 64 * 1024 * 1024
+SESSION_TTL = timedelta(hours=24)
+
+def partial_path(sid: str) -> str:
+    return os.path.join(PARTIAL_DIR, sid)
+
+def chunk_count(s) -> int:
+    return max((s.size + s.chunk_size - 1) // s.chunk_size, 1)
+
+def chunk_len(s, n: int) -> int:
+    return min(s.chunk_size, s.size - n * s.chunk_size)
+
+def _preallocate(path: str, size: int):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.truncate(size)
+
+def create(d, user_id: int, filename: str, content_type: str, size: int, chunk_size: int,
+           sha256: str = None, project: str = None, notes: str = None, lat: float = None, lng: float = None):
+    sid = uuid.uuid4().hex
+    _preallocate(partial_path(sid), size)  # sparse: no data is written here
+    now = datetime.utcnow()
+    d.execute(
+        text("INSERT INTO upload_sessions (id,user_id,filename,content_type,size,chunk_size,sha256,"
+             "project,notes,lat,lng,created_at,updated_at) VALUES (:id,:u,:f,:ct,:sz,:cs,:sha,:p,:n,:la,:ln,:t,:t)"),
+        {"id": sid, "u": user_id, "f": filename, "ct": content_type, "sz": size, "cs": chunk_size,
+         "sha": sha256, "p": project, "n": notes, "la": lat, "ln": lng, "t": now},
+    )
+    return sid
+
+def get(d, sid: str, user_id: int):
+    return d.execute(text("SELECT * FROM upload_sessions WHERE id=:id AND user_id=:u"),
+                     {"id": sid, "u": user_id}).fetchone()
+
+def received(d, sid: str):
+    return [r.idx for r in d.execute(text("SELECT idx FROM upload_chunks WHERE session_id=:id ORDER BY idx"),
+                                     {"id": sid})]
+
+def begin_chunk(d, sid: str, n: int) -> bool:
+    # Forgets chunk n before it is (re)written, so a write that fails its length
+    # or checksum leaves it missing instead of marked received over changed
+    # bytes. False once finalize has begun.
+    ok = d.execute(text("UPDATE upload_sessions SET updated_at=:t "
+                        "WHERE id=:id AND recce_id IS NULL AND finalizing_at IS NULL"),
+                   {"t": datetime.utcnow(), "id": sid}).rowcount
+    if ok:
+        d.execute(text("DELETE FROM upload_chunks WHERE session_id=:id AND idx=:n"), {"id": sid, "n": n})
+    return bool(ok)
+
+def begin_finalize(d, s):
+    # Stops chunk writes before finalize hashes and links the file. Returns the
+    # chunks still missing; the session is only left marked when there are none.
+    # Writers drop their chunk's row first (begin_chunk), so with nothing
+    # missing none can be mid-write, and none can start once this commits.
+    d.execute(text("UPDATE upload_sessions SET finalizing_at=:t WHERE id=:id AND recce_id IS NULL"),
+              {"t": datetime.utcnow(), "id": s.id})
+    missing = sorted(set(range(chunk_count(s))) - set(received(d, s.id)))
+    if missing:
+        end_finalize(d, s.id)
+    return missing
+
+def end_finalize(d, sid: str):
+    # A finalize that gave up: chunks may be (re)sent again.
+    d.execute(text("UPDATE upload_sessions SET finalizing_at=NULL WHERE id=:id AND recce_id IS NULL"), {"id": sid})
+
+def record_chunk(d, sid: str, n: int, size: int, sha: str):
+    d.execute(
+        text("INSERT INTO upload_chunks (session_id,idx,size,sha256) VALUES (:id,:n,:sz,:sha) "
+             "ON CONFLICT(session_id,idx) DO UPDATE SET size=excluded.size, sha256=excluded.sha256"),
+        {"id": sid, "n": n, "sz": size, "sha": sha},
+    )
+    d.execute(text("UPDATE upload_sessions SET updated_at=:t WHERE id=:id"), {"t": datetime.utcnow(), "id": sid})
+
+async def write_chunk(stream, path: str, offset: int, length: int):
+    # Streams the request body to [offset, offset+length). Returns (bytes, sha256);
+    # a longer body raises OverflowError before anything past the range is written.
+    h, pos = hashlib.sha256(), 0
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        async for piece in stream:
+            if not piece:
+                continue
+            if pos + len(piece) > length:
+                raise OverflowError
+            h.update(piece)
+            await anyio.to_thread.run_sync(os.pwrite, fd, piece, offset + pos)
+            pos += len(piece)
+        await anyio.to_thread.run_sync(os.fsync, fd)
+    finally:
+        os.close(fd)
+    return pos, h.hexdigest()
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def complete(d, sid: str, recce_id: int, sha: str):
+    # Marks the session finalized; False if another finalize got there first.
+    n = d.execute(
+        text("UPDATE upload_sessions SET recce_id=:r, sha256=:sha, updated_at=:t WHERE id=:id AND recce_id IS NULL"),
+        {"r": recce_id, "sha": sha, "t": datetime.utcnow(), "id": sid},
+    ).rowcount
+    d.execute(text("DELETE FROM upload_chunks WHERE session_id=:id"), {"id": sid})
+    return n == 1
+
+def discard(d, sid: str):
+    d.execute(text("DELETE FROM upload_chunks WHERE session_id=:id"), {"id": sid})
+    d.execute(text("DELETE FROM upload_sessions WHERE id=:id"), {"id": sid})
+    if os.path.exists(partial_path(sid)):
+        os.unlink(partial_path(sid))
+
+def prune(d, ttl: timedelta = SESSION_TTL):
+    # Idle sessions (abandoned, or finalized and past their replay window).
+    ids = [r.id for r in d.execute(text("SELECT id FROM upload_sessions WHERE updated_at < :t"),
+                                   {"t": datetime.utcnow() - ttl})]
+    for sid in ids:
+        discard(d, sid)
+    d.commit()
+    return len(ids)
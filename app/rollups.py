@@ -0,0 +1,91 @@
+from sqlalchemy import text
+from datetime import date
+
+# -----------------------------------------------------------------------------
+# Monthly attendance rollups
+#
+# One `attendance_month` row per user per month. Check-in/check-out bump it in
+# the same transaction as the attendance write, so month totals are a primary
+# key lookup instead of a scan over the user's whole attendance history.
+# -----------------------------------------------------------------------------
+LATES_PER_PAYCUT = 4
+
+def month_key(day=None) -> str:
+    day = day or date.today()
+    return day[:7] if isinstance(day, str) else day.strftime("%Y-%m")
+
+# Both writers return the month's (late_count, paycut_days) after the update.
+def record_checkin(d, user_id: int, day, status: str):
+    late = 1 if status == "LATE" else 0
+    row = d.execute(
+        text(
+            "INSERT INTO attendance_month (user_id,month,days_present,late_count,worked_hours,paycut_days) "
+            "VALUES (:u,:m,1,:l,0,:l/:k) "
+            "ON CONFLICT(user_id,month) DO UPDATE SET "
+            "days_present=days_present+1, late_count=late_count+excluded.late_count, "
+            "paycut_days=(late_count+excluded.late_count)/:k "
+            "RETURNING late_count, paycut_days"
+        ),
+        {"u": user_id, "m": month_key(day), "l": late, "k": LATES_PER_PAYCUT},
+    ).fetchone()
+    return int(row.late_count), int(row.paycut_days)
+
+def record_checkout(d, user_id: int, day, hours: float):
+    row = d.execute(
+        text(
+            "INSERT INTO attendance_month (user_id,month,days_present,late_count,worked_hours,paycut_days) "
+            "VALUES (:u,:m,0,0,:h,0) "
+            "ON CONFLICT(user_id,month) DO UPDATE SET worked_hours=worked_hours+excluded.worked_hours "
+            "RETURNING late_count, paycut_days"
+        ),
+        {"u": user_id, "m": month_key(day), "h": hours or 0},
+    ).fetchone()
+    return int(row.late_count), int(row.paycut_days)
+
+def month_lates(d, user_id: int, day):
+    # (late_count, paycut_days) straight from attendance, for responses written
+    # before the queued rollup update has run. A month is at most 31 rows on
+    # ux_attendance_user_date.
+    m = month_key(day)
+    n = d.execute(
+        text("SELECT COUNT(*) FROM attendance WHERE user_id=:u AND date BETWEEN :d1 AND :d2 AND status='LATE'"),
+        {"u": user_id, "d1": m + "-01", "d2": m + "-31"},
+    ).scalar()
+    return int(n), int(n) // LATES_PER_PAYCUT
+
+def company_month(d, month: str = None):
+    row = d.execute(
+        text(
+            "SELECT COUNT(*) AS staff, COALESCE(SUM(days_present),0) AS days_present, "
+            "COALESCE(SUM(late_count),0) AS late_count, COALESCE(SUM(worked_hours),0) AS worked_hours, "
+            "COALESCE(SUM(paycut_days),0) AS paycut_days "
+            "FROM attendance_month WHERE month=:m"
+        ),
+        {"m": month or month_key()},
+    ).fetchone()
+    r = dict(row._mapping)
+    r["month"] = month or month_key()
+    r["worked_hours"] = round(float(r["worked_hours"]), 2)
+    return r
+
+def rebuild(d):
+    d.execute(text("DELETE FROM attendance_month"))
+    d.execute(
+        text(
+            "INSERT INTO attendance_month (user_id,month,days_present,late_count,worked_hours,paycut_days) "
+            "SELECT user_id, strftime('%Y-%m', date), COUNT(cin_ts), SUM(status='LATE'), "
+            "COALESCE(ROUND(SUM((julianday(cout_ts) - julianday(cin_ts)) * 24), 2), 0), "
+            "SUM(status='LATE')/:k "
+            "FROM attendance WHERE user_id IS NOT NULL AND date IS NOT NULL "
+            "GROUP BY user_id, strftime('%Y-%m', date)"
+        ),
+        {"k": LATES_PER_PAYCUT},
+    )
+    d.commit()
+    return int(d.execute(text("SELECT COUNT(*) FROM attendance_month")).scalar() or 0)
+
+def ensure_rollups(d):
+    if d.execute(text("SELECT 1 FROM attendance_month LIMIT 1")).fetchone():
+        return
+    if d.execute(text("SELECT 1 FROM attendance LIMIT 1")).fetchone():
+        rebuild(d)
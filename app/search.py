@@ -0,0 +1,134 @@
+from sqlalchemy import text
+import html, re
+
+# -----------------------------------------------------------------------------
+# Full-text search over recce (project, notes) and daily reports (summary)
+#
+# One SQLite FTS5 table holds both sources. Triggers on recce and reports keep
+# it in step inside the writing transaction, so nothing in the app has to
+# remember to index. Rowids are derived from the source row (reports id*2,
+# recce id*2+1) so updates and deletes hit a single FTS row. Filters (user,
+# day, kind) are UNINDEXED columns checked on the matched rows; ranking is
+# bm25 with project matches weighted above body text.
+# -----------------------------------------------------------------------------
+TABLE = "search_fts"
+PAGE_DEFAULT = 20
+PAGE_MAX = 100
+KINDS = ("recce", "report")
+SNIPPET_TOKENS = 16
+PROJECT_WEIGHT, BODY_WEIGHT = 4.0, 1.0
+
+_MARK_OPEN, _MARK_CLOSE = "\x02", "\x03"  # swapped for <mark> after escaping
+
+DDL = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {TABLE} USING fts5("
+    "kind UNINDEXED, ref_id UNINDEXED, user_id UNINDEXED, day UNINDEXED, project, body, "
+    "tokenize='porter unicode61 remove_diacritics 2')",
+    # recce
+    f"""CREATE TRIGGER IF NOT EXISTS recce_fts_ai AFTER INSERT ON recce BEGIN
+        INSERT INTO {TABLE} (rowid, kind, ref_id, user_id, day, project, body)
+        VALUES (new.id * 2 + 1, 'recce', new.id, new.user_id, date(new.uploaded_at), new.project, new.notes);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS recce_fts_ad AFTER DELETE ON recce BEGIN
+        DELETE FROM {TABLE} WHERE rowid = old.id * 2 + 1;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS recce_fts_au AFTER UPDATE OF user_id, uploaded_at, project, notes ON recce BEGIN
+        DELETE FROM {TABLE} WHERE rowid = old.id * 2 + 1;
+        INSERT INTO {TABLE} (rowid, kind, ref_id, user_id, day, project, body)
+        VALUES (new.id * 2 + 1, 'recce', new.id, new.user_id, date(new.uploaded_at), new.project, new.notes);
+    END""",
+    # reports
+    f"""CREATE TRIGGER IF NOT EXISTS reports_fts_ai AFTER INSERT ON reports BEGIN
+        INSERT INTO {TABLE} (rowid, kind, ref_id, user_id, day, project, body)
+        VALUES (new.id * 2, 'report', new.id, new.user_id, new.report_date, NULL, new.summary);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS reports_fts_ad AFTER DELETE ON reports BEGIN
+        DELETE FROM {TABLE} WHERE rowid = old.id * 2;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS reports_fts_au AFTER UPDATE OF user_id, report_date, summary ON reports BEGIN
+        DELETE FROM {TABLE} WHERE rowid = old.id * 2;
+        INSERT INTO {TABLE} (rowid, kind, ref_id, user_id, day, project, body)
+        VALUES (new.id * 2, 'report', new.id, new.user_id, new.report_date, NULL, new.summary);
+    END""",
+)
+
+ready = False  # set once install() has run in this process
+
+def _has_index(cn) -> bool:
+    return cn.execute(text("SELECT 1 FROM sqlite_master WHERE type='table' AND name=:t"), {"t": TABLE}).first() is not None
+
+def install(cn):
+    # Idempotent; run from migrations. A new index is filled from existing rows.
+    global ready
+    if cn.dialect.name != "sqlite":
+        return False
+    fresh = not _has_index(cn)
+    for stmt in DDL:
+        cn.execute(text(stmt))
+    if fresh:
+        rebuild(cn)
+    ready = True
+    return True
+
+def rebuild(d):
+    d.execute(text(f"DELETE FROM {TABLE}"))
+    d.execute(text(
+        f"INSERT INTO {TABLE} (rowid, kind, ref_id, user_id, day, project, body) "
+        "SELECT id * 2 + 1, 'recce', id, user_id, date(uploaded_at), project, notes FROM recce"
+    ))
+    d.execute(text(
+        f"INSERT INTO {TABLE} (rowid, kind, ref_id, user_id, day, project, body) "
+        "SELECT id * 2, 'report', id, user_id, report_date, NULL, summary FROM reports"
+    ))
+    d.execute(text(f"INSERT INTO {TABLE} ({TABLE}) VALUES ('optimize')"))
+    return d.execute(text(f"SELECT count(*) FROM {TABLE}")).scalar()
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+def to_match(q: str):
+    # Free text -> FTS5 query: every word must appear, the last one as a prefix
+    # (search-as-you-type). Quoting each word keeps FTS syntax out of user input.
+    words = _WORD.findall(q or "")[:16]
+    if not words:
+        return None
+    return " ".join(f'"{w}"' for w in words) + "*"
+
+def _marked(s):
+    if s is None:
+        return None
+    return html.escape(s).replace(_MARK_OPEN, "<mark>").replace(_MARK_CLOSE, "</mark>")
+
+def search(d, q: str, user_id: int = None, d1=None, d2=None, project: str = None, kind: str = None,
+           limit: int = PAGE_DEFAULT, offset: int = 0):
+    match = to_match(q)
+    if not match:
+        return [], False
+    where, params = [f"{TABLE} MATCH :q"], {"q": match, "n": limit + 1, "o": offset}
+    if user_id:
+        where.append("f.user_id = :u")
+        params["u"] = user_id
+    if d1:
+        where.append("f.day >= :d1")
+        params["d1"] = str(d1)
+    if d2:
+        where.append("f.day <= :d2")
+        params["d2"] = str(d2)
+    if project:
+        where.append("f.project = :p COLLATE NOCASE")
+        params["p"] = project
+    if kind:
+        where.append("f.kind = :k")
+        params["k"] = kind
+    rows = d.execute(text(
+        f"SELECT f.kind, f.ref_id, f.user_id, f.day, u.name, "
+        f"highlight({TABLE}, 4, '{_MARK_OPEN}', '{_MARK_CLOSE}') AS project, "
+        f"snippet({TABLE}, 5, '{_MARK_OPEN}', '{_MARK_CLOSE}', '…', {SNIPPET_TOKENS}) AS snippet, "
+        f"bm25({TABLE}, 0, 0, 0, 0, {PROJECT_WEIGHT}, {BODY_WEIGHT}) AS score "
+        f"FROM {TABLE} f JOIN users u ON u.id = f.user_id "
+        f"WHERE {' AND '.join(where)} ORDER BY score LIMIT :n OFFSET :o"
+    ), params).fetchall()
+    more = len(rows) > limit
+    return [{
+        "kind": r.kind, "id": r.ref_id, "user_id": r.user_id, "name": r.name, "date": r.day,
+        "project": _marked(r.project), "snippet": _marked(r.snippet), "score": round(-r.score, 4),
+    } for r in rows[:limit]], more
@@ -1,6 +1,11 @@
 from passlib.context import CryptContext
 from datetime import datetime, timedelta
 from jose import jwt
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+import asyncio, multiprocessing, os, threading, time
+
+from . import metrics
 SECRET='CHANGE_ME'
 ALGO='HS256'
 EXP_MIN=60*24*7
@@ -8,3 +13,116 @@ pwd=CryptContext(schemes=['bcrypt'], deprecated='auto')
 def hash_pw(p): return pwd.hash(p)
 def verify_pw(p,h): return pwd.verify(p,h)
 def make_token(email): return jwt.encode({'sub':email,'exp':datetime.utcnow()+timedelta(minutes=EXP_MIN)}, SECRET, algorithm=ALGO)
+
+# -----------------------------------------------------------------------------
+# bcrypt off the request path
+#
+# Hashing runs in a small dedicated process pool so a burst of logins cannot
+# eat the request threadpool (or the GIL). At most HASH_QUEUE jobs may be
+# running or waiting; beyond that callers get HashBusy and should answer 429.
+# The pool is started and shut down by the app lifespan, with spawned workers:
+# by then the process runs aiosqlite and worker threads, which fork would copy
+# mid-flight. Outside the lifespan (scripts, tests) hashing runs in a thread.
+# -----------------------------------------------------------------------------
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", "2"))
+HASH_QUEUE = int(os.getenv("HASH_QUEUE", "32"))
+
+class HashBusy(Exception):
+    pass
+
+_pool = None
+_inflight = 0
+_pool_lock = threading.Lock()
+
+def start_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=HASH_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+def stop_pool():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+async def _offload(fn, *args):
+    global _inflight
+    with _pool_lock:
+        if _inflight >= HASH_QUEUE:
+            raise HashBusy()
+        _inflight += 1
+    t0 = time.perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_pool, fn, *args)
+    finally:
+        metrics.bcrypt_seconds.observe(time.perf_counter() - t0, op=fn.__name__)
+        with _pool_lock:
+            _inflight -= 1
+
+async def hash_pw_async(p): return await _offload(hash_pw, p)
+async def verify_pw_async(p,h): return await _offload(verify_pw, p, h)
+
+# -----------------------------------------------------------------------------
+# Client address
+#
+# Behind a reverse proxy the peer is the proxy. PROXY_HOPS is how many proxies
+# sit in front of the app (the Dockerfile sets 1, for the hosting proxy). Each
+# appends the address it saw to X-Forwarded-For, so the client is the entry
+# that many places from the right; anything further left is sent by the client
+# and never trusted.
+# -----------------------------------------------------------------------------
+PROXY_HOPS = int(os.getenv("PROXY_HOPS", "0"))
+
+def client_ip(request) -> str:
+    peer = request.client.host if request.client else "-"
+    if PROXY_HOPS <= 0:
+        return peer
+    fwd = [h.strip() for v in request.headers.getlist("x-forwarded-for") for h in v.split(",") if h.strip()]
+    return fwd[-PROXY_HOPS] if len(fwd) >= PROXY_HOPS else peer
+
+# -----------------------------------------------------------------------------
+# Failed-login throttling (checked before any bcrypt work)
+# -----------------------------------------------------------------------------
+class LoginThrottle:
+    # Sliding window of failure timestamps per key ("acct:<email>", "ip:<addr>").
+    def __init__(self, limits: dict, window: float = 15 * 60, max_keys: int = 50000):
+        self.limits, self.window, self.max_keys = limits, window, max_keys
+        self._fails = {}
+        self._lock = threading.Lock()
+
+    def _prune(self, key, now):
+        q = self._fails.get(key)
+        while q and q[0] <= now - self.window:
+            q.popleft()
+        if q is not None and not q:
+            del self._fails[key]
+        return q
+
+    def retry_after(self, **keys) -> int:
+        # Seconds until the caller may try again, 0 if not throttled.
+        now = time.monotonic()
+        wait = 0
+        with self._lock:
+            for kind, val in keys.items():
+                q = self._prune(f"{kind}:{val}", now)
+                if q and len(q) >= self.limits[kind]:
+                    wait = max(wait, int(q[0] + self.window - now) + 1)
+        return wait
+
+    def fail(self, **keys):
+        now = time.monotonic()
+        with self._lock:
+            if len(self._fails) >= self.max_keys:
+                for k in list(self._fails)[: self.max_keys // 10]:
+                    del self._fails[k]
+            for kind, val in keys.items():
+                self._fails.setdefault(f"{kind}:{val}", deque()).append(now)
+
+    def reset(self, **keys):
+        with self._lock:
+            for kind, val in keys.items():
+                self._fails.pop(f"{kind}:{val}", None)
+
+throttle = LoginThrottle({"acct": 5, "ip": 30})
@@ -0,0 +1,527 @@
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from starlette.responses import FileResponse, Response, StreamingResponse
+from collections import namedtuple
+from datetime import datetime, timedelta
+import hashlib, io, json, logging, mimetypes, os, re, shutil, tempfile, uuid, zlib
+
+from .db import SessionLocal
+from . import metrics
+
+log = logging.getLogger("vapp.storage")
+
+# -----------------------------------------------------------------------------
+# Content-addressed upload storage
+#
+# Every upload is stored once per distinct content, as
+# uploads/blobs/<sha[:2]>/<sha[2:4]>/<sha256><ext>. The two shard levels keep
+# each directory to a few hundred files however many photos there are. Rows
+# (attendance photos, recce files) keep pointing at that path. A `blobs` row
+# per content holds its metadata, where it lives, and `refs`, which SQLite
+# triggers keep equal to the number of rows pointing at it.
+#
+# Handlers stream into uploads/blobs/.staging (see uploads.save_upload) and
+# call put() inside their write transaction. put() takes the SQLite write lock
+# before it moves the file into place, and gc() unlinks only while holding
+# that lock, so the two never race. A file put() placed is removed again if
+# the transaction rolls back. Blobs left unreferenced for GC_GRACE are
+# deleted by gc().
+#
+# Tiering: blobs older than ARCHIVE_AFTER_MONTHS are packed into bundles on
+# the archive backend (local directory or any S3-compatible store). Entries
+# are streamed into the bundle, each deflated only when that saves at least
+# COMPRESS_MIN_SAVING. An index of each bundle is written next to it, and the
+# same offsets are kept on the blob rows. The hot copies are then removed.
+# The /uploads path serves both tiers, with single byte-range support, so URLs
+# never change.
+# -----------------------------------------------------------------------------
+BLOB_DIR = "uploads/blobs"
+STAGING_DIR = "uploads/blobs/.staging"
+ARCHIVE = os.getenv("STORAGE_ARCHIVE", "uploads/.archive")  # dir, s3://bucket/prefix or s3+file://dir/bucket
+ARCHIVE_AFTER_MONTHS = int(os.getenv("ARCHIVE_AFTER_MONTHS", "6"))
+BUNDLE_MAX_BYTES = int(os.getenv("BUNDLE_MAX_MB", "256")) * 1024 * 1024
+BUNDLE_MAX_FILES = 5000
+COMPRESS_MIN_SAVING = 0.1
+INCOMPRESSIBLE = ("image/jpeg", "image/png", "image/webp", "image/gif", "video/", "audio/", "application/zip")
+GC_GRACE = timedelta(hours=1)
+GC_BATCH = 1000
+READ_CHUNK = 1024 * 1024
+
+# A finished upload waiting to be put(): path of the file under STAGING_DIR
+# (or elsewhere with keep=True, which links instead of moving it).
+Staged = namedtuple("Staged", "path sha256 size ext content_type keep", defaults=(False,))
+
+_SHA = re.compile(r"^[0-9a-f]{64}$")
+_PLACED = "vapp_placed_blobs"
+
+ops_total = metrics.Counter("vapp_storage_ops_total", "Blob store operations (stored, deduped, archived, collected).")
+metrics.REGISTRY.append(ops_total)
+
+def blob_path(sha: str, ext: str = "") -> str:
+    return f"{BLOB_DIR}/{sha[:2]}/{sha[2:4]}/{sha}{ext}"
+
+def parse(path: str):
+    # uploads/blobs/... path -> (sha256, ext), or None for anything else
+    # (legacy paths, derived images).
+    path = path.lstrip("/")
+    if not path.startswith(BLOB_DIR + "/"):
+        return None
+    name = path.rsplit("/", 1)[-1]
+    sha, ext = name[:64], name[64:]
+    if not _SHA.match(sha) or path != blob_path(sha, ext):
+        return None
+    return sha, ext
+
+# -----------------------------------------------------------------------------
+# Refcounts (SQLite triggers, installed by migrations)
+# -----------------------------------------------------------------------------
+REFS = (("attendance", "cin_photo"), ("attendance", "cout_photo"), ("recce", "filename"))
+
+def _ref(col: str, delta: str):
+    return (f"UPDATE blobs SET refs = refs {delta} 1, touched_at = strftime('%Y-%m-%d %H:%M:%f', 'now') "
+            f"WHERE {col} LIKE '{BLOB_DIR}/%' AND sha256 = substr({col}, {len(BLOB_DIR) + 8}, 64);")
+
+def _triggers():
+    for table in dict.fromkeys(t for t, _ in REFS):
+        cols = [c for t, c in REFS if t == table]
+        yield (f"{table}_blob_ai", f"AFTER INSERT ON {table}", [_ref(f"new.{c}", "+") for c in cols])
+        yield (f"{table}_blob_ad", f"AFTER DELETE ON {table}", [_ref(f"old.{c}", "-") for c in cols])
+        for c in cols:
+            yield (f"{table}_{c}_blob_au", f"AFTER UPDATE OF {c} ON {table} WHEN old.{c} IS NOT new.{c}",
+                   [_ref(f"new.{c}", "+"), _ref(f"old.{c}", "-")])
+
+ready = False  # refcounts are maintained; gc() refuses to run without them
+
+def install(cn):
+    global ready
+    if cn.dialect.name != "sqlite":
+        return False
+    for name, when, body in _triggers():
+        cn.execute(text(f"DROP TRIGGER IF EXISTS {name}"))
+        cn.execute(text(f"CREATE TRIGGER {name} {when} BEGIN {' '.join(body)} END"))
+    ready = True
+    return True
+
+# -----------------------------------------------------------------------------
+# Writing (sync, inside the caller's write transaction)
+# -----------------------------------------------------------------------------
+def put(d, staged) -> str:
+    # staged: uploads.Staged. Returns the path rows should store. The upsert
+    # comes first so the write lock is held before the file is placed.
+    now = datetime.utcnow()
+    row = d.execute(
+        text("INSERT INTO blobs (sha256, ext, size, content_type, refs, tier, created_at, touched_at) "
+             "VALUES (:s, :e, :n, :ct, 0, 'hot', :t, :t) "
+             "ON CONFLICT(sha256) DO UPDATE SET touched_at = excluded.touched_at RETURNING ext, tier"),
+        {"s": staged.sha256, "e": staged.ext, "n": staged.size, "ct": staged.content_type, "t": now},
+    ).fetchone()
+    path = blob_path(staged.sha256, row.ext)
+    if row.tier == "hot" and not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if staged.keep:
+            _link(staged.path, path)
+        else:
+            os.replace(staged.path, path)
+        d.info.setdefault(_PLACED, []).append(path)
+        ops_total.inc(op="stored")
+    else:
+        discard(staged)
+        ops_total.inc(op="deduped")
+    return path
+
+def _link(src: str, dest: str):
+    tmp = f"{os.path.dirname(dest)}/.in-{os.path.basename(dest)}"
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dest)
+
+def discard(staged):
+    # Drops a staged upload that was never (or no longer needs to be) put().
+    if staged and not staged.keep and os.path.exists(staged.path):
+        os.unlink(staged.path)
+
+@event.listens_for(Session, "after_commit")
+def _keep_placed(session):
+    session.info.pop(_PLACED, None)
+
+@event.listens_for(Session, "after_rollback")
+def _drop_placed(session):
+    for path in session.info.pop(_PLACED, ()):
+        if os.path.exists(path):
+            os.unlink(path)
+
+def ingest(d, path: str, content_type: str = None) -> str:
+    # Files an existing local file (legacy uploads/attendance/..., recce/...)
+    # into the store. The original is hard-linked, so it is still there if the
+    # transaction rolls back; the caller removes it after commit.
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(READ_CHUNK), b""):
+            h.update(block)
+    ext = os.path.splitext(path)[1].lower()
+    return put(d, Staged(path, h.hexdigest(), os.path.getsize(path), ext,
+                         content_type or mimetypes.guess_type(path)[0] or "application/octet-stream", True))
+
+LEGACY_BATCH = 500
+
+def migrate_legacy(d):
+    # Rewrites every row still pointing at a pre-store path; returns
+    # (files moved, paths missing on disk). Commits per batch.
+    moved = missing = 0
+    for table, col in REFS:
+        last = 0
+        while True:
+            rows = d.execute(text(f"SELECT id, {col} AS p FROM {table} WHERE {col} IS NOT NULL "
+                                  f"AND {col} NOT LIKE '{BLOB_DIR}/%' AND {col} LIKE 'uploads/%' "
+                                  f"AND id > :last ORDER BY id LIMIT :n"),
+                             {"last": last, "n": LEGACY_BATCH}).fetchall()
+            if not rows:
+                break
+            done = []
+            for r in rows:
+                last = r.id
+                if r.p in done:
+                    continue
+                if not os.path.exists(r.p):
+                    missing += 1
+                    continue
+                new = ingest(d, r.p)
+                d.execute(text(f"UPDATE {table} SET {col}=:new WHERE {col}=:old"), {"new": new, "old": r.p})
+                done.append(r.p)
+            d.commit()
+            for p in done:
+                os.unlink(p)
+            moved += len(done)
+    return moved, missing
+
+# -----------------------------------------------------------------------------
+# Archive backends
+#
+# put_file(key, path), get_range(key, start, end) -> bytes for [start, end),
+# delete(key). S3Backend works with boto3's client or anything with the same
+# put_object/get_object/delete_object calls; LocalS3Client is such a stand-in
+# over a directory, for tests and development.
+# -----------------------------------------------------------------------------
+class LocalBackend:
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, key: str):
+        return os.path.join(self.root, *key.split("/"))
+
+    def put_file(self, key: str, path: str):
+        dest = self._path(key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.copyfile(path, dest + ".tmp")
+        with open(dest + ".tmp", "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(dest + ".tmp", dest)
+
+    def get_range(self, key: str, start: int, end: int) -> bytes:
+        with open(self._path(key), "rb") as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    def delete(self, key: str):
+        if os.path.exists(self._path(key)):
+            os.unlink(self._path(key))
+
+class S3Backend:
+    def __init__(self, client, bucket: str, prefix: str = ""):
+        self.client, self.bucket, self.prefix = client, bucket, prefix.strip("/")
+
+    def _key(self, key: str):
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def put_file(self, key: str, path: str):
+        with open(path, "rb") as f:
+            self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=f)
+
+    def get_range(self, key: str, start: int, end: int) -> bytes:
+        r = self.client.get_object(Bucket=self.bucket, Key=self._key(key), Range=f"bytes={start}-{end - 1}")
+        return r["Body"].read()
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+class LocalS3Client:
+    # The subset of the S3 client API that S3Backend uses, over root/<bucket>/<key>.
+    def __init__(self, root: str):
+        self.files = LocalBackend(root)
+
+    def put_object(self, Bucket, Key, Body):
+        with tempfile.NamedTemporaryFile(delete=False) as tmp:
+            shutil.copyfileobj(Body if hasattr(Body, "read") else io.BytesIO(Body), tmp)
+        try:
+            self.files.put_file(f"{Bucket}/{Key}", tmp.name)
+        finally:
+            os.unlink(tmp.name)
+        return {}
+
+    def get_object(self, Bucket, Key, Range=None):
+        path = self.files._path(f"{Bucket}/{Key}")
+        if not os.path.exists(path):
+            raise KeyError(Key)
+        size = os.path.getsize(path)
+        start, end = 0, size
+        if Range:
+            a, b = Range.removeprefix("bytes=").split("-")
+            start, end = int(a), min(int(b) + 1, size)
+        return {"Body": io.BytesIO(self.files.get_range(f"{Bucket}/{Key}", start, end)),
+                "ContentLength": end - start}
+
+    def delete_object(self, Bucket, Key):
+        self.files.delete(f"{Bucket}/{Key}")
+        return {}
+
+def backend_from_url(url: str):
+    if url.startswith("s3+file://"):
+        root, _, bucket = url.removeprefix("s3+file://").rstrip("/").rpartition("/")
+        return S3Backend(LocalS3Client(root), bucket)
+    if url.startswith("s3://"):
+        import boto3  # optional: only needed for a real S3-compatible archive
+        bucket, _, prefix = url.removeprefix("s3://").partition("/")
+        return S3Backend(boto3.client("s3", endpoint_url=os.getenv("S3_ENDPOINT_URL") or None), bucket, prefix)
+    return LocalBackend(url)
+
+_archive = None
+
+def index_key(key: str) -> str:
+    return key.removesuffix(".pack") + ".idx.json"
+
+def archive():
+    global _archive
+    if _archive is None:
+        _archive = backend_from_url(ARCHIVE)
+    return _archive
+
+# -----------------------------------------------------------------------------
+# Tiering and garbage collection (sync; own sessions, run from a blocking job)
+# -----------------------------------------------------------------------------
+def _compressible(content_type: str) -> bool:
+    return not (content_type or "").startswith(INCOMPRESSIBLE)
+
+def _cutoff(months: int) -> datetime:
+    return datetime.utcnow() - timedelta(days=30 * months)
+
+def _write_entry(out, src: str, compress: bool):
+    # Streams one blob onto the end of the bundle, READ_CHUNK at a time;
+    # returns (length, method). A deflated entry that doesn't save enough is
+    # cut off again and the blob copied as is.
+    start = out.tell()
+    if compress:
+        z, size = zlib.compressobj(6), 0
+        with open(src, "rb") as f:
+            for block in iter(lambda: f.read(READ_CHUNK), b""):
+                size += len(block)
+                out.write(z.compress(block))
+        out.write(z.flush())
+        if out.tell() - start <= size * (1 - COMPRESS_MIN_SAVING):
+            return out.tell() - start, "deflate"
+        out.seek(start)
+        out.truncate()
+    with open(src, "rb") as f:
+        shutil.copyfileobj(f, out, READ_CHUNK)
+    return out.tell() - start, "store"
+
+def pack(d, months: int = None, backend=None) -> int:
+    # Packs one bundle of hot blobs older than `months`; returns how many it
+    # archived (0: nothing left to do).
+    backend = backend or archive()
+    rows = d.execute(
+        text("SELECT sha256, ext, size, content_type FROM blobs WHERE tier='hot' AND refs > 0 "
+             "AND created_at < :c ORDER BY created_at LIMIT :n"),
+        {"c": _cutoff(ARCHIVE_AFTER_MONTHS if months is None else months), "n": BUNDLE_MAX_FILES},
+    ).fetchall()
+    d.rollback()  # no read transaction held while the bundle is built
+    if not rows:
+        return 0
+    entries, total = {}, 0
+    os.makedirs(STAGING_DIR, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=STAGING_DIR, prefix="bundle-")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for r in rows:
+                src = blob_path(r.sha256, r.ext)
+                if not os.path.exists(src):
+                    log.warning("blob %s is missing from the hot tier", r.sha256)
+                    continue
+                length, method = _write_entry(out, src, _compressible(r.content_type))
+                entries[r.sha256] = {"offset": total, "length": length, "method": method,
+                                     "size": r.size, "ext": r.ext, "content_type": r.content_type}
+                total += length
+                if total >= BUNDLE_MAX_BYTES:
+                    break
+            out.flush()
+            os.fsync(out.fileno())
+        if not entries:
+            return 0
+        # Uploaded before the transaction starts: the write lock is only held
+        # for the row updates. A crash in between leaves an unreferenced bundle.
+        now = datetime.utcnow()
+        key = f"bundles/{now:%Y%m}/{uuid.uuid4().hex}.pack"
+        backend.put_file(key, tmp)
+        with open(tmp + ".idx", "w") as f:
+            json.dump({"key": key, "created_at": now.isoformat(), "entries": entries}, f)
+        backend.put_file(index_key(key), tmp + ".idx")
+        bid = d.execute(text("INSERT INTO bundles (key, size, files, created_at) VALUES (:k, :s, :n, :t) "
+                             "RETURNING id"), {"k": key, "s": total, "n": len(entries), "t": now}).scalar()
+        d.execute(
+            text("UPDATE blobs SET tier='archive', bundle_id=:b, offset=:o, length=:l, method=:m "
+                 "WHERE sha256=:s AND tier='hot'"),
+            [{"b": bid, "o": e["offset"], "l": e["length"], "m": e["method"], "s": sha} for sha, e in entries.items()],
+        )
+        d.commit()
+    except BaseException:
+        d.rollback()
+        raise
+    finally:
+        for p in (tmp, tmp + ".idx"):
+            if os.path.exists(p):
+                os.unlink(p)
+    for sha, e in entries.items():
+        p = blob_path(sha, e["ext"])
+        if os.path.exists(p):
+            os.unlink(p)
+    ops_total.inc(len(entries), op="archived")
+    return len(entries)
+
+def gc(d, grace: timedelta = GC_GRACE, backend=None) -> int:
+    # Deletes blobs nothing has pointed at for `grace`, and bundles left with
+    # no live entries. Files go while the write lock is held (see put()).
+    if not ready:
+        return 0
+    backend = backend or archive()
+    rows = d.execute(
+        text("DELETE FROM blobs WHERE sha256 IN (SELECT sha256 FROM blobs WHERE refs <= 0 AND touched_at < :c "
+             "LIMIT :n) RETURNING sha256, ext, tier"),
+        {"c": datetime.utcnow() - grace, "n": GC_BATCH},
+    ).fetchall()
+    for r in rows:
+        p = blob_path(r.sha256, r.ext)
+        if r.tier == "hot" and os.path.exists(p):
+            os.unlink(p)
+    empty = d.execute(text("DELETE FROM bundles WHERE id NOT IN (SELECT bundle_id FROM blobs "
+                           "WHERE bundle_id IS NOT NULL) RETURNING key")).fetchall()
+    d.commit()
+    for b in empty:
+        backend.delete(b.key)
+        backend.delete(index_key(b.key))
+    ops_total.inc(len(rows), op="collected")
+    return len(rows)
+
+def maintain() -> bool:
+    # One gc pass and one bundle; True while there is more to do.
+    d = SessionLocal()
+    try:
+        return gc(d) >= GC_BATCH or pack(d) > 0
+    finally:
+        d.close()
+
+def stats(d):
+    return [dict(r._mapping) for r in d.execute(text(
+        "SELECT tier, COUNT(*) AS blobs, COALESCE(SUM(size), 0) AS bytes, COALESCE(SUM(refs), 0) AS refs "
+        "FROM blobs GROUP BY tier ORDER BY tier"))]
+
+# -----------------------------------------------------------------------------
+# Reading and serving
+# -----------------------------------------------------------------------------
+def _entry(sha: str):
+    d = SessionLocal()
+    try:
+        return d.execute(text("SELECT b.sha256, b.size, b.tier, b.offset, b.length, b.method, n.key "
+                              "FROM blobs b LEFT JOIN bundles n ON n.id = b.bundle_id WHERE b.sha256=:s"),
+                         {"s": sha}).fetchone()
+    finally:
+        d.close()
+
+def _archived(e, start: int, end: int):
+    # Yields [start, end) of an archived blob, READ_CHUNK at a time.
+    backend = archive()
+    if e.method == "store":
+        for pos in range(start, end, READ_CHUNK):
+            yield backend.get_range(e.key, e.offset + pos, e.offset + min(pos + READ_CHUNK, end))
+        return
+    z, pos = zlib.decompressobj(), 0
+    for at in range(0, e.length, READ_CHUNK):
+        raw = z.decompress(backend.get_range(e.key, e.offset + at, e.offset + min(at + READ_CHUNK, e.length)))
+        lo, hi = max(start - pos, 0), min(end - pos, len(raw))
+        if lo < hi:
+            yield raw[lo:hi]
+        pos += len(raw)
+        if pos >= end:
+            return
+
+def open_blob(path: str):
+    # Binary file object for a stored upload in either tier (image derivation).
+    if os.path.exists(path):
+        return open(path, "rb")
+    parsed = parse(path)
+    e = _entry(parsed[0]) if parsed else None
+    if not e or e.tier != "archive":
+        raise FileNotFoundError(path)
+    return io.BytesIO(b"".join(_archived(e, 0, e.size)))
+
+def _range(header: str, size: int):
+    # "bytes=a-b" / "bytes=a-" / "bytes=-n" -> (start, end) half-open; None to
+    # ignore the header (multiple ranges, junk); raises ValueError if unsatisfiable.
+    m = re.fullmatch(r"bytes=(\d*)-(\d*)", (header or "").strip())
+    if not m or m.group(1) == m.group(2) == "":
+        return None
+    if m.group(1) == "":
+        n = int(m.group(2))
+        if n == 0:
+            raise ValueError
+        return max(size - n, 0), size
+    start = int(m.group(1))
+    end = min(int(m.group(2)) + 1, size) if m.group(2) else size
+    if start >= size or end <= start:
+        raise ValueError
+    return start, end
+
+def _local_chunks(path: str, start: int, end: int):
+    with open(path, "rb") as f:
+        f.seek(start)
+        left = end - start
+        while left > 0:
+            b = f.read(min(READ_CHUNK, left))
+            if not b:
+                break
+            left -= len(b)
+            yield b
+
+async def response(rel: str, headers, cache_control: str):
+    # rel: path below /uploads. None when it isn't a stored blob.
+    parsed = parse("uploads/" + rel)
+    if not parsed:
+        return None
+    sha, _ = parsed
+    local = "uploads/" + rel
+    base = {"ETag": f'"{sha}"', "Cache-Control": cache_control, "Accept-Ranges": "bytes"}
+    if headers.get("if-none-match", "").strip() in (f'"{sha}"', f'W/"{sha}"', "*"):
+        return Response(status_code=304, headers=base)
+    media = mimetypes.guess_type(rel)[0] or "application/octet-stream"
+    e = None
+    if os.path.exists(local):
+        size = os.path.getsize(local)
+    else:
+        e = await run_in_threadpool(_entry, sha)
+        if not e or e.tier != "archive":
+            return Response(status_code=404)
+        size = e.size
+    try:
+        rng = _range(headers.get("range"), size) if "range" in headers else None
+    except ValueError:
+        return Response(status_code=416, headers={**base, "Content-Range": f"bytes */{size}"})
+    if rng is None and e is None:
+        return FileResponse(local, media_type=media, headers=base)
+    start, end = rng or (0, size)
+    chunks = _archived(e, start, end) if e is not None else _local_chunks(local, start, end)
+    h = {**base, "Content-Length": str(end - start)}
+    if rng:
+        h["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+    return StreamingResponse(iterate_in_threadpool(chunks), status_code=206 if rng else 200,
+                             media_type=media, headers=h)
@@ -0,0 +1,142 @@
+from sqlalchemy import text
+from datetime import datetime
+import json, logging, os, urllib.request
+
+from .db import SessionLocal
+from . import jobs, points, rollups, images, storage, resumable
+
+log = logging.getLogger("vapp.tasks")
+
+# -----------------------------------------------------------------------------
+# Background job handlers (see jobs.py)
+#
+# The handlers that request code defers work to. Payloads are plain JSON, so
+# dates arrive as ISO strings.
+# -----------------------------------------------------------------------------
+WEBHOOK_URL = os.getenv("NOTIFY_WEBHOOK_URL")  # unset: no notification jobs are queued
+WEBHOOK_TIMEOUT = 10
+
+def _ts(v):
+    return datetime.fromisoformat(v) if v else None
+
+@jobs.handler("points.award")
+def award_points(d, p):
+    points.award(d, p["user_id"], p["category"], p["descr"], p["pts"], _ts(p.get("ts")))
+
+@jobs.handler("rollups.checkin")
+def rollup_checkin(d, p):
+    rollups.record_checkin(d, p["user_id"], p["day"], p["status"])
+
+@jobs.handler("rollups.checkout")
+def rollup_checkout(d, p):
+    rollups.record_checkout(d, p["user_id"], p["day"], p["hours"])
+
+COMPACT_RETRY = 3600
+
+@jobs.handler("points.compact")
+def compact_points(d, p):
+    # One closed month per run, then the next; once caught up it reschedules
+    # itself for just after the next month closes. A month that fails is
+    # rolled back and tried again after COMPACT_RETRY; the follow-up is always
+    # queued, so compaction never stops on a failed job.
+    month = points.oldest_open(d)
+    delay = 0 if month else None
+    if month:
+        try:
+            with d.begin_nested():
+                points.compact_month(d, month)
+        except Exception:
+            log.exception("points compaction of %s failed", month)
+            delay = COMPACT_RETRY
+    schedule_compaction(d, delay)
+
+def schedule_compaction(d, delay: float = None):
+    if delay is None:
+        now = datetime.now()
+        nxt = datetime(now.year + now.month // 12, now.month % 12 + 1, 1, 1, 0)
+        delay = (nxt - now).total_seconds()
+    jobs.enqueue(d, "points.compact", delay=delay, key="points.compact")
+
+# Startup: make sure one job of each periodic kind is queued. Every app
+# worker runs these at once; the dedupe key makes all but the first a no-op.
+def ensure_compaction(d):
+    schedule_compaction(d, 0)
+    d.commit()
+
+STORAGE_INTERVAL = 24 * 3600
+
+@jobs.handler("storage.maintain", blocking=True)
+def maintain_storage(p):
+    # Garbage collection and one archive bundle per run; repeats right away
+    # while there is a backlog, otherwise daily. Runs in a thread with its own
+    # sessions, so the follow-up is queued on one too.
+    more = storage.maintain()
+    d = SessionLocal()
+    try:
+        jobs.enqueue(d, "storage.maintain", delay=0 if more else STORAGE_INTERVAL, key="storage.maintain")
+        d.commit()
+    finally:
+        d.close()
+
+def ensure_storage_maintenance(d):
+    jobs.enqueue(d, "storage.maintain", delay=60, key="storage.maintain")
+    d.commit()
+
+PRUNE_UPLOADS_INTERVAL = 3600
+
+@jobs.handler("uploads.prune", blocking=True)
+def prune_uploads(p):
+    # Abandoned resumable upload sessions and their .partial files; hourly, so
+    # none outlives resumable.SESSION_TTL by much on a long-running server.
+    d = SessionLocal()
+    try:
+        resumable.prune(d)
+        jobs.enqueue(d, "uploads.prune", delay=PRUNE_UPLOADS_INTERVAL, key="uploads.prune")
+        d.commit()
+    finally:
+        d.close()
+
+def ensure_upload_pruning(d):
+    jobs.enqueue(d, "uploads.prune", delay=0, key="uploads.prune")
+    d.commit()
+
+@jobs.handler("images.derive", blocking=True)
+def derive_images(p):
+    images.process(p)
+
+@jobs.handler("notify.webhook", blocking=True)
+def post_webhook(p):
+    req = urllib.request.Request(WEBHOOK_URL, data=json.dumps(p).encode(), method="POST",
+                                 headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=WEBHOOK_TIMEOUT) as r:
+        r.read()
+
+# Enqueue helpers for request code; they join the caller's transaction.
+def award_later(d, user_id: int, category: str, descr: str, pts: int, ts: datetime = None):
+    jobs.enqueue(d, "points.award", {"user_id": user_id, "category": category, "descr": descr, "pts": pts,
+                                     "ts": (ts or datetime.utcnow()).isoformat()})
+    return pts
+
+def balance_with_queued(d, user_id: int) -> int:
+    # points.balance plus the user's awards still in the queue, in one
+    # statement: the award job lands and its row is deleted in one
+    # transaction, so each award is counted exactly once. Dead jobs never land.
+    pts = d.execute(
+        text(
+            "SELECT COALESCE((SELECT total FROM points_balance WHERE user_id=:u), 0) + "
+            "COALESCE((SELECT SUM(json_extract(payload, '$.pts')) FROM jobs "
+            "WHERE state IN ('queued','running') AND kind='points.award' "
+            "AND json_extract(payload, '$.user_id')=:u), 0)"
+        ),
+        {"u": user_id},
+    ).scalar()
+    return int(pts or 0)
+
+def derive_later(d, **job):
+    if images.wanted(job["src"]):
+        jobs.enqueue(d, "images.derive", job)
+
+def notify(d, event: str, user_id: int, **data):
+    if WEBHOOK_URL:
+        jobs.enqueue(d, "notify.webhook", {"event": event, "user_id": user_id,
+                                           "at": datetime.utcnow().isoformat(), **data})
@@ -0,0 +1,261 @@
+from fastapi import HTTPException, Request, UploadFile
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.formparsers import MultiPartException, MultiPartParser, parse_options_header
+import anyio, hashlib, mimetypes, os, re, tempfile
+
+from . import metrics, storage
+
+# -----------------------------------------------------------------------------
+# Upload ingestion
+#
+# Files are streamed chunk by chunk to a temp file in the blob store's staging
+# directory, hashed on the way and fsynced. Handlers only touch the DB once
+# save_upload() has returned, and then file the upload under its content hash
+# with storage.put() in their own transaction (see storage.py), so a
+# half-written upload is never visible.
+#
+# On the routes in UPLOAD_POLICIES that happens while the multipart body is
+# parsed (StagingParser): a file part's declared type is checked as soon as its
+# headers arrive, and its bytes go straight to staging, counted against the
+# limit, instead of being spooled by Starlette and copied again. save_upload()
+# then only fsyncs and claims it; staged parts no handler claimed are removed
+# when the request's form is closed.
+# -----------------------------------------------------------------------------
+CHUNK = 256 * 1024
+MULTIPART_SLACK = 64 * 1024  # form fields + boundaries on top of the file itself
+
+PHOTO_MAX = 15 * 1024 * 1024
+PHOTO_TYPES = ("image/",)
+RECCE_MAX = 250 * 1024 * 1024
+RECCE_TYPES = ("image/", "video/", "application/pdf")
+SYNC_MAX = 400 * 1024 * 1024  # a whole offline batch: photos plus recce files
+SITES_CSV_MAX = 20 * 1024 * 1024
+
+# Request-body limits per upload endpoint, enforced by UploadLimitMiddleware.
+BODY_LIMITS = {
+    "/attendance/checkin": PHOTO_MAX + MULTIPART_SLACK,
+    "/attendance/checkout": PHOTO_MAX + MULTIPART_SLACK,
+    "/recce/upload": RECCE_MAX + MULTIPART_SLACK,
+    "/api/sync": SYNC_MAX + MULTIPART_SLACK,
+    "/admin/sites/import": SITES_CSV_MAX + MULTIPART_SLACK,
+}
+
+# Per-file (max bytes, types) for routes whose file parts are staged while
+# parsing. Sync batches mix photos and recce files; save_upload() narrows it
+# per action.
+UPLOAD_POLICIES = {
+    "/attendance/checkin": (PHOTO_MAX, PHOTO_TYPES),
+    "/attendance/checkout": (PHOTO_MAX, PHOTO_TYPES),
+    "/recce/upload": (RECCE_MAX, RECCE_TYPES),
+    "/api/sync": (RECCE_MAX, RECCE_TYPES),
+}
+
+def _too_large(limit: int):
+    return HTTPException(status_code=413, detail=f"Upload too large (max {limit // (1024 * 1024)} MB)")
+
+class UploadLimitMiddleware:
+    # Rejects oversized bodies from Content-Length before anything is read, and
+    # cuts off chunked/lying clients as soon as they pass the limit.
+    def __init__(self, app, limits: dict = None):
+        self.app = app
+        self.limits = limits or BODY_LIMITS
+
+    async def __call__(self, scope, receive, send):
+        limit = self.limits.get(scope.get("path")) if scope["type"] == "http" else None
+        if limit is None:
+            return await self.app(scope, receive, send)
+
+        cl = dict(scope["headers"]).get(b"content-length")
+        if cl and cl.isdigit() and int(cl) > limit:
+            e = _too_large(limit)
+            return await JSONResponse({"detail": e.detail}, status_code=e.status_code)(scope, receive, send)
+
+        seen = 0
+
+        async def limited_receive():
+            nonlocal seen
+            msg = await receive()
+            if msg["type"] == "http.request":
+                seen += len(msg.get("body", b""))
+                if seen > limit:
+                    raise _too_large(limit)
+            return msg
+
+        await self.app(scope, limited_receive, send)
+
+def check_type(file: UploadFile, types):
+    ct = (file.content_type or "").lower()
+    if not any(ct.startswith(t) for t in types):
+        raise HTTPException(status_code=415, detail=f"Unsupported file type: {ct or 'unknown'}")
+
+def safe_name(filename: str) -> str:
+    name = os.path.basename((filename or "").replace("\\", "/")).strip()
+    return "".join(ch if ch.isalnum() or ch in "._-" else "_" for ch in name) or "upload"
+
+def extension(filename: str, content_type: str) -> str:
+    ext = os.path.splitext(safe_name(filename))[1].lower()
+    if re.fullmatch(r"\.[a-z0-9]{1,8}", ext):
+        return ext
+    return mimetypes.guess_extension(content_type or "") or ""
+
+# -----------------------------------------------------------------------------
+# Staging while parsing
+# -----------------------------------------------------------------------------
+class StagedUpload(UploadFile):
+    # A file part written to `path` under STAGING_DIR as it arrived.
+    def __init__(self, path: str, file, max_bytes: int, **kw):
+        super().__init__(file, size=0, **kw)
+        self.path, self.max_bytes, self.claimed = path, max_bytes, False
+        self._h = hashlib.sha256()
+
+    @property
+    def sha256(self) -> str:
+        return self._h.hexdigest()
+
+    async def write(self, data: bytes):
+        if self.size + len(data) > self.max_bytes:
+            raise _too_large(self.max_bytes)
+        self._h.update(data)
+        await super().write(data)
+
+    async def close(self):
+        await super().close()
+        if not self.claimed and os.path.exists(self.path):
+            os.unlink(self.path)
+
+class StagingParser(MultiPartParser):
+    def __init__(self, headers, stream, policy, **kw):
+        super().__init__(headers, stream, **kw)
+        self.max_bytes, self.types = policy
+        self.staged = []
+
+    def on_headers_finished(self):
+        super().on_headers_finished()
+        part = self._current_part
+        if part.file is None:
+            return
+        self._files_to_close_on_error.pop().close()  # the spooled file super() opened
+        check_type(part.file, self.types)
+        os.makedirs(storage.STAGING_DIR, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=storage.STAGING_DIR, prefix="up-")
+        part.file = StagedUpload(tmp, os.fdopen(fd, "w+b"), self.max_bytes,
+                                 filename=part.file.filename, headers=part.file.headers)
+        self.staged.append(part.file)
+
+    async def parse(self):
+        try:
+            return await super().parse()
+        except BaseException:
+            for f in self.staged:
+                await f.close()
+            raise
+
+class StagingRequest(Request):
+    async def _get_form(self, *, max_files: int | float = 1000, max_fields: int | float = 1000):
+        policy = UPLOAD_POLICIES.get(self.scope.get("path"))
+        if self._form is None and policy:
+            ct, _ = parse_options_header(self.headers.get("Content-Type"))
+            if ct == b"multipart/form-data":
+                parser = StagingParser(self.headers, self.stream(), policy, max_files=max_files, max_fields=max_fields)
+                try:
+                    self._form = await parser.parse()
+                except MultiPartException as exc:
+                    raise HTTPException(status_code=400, detail=exc.message)
+        return await super()._get_form(max_files=max_files, max_fields=max_fields)
+
+class UploadRoute(APIRoute):
+    # Route class for the app: handlers get a StagingRequest, and its form
+    # (with any unclaimed staged files) is closed once the handler returns.
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def staging_handler(request: Request):
+            request = StagingRequest(request.scope, request.receive)
+            try:
+                return await handler(request)
+            finally:
+                await request.close()
+        return staging_handler
+
+def _fsync(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+async def _copy(file: UploadFile, max_bytes: int):
+    # Files that weren't staged while parsing: stream them into staging here.
+    os.makedirs(storage.STAGING_DIR, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=storage.STAGING_DIR, prefix="up-")
+    h, size = hashlib.sha256(), 0
+    try:
+        async with await anyio.open_file(fd, "wb") as f:
+            while True:
+                chunk = await file.read(CHUNK)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise _too_large(max_bytes)
+                h.update(chunk)
+                await f.write(chunk)
+            await f.flush()
+            await anyio.to_thread.run_sync(os.fsync, f.wrapped.fileno())
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return tmp, h.hexdigest(), size
+
+# Returns a storage.Staged; `kind` labels the upload metrics, `ext` overrides
+# the extension taken from the client's filename.
+async def save_upload(file: UploadFile, kind: str, max_bytes: int, types, ext: str = None):
+    check_type(file, types)
+    if isinstance(file, StagedUpload):
+        if file.size > max_bytes:
+            raise _too_large(max_bytes)
+        await anyio.to_thread.run_sync(_fsync, file.file)
+        file.claimed = True
+        tmp, sha, size = file.path, file.sha256, file.size
+    else:
+        tmp, sha, size = await _copy(file, max_bytes)
+    metrics.uploads_total.inc(kind=kind)
+    metrics.upload_bytes_total.inc(size, kind=kind)
+    ct = (file.content_type or "").lower()
+    return storage.Staged(tmp, sha, size, ext or extension(file.filename, ct), ct)
+
+# -----------------------------------------------------------------------------
+# Serving
+# -----------------------------------------------------------------------------
+IMMUTABLE_PREFIXES = ("thumbs/", "display/", "blobs/")
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+class UploadFiles(StaticFiles):
+    # FileResponse already sends ETag/Last-Modified and StaticFiles answers
+    # If-None-Match with 304; this adds Cache-Control. Stored blobs and derived
+    # images are named by content hash and never change, legacy originals must
+    # be revalidated. Blobs are served by storage.response() from whichever
+    # tier holds them, with Range support.
+    async def get_response(self, path, scope):
+        if scope["method"] in ("GET", "HEAD"):
+            resp = await storage.response(path.replace(os.sep, "/"), Headers(scope=scope), IMMUTABLE)
+            if resp is not None:
+                return resp
+        return await super().get_response(path, scope)
+
+    def lookup_path(self, path):
+        # Dot-names are never served: in-progress uploads live in uploads/.partial/
+        # and uploads/blobs/.staging/, archive bundles in uploads/.archive/.
+        if any(p.startswith(".") for p in path.replace(os.sep, "/").split("/")):
+            return "", None
+        return super().lookup_path(path)
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        resp = super().file_response(full_path, stat_result, scope, status_code)
+        rel = os.path.relpath(full_path, self.directory).replace(os.sep, "/")
+        if rel.startswith(IMMUTABLE_PREFIXES):
+            resp.headers["Cache-Control"] = IMMUTABLE
+        else:
+            resp.headers["Cache-Control"] = "private, no-cache"
+        return resp
@@ -0,0 +1,93 @@
+from sqlalchemy import text
+
+# -----------------------------------------------------------------------------
+# Data versions
+#
+# `data_versions` keeps a counter per scope that triggers bump whenever rows in
+# that scope change, inside the writing transaction, along with the time of the
+# change. Anything derived from a scope (cached reports, ETags) can be reused
+# for as long as the counter it was built from is unchanged.
+#
+# attendance:YYYY-MM    attendance facts of a month; updates that only touch
+#                       derived columns (images, geofence) do not count
+# day:YYYY-MM-DD        anything shown for that date's attendance rows
+# user:<id>             a user's attendance rows, monthly rollup, balance, profile
+# rollups:YYYY-MM       attendance_month rows of a month
+# points, users, sites  the leaderboard, the user list, the sites registry
+#
+# Triggers are dropped and re-created on every start so edits here take
+# effect on the next deploy. They exist only on SQLite: until install() has run
+# in this process `ready` is False, and everything cached by version (ETags,
+# fragments, payroll, the site index) is bypassed rather than served stale.
+# -----------------------------------------------------------------------------
+def _bump(scope_sql: str):
+    # Rows with a NULL date or user_id have no scope and bump nothing.
+    return ("INSERT INTO data_versions (scope, version, changed_at) "
+            f"SELECT {scope_sql}, 1, strftime('%Y-%m-%d %H:%M:%f', 'now') WHERE {scope_sql} IS NOT NULL "
+            "ON CONFLICT(scope) DO UPDATE SET version = version + 1, changed_at = excluded.changed_at;")
+
+def _month(row: str):
+    return f"'attendance:' || strftime('%Y-%m', {row}.date)"
+
+def _day(row: str):
+    return f"'day:' || {row}.date"
+
+def _user(row: str):
+    return f"'user:' || {row}.user_id"
+
+TRIGGERS = {
+    "attendance_ver_ai": ("AFTER INSERT ON attendance", [_month("new")]),
+    "attendance_ver_ad": ("AFTER DELETE ON attendance", [_month("old")]),
+    "attendance_ver_au": ("AFTER UPDATE OF user_id, date, cin_ts, cout_ts, status ON attendance",
+                          [_month("new"), _month("old")]),
+    "attendance_view_ai": ("AFTER INSERT ON attendance", [_day("new"), _user("new")]),
+    "attendance_view_ad": ("AFTER DELETE ON attendance", [_day("old"), _user("old")]),
+    "attendance_view_au": ("AFTER UPDATE ON attendance", [_day("new"), _day("old"), _user("new"), _user("old")]),
+    "rollups_ver_ai": ("AFTER INSERT ON attendance_month", ["'rollups:' || new.month", _user("new")]),
+    "rollups_ver_ad": ("AFTER DELETE ON attendance_month", ["'rollups:' || old.month", _user("old")]),
+    "rollups_ver_au": ("AFTER UPDATE ON attendance_month", ["'rollups:' || new.month", _user("new")]),
+    "balance_ver_ai": ("AFTER INSERT ON points_balance", ["'points'", _user("new")]),
+    "balance_ver_ad": ("AFTER DELETE ON points_balance", ["'points'"]),
+    "balance_ver_au": ("AFTER UPDATE ON points_balance", ["'points'", _user("new")]),
+    "users_ver_ai": ("AFTER INSERT ON users", ["'users'"]),
+    "users_ver_ad": ("AFTER DELETE ON users", ["'users'"]),
+    "users_ver_au": ("AFTER UPDATE OF name, email, role ON users", ["'users'", "'user:' || new.id"]),
+    "sites_ver_ai": ("AFTER INSERT ON sites", ["'sites'"]),
+    "sites_ver_ad": ("AFTER DELETE ON sites", ["'sites'"]),
+    "sites_ver_au": ("AFTER UPDATE ON sites", ["'sites'"]),
+}
+
+ready = False  # set once install() has run in this process
+
+def install(cn):
+    global ready
+    if cn.dialect.name != "sqlite":
+        return False
+    for name, (when, scopes) in TRIGGERS.items():
+        cn.execute(text(f"DROP TRIGGER IF EXISTS {name}"))
+        cn.execute(text(f"CREATE TRIGGER {name} {when} BEGIN {' '.join(map(_bump, dict.fromkeys(scopes)))} END"))
+    ready = True
+    return True
+
+def attendance_scope(month: str) -> str:
+    return f"attendance:{month}"
+
+def day_scope(day) -> str:
+    return f"day:{day}"
+
+def user_scope(user_id: int) -> str:
+    return f"user:{user_id}"
+
+def rollup_scope(month: str) -> str:
+    return f"rollups:{month}"
+
+def get(d, scope: str) -> int:
+    return int(d.execute(text("SELECT version FROM data_versions WHERE scope=:s"), {"s": scope}).scalar() or 0)
+
+def many(d, scopes):
+    # scope -> (version, changed_at or None); scopes never written are (0, None).
+    keys = {f"s{n}": s for n, s in enumerate(scopes)}
+    rows = d.execute(text(f"SELECT scope, version, changed_at FROM data_versions "
+                          f"WHERE scope IN ({', '.join(':' + k for k in keys)})"), keys).fetchall()
+    found = {r.scope: (int(r.version), r.changed_at) for r in rows}
+    return {s: found.get(s, (0, None)) for s in scopes}
@@ -0,0 +1,207 @@
+import argparse, asyncio, io, json, os, platform, subprocess, sys, tempfile, time
+from datetime import date, datetime, timedelta
+
+# -----------------------------------------------------------------------------
+# Offline load test
+#
+#   python -m bench.run --users 500 --months 6 --concurrency 32 --out bench.json
+#   python -m bench.run ... --compare previous.json
+#
+# Builds a synthetic org in a scratch directory, imports the app against it and
+# drives the hot endpoints through an in-process ASGI client (no network, no
+# server). Each scenario runs on its own so SQL statement counts can be
+# attributed to it. Results are JSON so runs can be diffed.
+# -----------------------------------------------------------------------------
+def _setup(workdir: str):
+    # The app builds its engine and upload paths at import time, so point it at
+    # the scratch directory first.
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def _photo():
+    try:
+        from PIL import Image
+        b = io.BytesIO()
+        Image.new("RGB", (1280, 960), (120, 140, 160)).save(b, "JPEG", quality=85)
+        return b.getvalue()
+    except ImportError:
+        return b"\xff\xd8\xff\xe0" + b"\0" * 200_000
+
+def _pct(xs, p):
+    if not xs:
+        return None
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, max(0, int(round(p / 100 * len(xs))) - 1))]
+
+class SqlCounter:
+    # Statements run on behalf of a request only (the metrics middleware's
+    # context is set); job workers running alongside a scenario don't count.
+    def __init__(self, *engines):
+        from sqlalchemy import event
+        self.n = 0
+        for e in engines:
+            event.listen(getattr(e, "sync_engine", e), "before_cursor_execute", self._hit)
+
+    def _hit(self, *a):
+        from app import metrics
+        if metrics._current.get() is not None:
+            self.n += 1
+
+async def _scenario(app, name, reqs, concurrency, sql):
+    import httpx
+    lat, errors = [], 0
+    q = asyncio.Queue()
+    for r in reqs:
+        q.put_nowait(r)
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+
+    async def worker():
+        nonlocal errors
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as c:
+            while True:
+                try:
+                    method, url, kw = q.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                t0 = time.perf_counter()
+                r = await c.request(method, url, **kw)
+                await r.aread()
+                lat.append((time.perf_counter() - t0) * 1000)
+                if r.status_code >= 400:
+                    errors += 1
+
+    sql.n = 0
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - t0
+    return {
+        "requests": len(lat),
+        "errors": errors,
+        "concurrency": concurrency,
+        "wall_s": round(wall, 3),
+        "throughput_rps": round(len(lat) / wall, 1) if wall else None,
+        "mean_ms": round(sum(lat) / len(lat), 2) if lat else None,
+        "p50_ms": round(_pct(lat, 50), 2) if lat else None,
+        "p95_ms": round(_pct(lat, 95), 2) if lat else None,
+        "p99_ms": round(_pct(lat, 99), 2) if lat else None,
+        "sql_per_request": round(sql.n / len(lat), 2) if lat else None,
+    }
+
+async def _run_all(app, scenarios, concurrency, sql):
+    # One event loop for every scenario, so the async connection pool is opened
+    # once (as in a running server) rather than per scenario.
+    from app import jobs
+    from app.db import async_engine, warm_pool
+    await warm_pool()
+    jobs.start()
+    results = {}
+    try:
+        for name, reqs in scenarios.items():
+            results[name] = r = await _scenario(app, name, reqs, concurrency, sql)
+            await jobs.drain()  # queued side effects land before the next scenario
+            print(f"{name:<18} n={r['requests']:<5} err={r['errors']:<3} p50={r['p50_ms']}ms "
+                  f"p95={r['p95_ms']}ms p99={r['p99_ms']}ms {r['throughput_rps']} req/s "
+                  f"{r['sql_per_request']} sql/req")
+    finally:
+        await jobs.stop()
+        await async_engine.dispose()
+    return results
+
+def _git_rev():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(__file__), stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def _compare(cur, old_path):
+    old = json.load(open(old_path))
+    print(f"\n{'scenario':<18}{'metric':<16}{'before':>10}{'after':>10}{'change':>9}")
+    for name, r in cur["scenarios"].items():
+        o = old.get("scenarios", {}).get(name)
+        if not o:
+            continue
+        for m in ("p50_ms", "p95_ms", "p99_ms", "throughput_rps", "sql_per_request"):
+            a, b = o.get(m), r.get(m)
+            if a is None or b is None:
+                continue
+            ch = f"{(b - a) / a * 100:+.0f}%" if a else "-"
+            print(f"{name:<18}{m:<16}{a:>10}{b:>10}{ch:>9}")
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog="python -m bench.run")
+    ap.add_argument("--users", type=int, default=200)
+    ap.add_argument("--months", type=int, default=3)
+    ap.add_argument("--concurrency", type=int, default=16)
+    ap.add_argument("--requests", type=int, default=200, help="requests per read scenario")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--workdir", default=None)
+    ap.add_argument("--out", default="bench_results.json")
+    ap.add_argument("--compare", default=None, help="previous results JSON to diff against")
+    args = ap.parse_args(argv)
+
+    out = os.path.abspath(args.out)
+    _setup(os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="vapp-bench-")))
+
+    from app.main import app
+    from app.db import engine, async_engine, SessionLocal
+    from app.security import make_token
+    from app import points, rollups
+    from bench import synth
+
+    t0 = time.perf_counter()
+    first, n = synth.generate(engine, users=args.users, months=args.months, seed=args.seed)
+    d = SessionLocal()
+    try:
+        points.rebuild_balances(d)
+        rollups.rebuild(d)
+    finally:
+        d.close()
+    setup_s = time.perf_counter() - t0
+
+    ids = list(range(first, first + n))
+    tok = {uid: make_token(f"user{uid - first}@bench.local") for uid in ids}
+    admin = {"cookies": {"t": tok[first]}}
+    photo = _photo()
+    today = date.today()
+    month_ago = (today - timedelta(days=30)).isoformat()
+    jh = {"accept": "application/json"}
+
+    def as_user(uid, **kw):
+        return {"cookies": {"t": tok[uid]}, **kw}
+
+    scenarios = {
+        "checkin": [("POST", "/attendance/checkin",
+                     as_user(uid, headers=jh, data={"lat": "19.07", "lng": "72.87"},
+                             files={"file": ("in.jpg", photo, "image/jpeg")})) for uid in ids],
+        "attendance_today": [("GET", "/attendance/today", as_user(ids[k % n])) for k in range(args.requests)],
+        "admin": [("GET", "/admin", admin) for _ in range(args.requests)],
+        "admin_attendance": [("GET", f"/admin/attendance?dt={(today - timedelta(days=1 + k % 20)).isoformat()}", admin)
+                             for k in range(args.requests)],
+        "export_month": [("GET", f"/admin/attendance/export?from={month_ago}&to={today.isoformat()}", admin)
+                         for _ in range(max(args.requests // 20, 3))],
+    }
+
+    sql = SqlCounter(engine, async_engine)
+    results = asyncio.run(_run_all(app, scenarios, args.concurrency, sql))
+
+    doc = {
+        "meta": {
+            "timestamp": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+            "git": _git_rev(),
+            "python": platform.python_version(),
+            "users": args.users, "months": args.months, "seed": args.seed,
+            "concurrency": args.concurrency, "setup_s": round(setup_s, 2),
+        },
+        "scenarios": results,
+    }
+    with open(out, "w") as f:
+        json.dump(doc, f, indent=2)
+    print(f"wrote {out}")
+    if args.compare:
+        _compare(doc, args.compare)
+
+if __name__ == "__main__":
+    main()
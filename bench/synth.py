@@ -0,0 +1,76 @@
+from sqlalchemy import text
+from datetime import date, datetime, timedelta
+import random
+
+# -----------------------------------------------------------------------------
+# Synthetic organisation generator
+#
+# N users with M months of attendance history (Mon-Sat, some late, some absent),
+# the matching points ledger, daily reports and occasional recce uploads.
+# Everything is bulk inserted; derived tables are rebuilt afterwards so the
+# database looks like a long-running deployment. Today is left empty so the
+# benchmark can check people in.
+# -----------------------------------------------------------------------------
+ABSENT_RATE = 0.05
+LATE_RATE = 0.12
+REPORT_RATE = 0.7
+RECCE_RATE = 0.08
+BATCH = 5000
+
+def _days(months: int, today: date):
+    d = today - timedelta(days=30 * months)
+    while d < today:
+        if d.weekday() <= 5:
+            yield d
+        d += timedelta(days=1)
+
+def _flush(cn, sql, rows):
+    if rows:
+        cn.execute(text(sql), rows)
+        rows.clear()
+
+def _flush_all(cn, att, pts, reps, rec):
+    _flush(cn, "INSERT INTO attendance (user_id,date,cin_ts,cout_ts,status,cin_lat,cin_lng,cout_lat,cout_lng,cin_photo,cout_photo) "
+               "VALUES (:u,:d,:i,:o,:s,:la,:ln,:la,:ln,:pi,:po)", att)
+    _flush(cn, "INSERT INTO points (user_id,category,descr,pts,created_at) VALUES (:u,:c,:d,:p,:t)", pts)
+    _flush(cn, "INSERT INTO reports (user_id,report_date,summary,created_at) VALUES (:u,:d,:s,:t)", reps)
+    _flush(cn, "INSERT INTO recce (user_id,uploaded_at,project,notes,filename) VALUES (:u,:t,:p,:n,:f)", rec)
+
+def generate(engine, users: int = 200, months: int = 3, seed: int = 1, password_hash: str = None):
+    rnd = random.Random(seed)
+    today = date.today()
+    # One precomputed hash: bcrypt per synthetic user would dominate setup time.
+    pw = password_hash or "$2b$12$" + "x" * 53
+    with engine.begin() as cn:
+        first = int(cn.execute(text("SELECT COALESCE(MAX(id),0) FROM users")).scalar()) + 1
+        cn.execute(
+            text("INSERT INTO users (id,name,email,hashed_password,role) VALUES (:i,:n,:e,:h,:r)"),
+            [{"i": first + k, "n": f"User {k:05d}", "e": f"user{k}@bench.local", "h": pw,
+              "r": "admin" if k == 0 else "user"} for k in range(users)],
+        )
+        att, pts, reps, rec = [], [], [], []
+        for day in _days(months, today):
+            for uid in range(first, first + users):
+                if rnd.random() < ABSENT_RATE:
+                    continue
+                late = rnd.random() < LATE_RATE
+                cin = datetime.combine(day, datetime.min.time()) + timedelta(
+                    hours=10, minutes=rnd.randint(31, 90) if late else rnd.randint(0, 30))
+                cout = cin + timedelta(hours=rnd.uniform(6, 10))
+                att.append({"u": uid, "d": day, "i": cin, "o": cout, "s": "LATE" if late else "PRESENT",
+                            "la": 19.07 + rnd.uniform(-0.05, 0.05), "ln": 72.87 + rnd.uniform(-0.05, 0.05),
+                            "pi": f"uploads/attendance/{uid}_{day}_in.jpg",
+                            "po": f"uploads/attendance/{uid}_{day}_out.jpg"})
+                pts.append({"u": uid, "c": "ATTENDANCE", "d": "Check-in", "p": -5 if late else 10, "t": cin})
+                pts.append({"u": uid, "c": "ATTENDANCE", "d": "Check-out", "p": 10, "t": cout})
+                if rnd.random() < REPORT_RATE:
+                    reps.append({"u": uid, "d": day, "s": f"Visited site {rnd.randint(1, 500)}; follow-ups pending", "t": cout})
+                    pts.append({"u": uid, "c": "REPORT", "d": "Daily report", "p": 10, "t": cout})
+                if rnd.random() < RECCE_RATE:
+                    rec.append({"u": uid, "t": cin + timedelta(hours=3), "p": f"Project {rnd.randint(1, 80)}",
+                                "n": "Site measurements and photos", "f": f"uploads/recce/{uid}_{day}.jpg"})
+                    pts.append({"u": uid, "c": "RECCE", "d": "Recce upload", "p": 15, "t": cin})
+            if len(att) >= BATCH:
+                _flush_all(cn, att, pts, reps, rec)
+        _flush_all(cn, att, pts, reps, rec)
+    return first, users
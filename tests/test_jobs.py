@@ -0,0 +1,139 @@
+import os, tempfile
+
+_tmp = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = f"sqlite:///{_tmp}/test.db"
+
+import asyncio
+from datetime import datetime, timedelta
+from sqlalchemy import text
+
+from app import models, migrations, points, jobs
+from app.db import engine, async_engine, SessionLocal
+
+migrations.run(engine)
+
+@jobs.handler("test.award")
+def _award(d, p):
+    points.award(d, 1, "TEST", p.get("descr", ""), p.get("pts", 1))
+
+@jobs.handler("test.fail")
+def _fail(d, p):
+    raise RuntimeError("boom")
+
+@jobs.handler("test.file", blocking=True)
+def _file(p):
+    pass
+
+def _session():
+    d = SessionLocal()
+    for t in ("points", "points_balance", "jobs", "users"):
+        d.execute(text(f"DELETE FROM {t}"))
+    d.execute(text("INSERT INTO users (id, name, email) VALUES (1, 'a', 'a@example.com')"))
+    d.commit()
+    return d
+
+def _run(coro):
+    async def go():
+        try:
+            return await coro
+        finally:
+            await async_engine.dispose()
+    return asyncio.run(go())
+
+def _claim(d, lease, limit=jobs.BATCH, blocking=False):
+    # As run_once does: the claim is committed before the jobs run.
+    batch = jobs.claim(d, lease, limit, blocking)
+    d.commit()
+    return batch
+
+def _jobs(d):
+    return d.execute(text("SELECT kind, state, attempts, run_at, last_error FROM jobs ORDER BY id")).fetchall()
+
+def test_expired_lease_is_reclaimed_once():
+    d = _session()
+    jobs.enqueue(d, "test.award", {"pts": 10})
+    d.commit()
+    batch = _claim(d, "a")
+    assert [j.kind for j in batch] == ["test.award"]
+    assert _claim(d, "b") == []  # still leased
+
+    d.execute(text("UPDATE jobs SET locked_until=:t"), {"t": datetime.utcnow() - timedelta(seconds=1)})
+    d.commit()
+    assert _run(jobs.run_once()) == 1
+    # The first worker comes back late: its lease is gone, so nothing runs twice.
+    jobs.finish(d, batch, "a", {})
+    assert points.balance(d, 1) == 10
+    assert _jobs(d) == []
+    d.close()
+
+def test_failure_is_retried_with_backoff():
+    d = _session()
+    jobs.enqueue(d, "test.fail")
+    d.commit()
+    batch = _claim(d, "a")
+    jobs.finish(d, batch, "a", {})
+
+    [job] = _jobs(d)
+    assert (job.state, job.attempts) == ("queued", 1)
+    assert "RuntimeError: boom" in job.last_error
+    assert datetime.fromisoformat(str(job.run_at)) > datetime.utcnow()
+    assert _claim(d, "b") == []  # not due yet
+    d.close()
+
+def test_dead_after_max_attempts_and_retry_dead(monkeypatch):
+    d = _session()
+    monkeypatch.setattr(jobs, "MAX_ATTEMPTS", 2)
+    jobs.enqueue(d, "test.fail")
+    jobs.enqueue(d, "test.gone")  # no handler: dead straight away
+    d.commit()
+    for lease in ("a", "b"):
+        d.execute(text("UPDATE jobs SET run_at=:t WHERE state='queued'"), {"t": datetime.utcnow()})
+        d.commit()
+        jobs.finish(d, _claim(d, lease), lease, {})
+    assert [(j.kind, j.state, j.attempts) for j in _jobs(d)] == [("test.fail", "dead", 2), ("test.gone", "dead", 1)]
+    assert jobs.pending(d, "test.fail") == 0
+
+    assert jobs.retry_dead(d) == 2
+    assert [(j.state, j.attempts) for j in _jobs(d)] == [("queued", 0), ("queued", 0)]
+    d.close()
+
+def test_failing_job_does_not_undo_its_batch():
+    d = _session()
+    jobs.enqueue(d, "test.award", {"descr": "first", "pts": 3})
+    jobs.enqueue(d, "test.fail")
+    jobs.enqueue(d, "test.award", {"descr": "second", "pts": 4})
+    d.commit()
+    batch = _claim(d, "a")
+    assert len(batch) == 3
+    jobs.finish(d, batch, "a", {})
+
+    assert points.balance(d, 1) == 7
+    assert [(j.kind, j.state) for j in _jobs(d)] == [("test.fail", "queued")]
+    d.close()
+
+def test_blocking_jobs_are_claimed_on_their_own():
+    d = _session()
+    jobs.enqueue(d, "test.file")
+    jobs.enqueue(d, "test.file")
+    jobs.enqueue(d, "test.award")
+    d.commit()
+    assert [j.kind for j in _claim(d, "a")] == ["test.award"]
+    [job] = _claim(d, "b", 1, blocking=True)
+    until = d.execute(text("SELECT locked_until FROM jobs WHERE id=:id"), {"id": job.id}).scalar()
+    assert datetime.fromisoformat(str(until)) > datetime.utcnow() + jobs.LEASE
+    d.close()
+
+def test_keyed_job_is_queued_once():
+    d = _session()
+    jobs.enqueue(d, "test.award", key="k")
+    d.commit()
+    jobs.enqueue(d, "test.award", key="k")
+    d.commit()
+    assert jobs.pending(d, "test.award") == 1
+
+    # Claiming releases the key, so the running job can queue its follow-up.
+    _claim(d, "a")
+    jobs.enqueue(d, "test.award", key="k")
+    d.commit()
+    assert jobs.pending(d, "test.award") == 2
+    d.close()
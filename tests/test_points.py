@@ -0,0 +1,54 @@
+import os, tempfile
+
+_tmp = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = f"sqlite:///{_tmp}/test.db"
+
+from datetime import datetime
+from sqlalchemy import text
+
+from app import models, migrations, points, tasks, jobs
+from app.db import engine, SessionLocal
+
+migrations.run(engine)
+
+def _session():
+    d = SessionLocal()
+    for t in ("points", "points_month", "points_archive", "points_balance", "jobs", "users"):
+        d.execute(text(f"DELETE FROM {t}"))
+    d.execute(text("INSERT INTO users (id, name, email) VALUES (1, 'a', 'a@example.com')"))
+    d.commit()
+    return d
+
+def test_compacts_consecutive_months():
+    # The first run empties `points`, so the next month's rows reuse its ids.
+    d = _session()
+    points.award(d, 1, "ATTENDANCE", "july", 10, datetime(2026, 7, 3))
+    d.commit()
+    assert points.compact(d, before="2026-08") == {"2026-07": 1}
+    points.award(d, 1, "ATTENDANCE", "august", 5, datetime(2026, 8, 3))
+    d.commit()
+    assert points.compact(d, before="2026-09") == {"2026-08": 1}
+
+    assert d.execute(text("SELECT COUNT(*) FROM points")).scalar() == 0
+    archived = d.execute(text("SELECT id, source_id, descr FROM points_archive ORDER BY id")).fetchall()
+    assert [r.descr for r in archived] == ["july", "august"]
+    assert archived[0].source_id == archived[1].source_id
+    months = d.execute(text("SELECT month, pts FROM points_month ORDER BY month")).fetchall()
+    assert [(r.month, r.pts) for r in months] == [("2026-07", 10), ("2026-08", 5)]
+    assert points.balance(d, 1) == 15
+    d.close()
+
+def test_failed_month_is_rescheduled(monkeypatch):
+    d = _session()
+    points.award(d, 1, "ATTENDANCE", "july", 10, datetime(2026, 7, 3))
+    d.commit()
+
+    def boom(d, month):
+        raise RuntimeError("disk full")
+    monkeypatch.setattr(points, "compact_month", boom)
+    tasks.compact_points(d, {})
+    d.commit()
+
+    assert d.execute(text("SELECT COUNT(*) FROM points")).scalar() == 1
+    assert jobs.pending(d, "points.compact") == 1
+    d.close()
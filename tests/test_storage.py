@@ -0,0 +1,119 @@
+import os, tempfile
+
+_tmp = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = f"sqlite:///{_tmp}/test.db"
+
+import asyncio, hashlib
+from datetime import datetime, timedelta
+from sqlalchemy import text
+from starlette.datastructures import Headers
+
+from app import models, migrations, storage
+from app.db import engine, SessionLocal
+
+migrations.run(engine)
+
+def _session(tmp_path, monkeypatch):
+    # Blob paths are relative to the working directory.
+    monkeypatch.chdir(tmp_path)
+    d = SessionLocal()
+    for t in ("recce", "blobs", "bundles"):
+        d.execute(text(f"DELETE FROM {t}"))
+    d.commit()
+    return d
+
+def _stage(data: bytes, ext: str = ".bin", content_type: str = "application/octet-stream"):
+    os.makedirs(storage.STAGING_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=storage.STAGING_DIR, prefix="up-")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    return storage.Staged(path, hashlib.sha256(data).hexdigest(), len(data), ext, content_type)
+
+def _file(d, data: bytes, **kw):
+    # A recce row pointing at `data`, committed; returns the blob path.
+    path = storage.put(d, _stage(data, **kw))
+    d.execute(text("INSERT INTO recce (user_id, filename) VALUES (1, :p)"), {"p": path})
+    d.commit()
+    return path
+
+def _blob(d, path: str):
+    sha, _ = storage.parse(path)
+    return d.execute(text("SELECT * FROM blobs WHERE sha256=:s"), {"s": sha}).fetchone()
+
+def test_put_dedupes_and_counts_refs(tmp_path, monkeypatch):
+    d = _session(tmp_path, monkeypatch)
+    a = _file(d, b"same bytes", ext=".txt")
+    second = _stage(b"same bytes", ext=".txt")
+    b = storage.put(d, second)
+    d.execute(text("INSERT INTO recce (user_id, filename) VALUES (1, :p)"), {"p": b})
+    d.commit()
+
+    assert a == b == storage.blob_path(hashlib.sha256(b"same bytes").hexdigest(), ".txt")
+    assert not os.path.exists(second.path)
+    assert os.listdir(storage.STAGING_DIR) == []
+    assert _blob(d, a).refs == 2
+    d.execute(text("DELETE FROM recce WHERE id=(SELECT MIN(id) FROM recce)"))
+    d.commit()
+    assert _blob(d, a).refs == 1
+    d.close()
+
+def test_rolled_back_put_leaves_no_file(tmp_path, monkeypatch):
+    d = _session(tmp_path, monkeypatch)
+    staged = _stage(b"never committed")
+    path = storage.put(d, staged)
+    assert os.path.exists(path)
+    d.rollback()
+
+    assert not os.path.exists(path)
+    assert not os.path.exists(staged.path)
+    assert _blob(d, path) is None
+    d.close()
+
+def test_gc_keeps_unreferenced_blobs_for_the_grace_period(tmp_path, monkeypatch):
+    d = _session(tmp_path, monkeypatch)
+    kept = _file(d, b"still used")
+    orphan = _file(d, b"orphan")
+    d.execute(text("DELETE FROM recce WHERE filename=:p"), {"p": orphan})
+    d.commit()
+
+    assert storage.gc(d) == 0
+    assert os.path.exists(orphan)
+
+    expired = datetime.utcnow() - storage.GC_GRACE - timedelta(minutes=1)
+    d.execute(text("UPDATE blobs SET touched_at=:t"), {"t": expired})
+    d.commit()
+    assert storage.gc(d) == 1
+    assert not os.path.exists(orphan) and _blob(d, orphan) is None
+    assert os.path.exists(kept) and _blob(d, kept).refs == 1
+    d.close()
+
+async def _get(path: str, **headers):
+    resp = await storage.response(path.removeprefix("uploads/"), Headers(headers), "immutable")
+    return resp.status_code, resp.headers, b"".join([c async for c in resp.body_iterator])
+
+def test_packed_blobs_are_served_with_ranges(tmp_path, monkeypatch):
+    d = _session(tmp_path, monkeypatch)
+    backend = storage.backend_from_url(f"s3+file://{tmp_path}/s3/archive")
+    monkeypatch.setattr(storage, "_archive", backend)
+    monkeypatch.setattr(storage, "READ_CHUNK", 4096)  # several chunks per entry
+    text_ = b"%PDF-1.4 " + b"site plan, level 2 " * 4000
+    noise = os.urandom(20000)
+    photo = os.urandom(12000)
+    files = [(_file(d, text_, ext=".pdf", content_type="application/pdf"), text_),
+             (_file(d, noise, ext=".pdf", content_type="application/pdf"), noise),
+             (_file(d, photo, ext=".jpg", content_type="image/jpeg"), photo)]
+    d.execute(text("UPDATE blobs SET created_at=:t"), {"t": datetime(2020, 1, 1)})
+    d.commit()
+
+    assert storage.pack(d, backend=backend) == 3
+    assert [_blob(d, p).method for p, _ in files] == ["deflate", "store", "store"]
+    for path, data in files:
+        assert not os.path.exists(path)
+        status, h, body = asyncio.run(_get(path))
+        assert (status, body) == (200, data)
+        status, h, body = asyncio.run(_get(path, range="bytes=5000-9999"))
+        assert (status, body, h["content-range"]) == (206, data[5000:10000], f"bytes 5000-9999/{len(data)}")
+        status, h, body = asyncio.run(_get(path, range="bytes=-100"))
+        assert (status, body) == (206, data[-100:])
+    assert storage.pack(d, backend=backend) == 0
+    d.close()